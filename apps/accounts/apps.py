@@ -3,4 +3,8 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.accounts'
-    verbose_name = 'Accounts'
\ No newline at end of file
+    verbose_name = 'Accounts'
+    
+    def ready(self):
+        # Invalidation du cache d'authentification des WebSockets
+        from . import signals
@@ -0,0 +1,118 @@
+"""
+Authentification JWT des WebSockets
+
+Les clients mobiles s'authentifient sur les WebSockets avec le même jeton
+d'accès SimpleJWT que sur l'API REST, passé dans l'en-tête
+« Authorization: Bearer <jeton> » ou, pour les clients qui ne peuvent pas
+fixer d'en-tête sur un WebSocket, dans l'URL (?token=<jeton>).
+
+Le jeton est vérifié localement (signature et expiration), sans requête.
+L'utilisateur est ensuite lu dans le cache (Redis en production) pendant
+WEBSOCKET_AUTH_CACHE_TTL secondes : une vague de reconnexions ne coûte que
+des lectures de cache, ni session ni table des utilisateurs. L'entrée est
+effacée à chaque enregistrement de l'utilisateur (voir signals.py), si bien
+qu'un compte désactivé ne se reconnecte plus.
+
+Seuls les champs USER_CACHE_FIELDS (identité publique et is_active) sont
+mis en cache, jamais le mot de passe : scope['user'] est une instance
+partielle du modèle, comme avec only(), dont les autres champs sont différés.
+
+Sans jeton, la session Django est utilisée comme avant (application web).
+"""
+
+from urllib.parse import parse_qs
+from channels.auth import AuthMiddlewareStack
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+USER_CACHE_KEY = 'accounts:ws-user:{}'
+
+# Champs dont ont besoin les consumers (user_payload, is_active)
+USER_CACHE_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'is_active')
+
+
+def user_cache_key(user_id):
+    return USER_CACHE_KEY.format(user_id)
+
+
+def token_from_scope(scope):
+    """Jeton d'accès de la connexion (en-tête Authorization, sinon paramètre token), ou None"""
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode('latin-1').split()
+            if len(parts) == 2 and parts[0] in api_settings.AUTH_HEADER_TYPES:
+                return parts[1]
+
+    token = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('token')
+    return token[0] if token else None
+
+
+def user_id_from_token(raw_token):
+    """Identifiant d'utilisateur d'un jeton d'accès valide, sans requête (None si invalide ou expiré)"""
+    try:
+        return AccessToken(raw_token).get(api_settings.USER_ID_CLAIM)
+    except TokenError:
+        return None
+
+
+def cached_user(fields):
+    """Instance partielle de l'utilisateur à partir des champs mis en cache"""
+    User = get_user_model()
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in fields]
+    return User.from_db(DEFAULT_DB_ALIAS, names, [fields[name] for name in names])
+
+
+async def resolve_user(raw_token):
+    """
+    Utilisateur actif d'un jeton d'accès, lu dans le cache puis en base
+
+    Returns:
+        User partiel (USER_CACHE_FIELDS) ou AnonymousUser si le jeton est
+        invalide ou le compte inactif
+    """
+    user_id = user_id_from_token(raw_token)
+    if user_id is None:
+        return AnonymousUser()
+
+    key = user_cache_key(user_id)
+    fields = await cache.aget(key)
+    if fields is None:
+        fields = await get_user_model().objects.filter(
+            **{api_settings.USER_ID_FIELD: user_id}, is_active=True
+        ).values(*USER_CACHE_FIELDS).afirst()
+        if fields is None:
+            return AnonymousUser()
+        await cache.aset(key, fields, settings.WEBSOCKET_AUTH_CACHE_TTL)
+    return cached_user(fields)
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Renseigne scope['user'] depuis le jeton JWT de la connexion
+
+    Les connexions sans jeton passent par AuthMiddlewareStack (session).
+    """
+
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        raw_token = token_from_scope(scope)
+        if raw_token is None:
+            return await self.session_auth(scope, receive, send)
+
+        scope = dict(scope, user=await resolve_user(raw_token))
+        return await self.inner(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    """Authentification des WebSockets par jeton JWT, ou par session à défaut"""
+    return JWTAuthMiddleware(inner)
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings
+from .middleware import user_cache_key
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_websocket_user(sender, instance, **kwargs):
+    """
+    Efface l'utilisateur du cache d'authentification des WebSockets
+
+    Un compte modifié ou désactivé est relu en base à sa prochaine
+    connexion ; une mise à jour en masse (queryset.update) reste visible au
+    plus WEBSOCKET_AUTH_CACHE_TTL secondes plus tard.
+    """
+    cache.delete(user_cache_key(getattr(instance, api_settings.USER_ID_FIELD)))
@@ -1,10 +1,50 @@
 ﻿from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from django.utils.html import format_html
-from django.db.models import Count
-from .models import Conversation, Message, MessageReadStatus
+from .models import Conversation, Message, MessageReadStatus, ModerationTerm
+from .moderation import bump_version
+from .read_state import mark_messages_read, read_by_recipients, read_positions
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginateur qui estime le nombre de lignes des grandes tables non filtrées
+    
+    Sur PostgreSQL, une liste sans filtre lit l'estimation des statistiques
+    (pg_class.reltuples) au lieu d'un COUNT(*) sur toute la table ; au-delà
+    de ESTIMATE_THRESHOLD lignes, le total affiché est approximatif. Les
+    listes filtrées, les petites tables et les autres bases gardent le
+    décompte exact.
+    """
+    ESTIMATE_THRESHOLD = 100000
+    
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [self.object_list.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            if row and row[0] > self.ESTIMATE_THRESHOLD:
+                return row[0]
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Listes des grandes tables : total estimé, sans second décompte non filtré"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
 
 @admin.register(Conversation)
-class ConversationAdmin(admin.ModelAdmin):
+class ConversationAdmin(LargeTableAdmin):
     """Administration des conversations"""
     
     list_display = [
@@ -16,9 +56,11 @@ class ConversationAdmin(admin.ModelAdmin):
         'updated_at'
     ]
     list_filter = ['created_at', 'updated_at']
+    list_select_related = ['product']
     search_fields = ['participants__username', 'participants__email']
     readonly_fields = ['created_at', 'updated_at', 'get_messages_preview']
-    filter_horizontal = ['participants']
+    # Sélection par id : les listes déroulantes chargeraient tous les utilisateurs et produits
+    raw_id_fields = ['participants', 'product']
     date_hierarchy = 'created_at'
     
     fieldsets = (
@@ -37,7 +79,7 @@ class ConversationAdmin(admin.ModelAdmin):
     
     def get_participants_display(self, obj):
         """Affiche les participants avec des badges colorés"""
-        participants = obj.participants.all()
+        participants = obj.participants.all()  # préchargés par get_queryset
         html = ' '.join([
             f'<span class="badge badge-info" style="background-color: #17a2b8; color: white; padding: 3px 8px; border-radius: 3px; margin: 2px;">{p.username}</span>'
             for p in participants
@@ -46,42 +88,46 @@ class ConversationAdmin(admin.ModelAdmin):
     get_participants_display.short_description = 'Participants'
     
     def get_message_count(self, obj):
-        """Affiche le nombre de messages"""
-        count = obj.messages.count()
+        """Affiche le nombre de messages (annoté par get_queryset)"""
+        count = obj.message_count
         color = '#28a745' if count > 0 else '#6c757d'
         return format_html(
             '<span style="color: {}; font-weight: bold;">{} message{}</span>',
             color, count, 's' if count > 1 else ''
         )
     get_message_count.short_description = 'Messages'
+    get_message_count.admin_order_field = 'message_count'
     
     def get_product_link(self, obj):
         """Affiche un lien vers le produit si disponible"""
-        if obj.product:
+        if obj.product_id:
             return format_html(
                 '<a href="/admin/shops/product/{}/change/" target="_blank">{}</a>',
-                obj.product.id,
-                obj.product.name if hasattr(obj.product, 'name') else f'Produit #{obj.product.id}'
+                obj.product_id,
+                obj.product.title or f'Produit #{obj.product_id}'
             )
         return format_html('<span style="color: #6c757d;">-</span>')
     get_product_link.short_description = 'Produit'
     
     def get_messages_preview(self, obj):
         """Affiche un aperçu des derniers messages"""
-        messages = obj.messages.order_by('-created_at')[:5]
+        messages = obj.messages.select_related('sender').order_by('-created_at')[:5]
         if not messages:
             return format_html('<p style="color: #6c757d;">Aucun message</p>')
         
+        # Lu par tous les destinataires, d'après leurs curseurs de lecture
+        positions = read_positions(obj.id)
         html = '<div style="max-height: 300px; overflow-y: auto;">'
         for msg in messages:
+            is_read = read_by_recipients(msg, positions)
             html += f'''
             <div style="border-left: 3px solid #007bff; padding: 10px; margin: 10px 0; background: #f8f9fa;">
                 <strong>{msg.sender.username}</strong>
                 <small style="color: #6c757d; float: right;">{msg.created_at.strftime("%d/%m/%Y %H:%M")}</small>
                 <br>
                 <p style="margin: 5px 0;">{msg.content[:200]}{'...' if len(msg.content) > 200 else ''}</p>
-                <span style="color: {'#28a745' if msg.is_read else '#dc3545'}; font-size: 12px;">
-                    {'✓ Lu' if msg.is_read else '✗ Non lu'}
+                <span style="color: {'#28a745' if is_read else '#dc3545'}; font-size: 12px;">
+                    {'✓ Lu' if is_read else '✗ Non lu'}
                 </span>
             </div>
             '''
@@ -90,15 +136,24 @@ class ConversationAdmin(admin.ModelAdmin):
     get_messages_preview.short_description = 'Aperçu des messages'
     
     def get_queryset(self, request):
-        """Optimise les requêtes"""
+        """
+        Optimise les requêtes
+        
+        Participants préchargés en une requête pour toute la page, et nombre
+        de messages en sous-requête corrélée : calculé pour les seules lignes
+        affichées, sans jointure groupée sur toute la table des messages.
+        """
         qs = super().get_queryset(request)
-        return qs.prefetch_related('participants', 'messages').annotate(
-            message_count=Count('messages')
+        message_count = Message.objects.filter(conversation=OuterRef('pk')).order_by().values(
+            'conversation'
+        ).annotate(count=Count('id')).values('count')
+        return qs.prefetch_related('participants').annotate(
+            message_count=Coalesce(Subquery(message_count), 0)
         )
 
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     """Administration des messages"""
     
     list_display = [
@@ -106,11 +161,13 @@ class MessageAdmin(admin.ModelAdmin):
         'get_sender_display',
         'get_conversation_link',
         'get_content_preview',
-        'is_read',
         'created_at'
     ]
-    list_filter = ['is_read', 'created_at', 'sender']
-    search_fields = ['sender__username', 'content', 'conversation__id']
+    # Pas de filtre par expéditeur : il listerait tous les utilisateurs
+    list_filter = ['created_at']
+    list_select_related = ['sender']
+    search_fields = ['sender__username', 'content', '=conversation__id']
+    raw_id_fields = ['conversation', 'sender']
     readonly_fields = ['created_at', 'get_full_content']
     date_hierarchy = 'created_at'
     
@@ -118,9 +175,6 @@ class MessageAdmin(admin.ModelAdmin):
         ('Message', {
             'fields': ('conversation', 'sender', 'get_full_content', 'attachment')
         }),
-        ('Statut', {
-            'fields': ('is_read',)
-        }),
         ('Date', {
             'fields': ('created_at',),
             'classes': ('collapse',)
@@ -139,8 +193,8 @@ class MessageAdmin(admin.ModelAdmin):
         """Lien vers la conversation"""
         return format_html(
             '<a href="/admin/messaging/conversation/{}/change/">Conv. #{}</a>',
-            obj.conversation.id,
-            obj.conversation.id
+            obj.conversation_id,
+            obj.conversation_id
         )
     get_conversation_link.short_description = 'Conversation'
     
@@ -162,33 +216,24 @@ class MessageAdmin(admin.ModelAdmin):
         )
     get_full_content.short_description = 'Contenu complet'
     
-    def get_queryset(self, request):
-        """Optimise les requêtes"""
-        qs = super().get_queryset(request)
-        return qs.select_related('sender', 'conversation')
-    
-    actions = ['mark_as_read', 'mark_as_unread']
+    actions = ['mark_as_read']
     
     def mark_as_read(self, request, queryset):
-        """Action pour marquer comme lu"""
-        updated = queryset.update(is_read=True)
-        self.message_user(request, f'{updated} message(s) marqué(s) comme lu(s).')
-    mark_as_read.short_description = "Marquer comme lu"
-    
-    def mark_as_unread(self, request, queryset):
-        """Action pour marquer comme non lu"""
-        updated = queryset.update(is_read=False)
-        self.message_user(request, f'{updated} message(s) marqué(s) comme non lu(s).')
-    mark_as_unread.short_description = "Marquer comme non lu"
+        """Action pour marquer comme lu par les destinataires (avance leurs curseurs de lecture)"""
+        advanced = mark_messages_read(queryset)
+        self.message_user(request, f'{advanced} curseur(s) de lecture avancé(s).')
+    mark_as_read.short_description = "Marquer comme lu par les destinataires"
 
 
 @admin.register(MessageReadStatus)
-class MessageReadStatusAdmin(admin.ModelAdmin):
+class MessageReadStatusAdmin(LargeTableAdmin):
     """Administration des statuts de lecture"""
     
     list_display = ['id', 'get_message_preview', 'user', 'read_at']
-    list_filter = ['read_at', 'user']
+    list_filter = ['read_at']
+    list_select_related = ['message', 'user']
     search_fields = ['user__username', 'message__content']
+    raw_id_fields = ['message', 'user']
     readonly_fields = ['read_at']
     date_hierarchy = 'read_at'
     
@@ -201,14 +246,35 @@ class MessageReadStatusAdmin(admin.ModelAdmin):
             preview
         )
     get_message_preview.short_description = 'Message'
+
+
+@admin.register(ModerationTerm)
+class ModerationTermAdmin(admin.ModelAdmin):
+    """Administration des termes de modération"""
     
-    def get_queryset(self, request):
-        """Optimise les requêtes"""
-        qs = super().get_queryset(request)
-        return qs.select_related('message', 'user')
+    list_display = ['term', 'category', 'is_active', 'updated_at']
+    list_filter = ['category', 'is_active']
+    list_editable = ['is_active']
+    search_fields = ['term']
+    actions = ['activate_terms', 'deactivate_terms']
+    
+    def activate_terms(self, request, queryset):
+        """Active les termes sélectionnés"""
+        updated = queryset.update(is_active=True)
+        # Les workers ne doivent pas recharger la liste avant le commit de la mise à jour
+        transaction.on_commit(bump_version)
+        self.message_user(request, f'{updated} terme(s) activé(s).')
+    activate_terms.short_description = 'Activer les termes sélectionnés'
+    
+    def deactivate_terms(self, request, queryset):
+        """Désactive les termes sélectionnés"""
+        updated = queryset.update(is_active=False)
+        transaction.on_commit(bump_version)
+        self.message_user(request, f'{updated} terme(s) désactivé(s).')
+    deactivate_terms.short_description = 'Désactiver les termes sélectionnés'
 
 
 # Personnalisation du site admin
 admin.site.site_header = "Pi Market - Administration"
 admin.site.site_title = "Pi Market Admin"
-admin.site.index_title = "Tableau de bord"
\ No newline at end of file
+admin.site.index_title = "Tableau de bord"
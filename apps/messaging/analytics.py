@@ -0,0 +1,182 @@
+"""
+Statistiques de messagerie calculées par la base
+
+Chaque statistique est une requête ensembliste (agrégats groupés, fonction
+de fenêtre LAG pour les temps de réponse) : le nombre de requêtes ne dépend
+ni du nombre de conversations ni du nombre de messages de l'utilisateur,
+et aucun message n'est chargé en Python.
+
+Les conversations d'un utilisateur sont lues par la paire user_low /
+user_high (index conversation_low_inbox / conversation_high_inbox).
+
+Les statistiques globales d'un utilisateur peuvent aussi être figées chaque
+nuit dans UserMessagingStats (tâche rollup_messaging_stats) pour les pages
+qui les affichent souvent.
+"""
+
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Case, Count, F, Q, When
+from django.utils import timezone
+from .models import Conversation, Message, UserMessagingStats
+from .read_state import total_unread
+
+ACTIVE_DAYS = 30
+
+# Écart en secondes entre deux horodatages, selon la base
+_SECONDS_BETWEEN = {
+    'postgresql': 'EXTRACT(EPOCH FROM responses.created_at - responses.previous_at)',
+    'sqlite': '(julianday(responses.created_at) - julianday(responses.previous_at)) * 86400',
+}
+
+# Réponses de l'utilisateur : ses messages qui suivent un message d'un autre
+# participant dans la même conversation (LAG sur created_at, id)
+_RESPONSE_TIME_SQL = """
+    SELECT AVG({seconds}) FROM (
+        SELECT m.sender_id, m.created_at,
+               LAG(m.sender_id) OVER history AS previous_sender_id,
+               LAG(m.created_at) OVER history AS previous_at
+        FROM messaging_message m
+        WHERE m.conversation_id IN (
+            SELECT c.id FROM messaging_conversation c WHERE c.user_low_id = %(user)s OR c.user_high_id = %(user)s
+        )
+        WINDOW history AS (PARTITION BY m.conversation_id ORDER BY m.created_at, m.id)
+    ) responses
+    WHERE responses.sender_id = %(user)s AND responses.previous_sender_id <> %(user)s
+"""
+
+
+def user_conversations(user_id):
+    """Conversations à deux de l'utilisateur"""
+    return Conversation.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id))
+
+
+def popular_contacts(user_id, limit=10):
+    """
+    Contacts de l'utilisateur classés par nombre de messages échangés
+
+    Deux requêtes : les comptes groupés par contact, puis les utilisateurs.
+
+    Returns:
+        list: tuples (User, message_count), du plus au moins actif
+    """
+    counts = list(
+        user_conversations(user_id).exclude(user_low_id=F('user_high_id')).annotate(
+            contact_id=Case(When(user_low_id=user_id, then=F('user_high_id')), default=F('user_low_id'))
+        ).values('contact_id').annotate(
+            message_count=Count('messages')
+        ).order_by('-message_count', 'contact_id')[:limit]
+    )
+
+    users = get_user_model().objects.in_bulk([row['contact_id'] for row in counts])
+    return [(users[row['contact_id']], row['message_count']) for row in counts]
+
+
+def average_response_time(user_id):
+    """
+    Temps de réponse moyen de l'utilisateur
+
+    Une requête : LAG sur l'historique de chaque conversation, moyenne
+    calculée par la base.
+
+    Returns:
+        timedelta ou None si l'utilisateur n'a jamais répondu
+    """
+    sql = _RESPONSE_TIME_SQL.format(seconds=_SECONDS_BETWEEN.get(connection.vendor, _SECONDS_BETWEEN['postgresql']))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {'user': user_id})
+        seconds = cursor.fetchone()[0]
+
+    return None if seconds is None else timedelta(seconds=float(seconds))
+
+
+def most_active_conversation(user_id):
+    """Conversation de l'utilisateur qui compte le plus de messages (ou None)"""
+    return user_conversations(user_id).annotate(
+        msg_count=Count('messages')
+    ).order_by('-msg_count', '-id').first()
+
+
+def active_conversation_count(user_id):
+    """Conversations de l'utilisateur qui ont reçu un message depuis ACTIVE_DAYS jours"""
+    cutoff = timezone.now() - timedelta(days=ACTIVE_DAYS)
+    return user_conversations(user_id).filter(last_message_at__gte=cutoff).count()
+
+
+def compute_user_stats(user_id):
+    """
+    Statistiques globales de messagerie d'un utilisateur, hors non-lus
+
+    Quatre requêtes quel que soit le volume : conversations (totales et
+    actives), messages (envoyés et reçus), temps de réponse, conversation
+    la plus active.
+    """
+    cutoff = timezone.now() - timedelta(days=ACTIVE_DAYS)
+    conversations = user_conversations(user_id).aggregate(
+        total=Count('id'),
+        active=Count('id', filter=Q(last_message_at__gte=cutoff)),
+    )
+    messages = Message.objects.filter(conversation__in=user_conversations(user_id)).aggregate(
+        sent=Count('id', filter=Q(sender_id=user_id)),
+        received=Count('id', filter=~Q(sender_id=user_id)),
+    )
+
+    return {
+        'total_conversations': conversations['total'],
+        'active_conversations': conversations['active'],
+        'total_messages_sent': messages['sent'],
+        'total_messages_received': messages['received'],
+        'average_response_time': average_response_time(user_id),
+        'most_active_conversation': most_active_conversation(user_id),
+    }
+
+
+def user_stats(user, use_rollup=False):
+    """
+    Statistiques globales de messagerie d'un utilisateur
+
+    Args:
+        user: Utilisateur
+        use_rollup: Lire le dernier instantané nocturne s'il existe plutôt
+            que de tout recalculer (les non-lus et les conversations
+            actives, qui dépendent de la date du jour, restent en temps réel)
+
+    Returns:
+        dict: Statistiques
+    """
+    stats = None
+    if use_rollup:
+        rollup = UserMessagingStats.objects.select_related('most_active_conversation').filter(user=user).first()
+        if rollup is not None:
+            stats = rollup.as_dict()
+            # Une conversation sort de la fenêtre active sans nouveau message : pas de re-calcul nocturne
+            stats['active_conversations'] = active_conversation_count(user.id)
+
+    if stats is None:
+        stats = compute_user_stats(user.id)
+
+    stats['unread_messages'] = total_unread(user)
+    return stats
+
+
+def active_user_ids(since):
+    """Utilisateurs dont une conversation a reçu un message depuis since"""
+    recent = Conversation.objects.filter(last_message_at__gte=since)
+    return set(recent.values_list('user_low_id', flat=True)) | set(recent.values_list('user_high_id', flat=True))
+
+
+def rollup_user_stats(user_ids):
+    """
+    Fige les statistiques des utilisateurs donnés dans UserMessagingStats
+
+    Returns:
+        int: Nombre d'instantanés écrits
+    """
+    written = 0
+    for user_id in user_ids:
+        if user_id is None:
+            continue
+        UserMessagingStats.objects.update_or_create(user_id=user_id, defaults=compute_user_stats(user_id))
+        written += 1
+    return written
@@ -1,162 +1,455 @@
-﻿import json
-from channels.generic.websocket import AsyncWebsocketConsumer
+﻿import asyncio
+import json
+import uuid
 from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Conversation, Message
-from .serializers import MessageSerializer
+from .delivery import DeliveryError, acknowledge, asend_message
+from .models import Conversation
+from .serializers import message_payload, user_payload
+from .read_state import aapply_read_flags, amark_conversation_read
+from . import history, presence
+from .throttling import TokenBucket, TypingCoalescer
+
+
+def user_group(user_id):
+    """Groupe du channel layer qui reçoit les événements d'un utilisateur, toutes conversations"""
+    return f'messaging_user_{user_id}'
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+def conversation_group(conversation_id):
+    """Groupe du channel layer des sockets abonnés à une conversation"""
+    return f'chat_{conversation_id}'
+
+
+class MessagingConsumer(AsyncWebsocketConsumer):
     """
-    Consumer WebSocket pour la messagerie en temps réel
+    WebSocket de messagerie unique par utilisateur (ws/messaging/)
+    
+    Le client s'abonne et se désabonne des conversations par des commandes :
+    {"type": "subscribe", "conversation_ids": [...]} (appartenance vérifiée
+    en une requête pour toute la liste) et {"type": "unsubscribe", ...}. Les
+    trames chat_message, typing, mark_read, ack et backfill portent le
+    conversation_id visé. Les événements arrivent par les groupes des
+    conversations abonnées, et par le groupe de l'utilisateur pour ce qui
+    concerne ses autres conversations (inbox_update) et les accusés de
+    réception de ses messages (receipt).
+    
+    Une trame chat_message peut porter un client_id (UUID) : un renvoi
+    après coupure n'est ni enregistré ni diffusé une seconde fois, le
+    message déjà enregistré est renvoyé au seul expéditeur (voir
+    delivery.py).
+    
+    Chemin critique entièrement sur l'ORM asynchrone : l'appartenance est
+    vérifiée une seule fois à l'abonnement, l'expéditeur est sérialisé une
+    seule fois, et chaque message diffusé est encodé en JSON une seule fois
+    pour tout le groupe.
     """
     
     async def connect(self):
         """Connexion WebSocket"""
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.conversation_group_name = f'chat_{self.conversation_id}'
         self.user = self.scope['user']
+        self.subscriptions = {}
         
         # Vérifier si l'utilisateur est authentifié
         if not self.user.is_authenticated:
             await self.close()
             return
         
-        # Vérifier si l'utilisateur fait partie de la conversation
-        is_participant = await self.is_conversation_participant()
-        if not is_participant:
+        if not await self.before_accept():
             await self.close()
             return
         
-        # Rejoindre le groupe de la conversation
-        await self.channel_layer.group_add(
-            self.conversation_group_name,
-            self.channel_name
-        )
+        self.is_connected = True
+        self.sender_data = user_payload(self.user)
+        self.user_group_name = user_group(self.user.id)
         
-        await self.accept()
+        # Présence : publiée seulement au passage en ligne, puis entretenue par battements
+        if await presence.mark_online(self.user.id):
+            await presence.publish_change(self.channel_layer, self.user.id, True)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
         
+        # Limite de trames entrantes par socket
+        self.inbound = TokenBucket(settings.MESSAGING_SOCKET_RATE, settings.MESSAGING_SOCKET_BURST)
+        self.rate_limited = False
+        
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        await self.accept()
+        await self.after_accept()
+    
+    async def before_accept(self):
+        """Contrôles supplémentaires avant d'accepter le socket"""
+        return True
+    
+    async def after_accept(self):
         # Envoyer un message de confirmation
-        await self.send(text_data=json.dumps({
+        await self.send_json({
             'type': 'connection_established',
-            'message': 'Connecté à la conversation'
-        }))
+            'message': 'Connecté à la messagerie'
+        })
     
     async def disconnect(self, close_code):
         """Déconnexion WebSocket"""
-        # Quitter le groupe de la conversation
-        await self.channel_layer.group_discard(
-            self.conversation_group_name,
-            self.channel_name
-        )
+        if not getattr(self, 'is_connected', False):
+            return
+        
+        self.heartbeat_task.cancel()
+        for conversation_id in list(self.subscriptions):
+            await self.unsubscribe(conversation_id)
+        
+        if await presence.mark_offline(self.user.id):
+            await presence.publish_change(self.channel_layer, self.user.id, False)
+        
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
     
     async def receive(self, text_data):
-        """Recevoir un message du WebSocket"""
+        """Recevoir une trame du WebSocket"""
+        if not self.inbound.consume():
+            # Une seule erreur par rafale : les trames suivantes sont ignorées sans réponse
+            if not self.rate_limited:
+                self.rate_limited = True
+                await self.send_error('Trop de messages, ralentissez')
+            return
+        self.rate_limited = False
+        
         try:
             data = json.loads(text_data)
-            message_type = data.get('type')
-            
-            if message_type == 'chat_message':
-                content = data.get('message')
-                
-                if not content or not content.strip():
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': 'Le message ne peut pas être vide'
-                    }))
-                    return
-                
-                # Sauvegarder le message dans la base de données
-                message = await self.save_message(content)
-                
-                if message:
-                    # Diffuser le message à tous les participants
-                    await self.channel_layer.group_send(
-                        self.conversation_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message
-                        }
-                    )
+        except json.JSONDecodeError:
+            await self.send_error('Format JSON invalide')
+            return
+        
+        message_type = data.get('type')
+        
+        if message_type == 'subscribe':
+            await self.handle_subscribe(data)
+            return
+        if message_type == 'unsubscribe':
+            for conversation_id in self.requested_conversations(data):
+                await self.unsubscribe(conversation_id)
+                await self.send_json({'type': 'unsubscribed', 'conversation_id': conversation_id})
+            return
+        
+        handler = {
+            'chat_message': self.handle_chat_message,
+            'typing': self.handle_typing,
+            'mark_read': self.handle_mark_read,
+            'ack': self.handle_ack,
+            'backfill': self.send_backfill,
+        }.get(message_type)
+        if handler is None:
+            return
+        
+        conversation_id = self.target_conversation(data)
+        if conversation_id not in self.subscriptions:
+            await self.send_error("Conversation non abonnée")
+            return
+        await handler(conversation_id, data)
+    
+    # Abonnements
+    
+    def requested_conversations(self, data):
+        """IDs de conversation d'une commande (conversation_id ou conversation_ids)"""
+        requested = data.get('conversation_ids')
+        if requested is None:
+            requested = [data.get('conversation_id')]
+        try:
+            return list(dict.fromkeys(int(conversation_id) for conversation_id in requested))
+        except (TypeError, ValueError):
+            return []
+    
+    def target_conversation(self, data):
+        """Conversation visée par une trame"""
+        try:
+            return int(data.get('conversation_id'))
+        except (TypeError, ValueError):
+            return None
+    
+    async def handle_subscribe(self, data):
+        requested = [c for c in self.requested_conversations(data) if c not in self.subscriptions]
+        room = settings.MESSAGING_MAX_SUBSCRIPTIONS - len(self.subscriptions)
+        allowed = await self.participant_conversations(requested[:max(room, 0)])
+        
+        for conversation_id in requested:
+            if conversation_id in allowed:
+                await self.subscribe(conversation_id)
+        for conversation_id in self.requested_conversations(data):
+            if conversation_id in self.subscriptions:
+                await self.send_json({'type': 'subscribed', 'conversation_id': conversation_id})
+            else:
+                await self.send_json({
+                    'type': 'error',
+                    'conversation_id': conversation_id,
+                    'message': "Abonnement refusé"
+                })
+    
+    async def subscribe(self, conversation_id):
+        self.subscriptions[conversation_id] = TypingCoalescer(
+            lambda is_typing: self.publish_typing(conversation_id, is_typing),
+            settings.MESSAGING_TYPING_INTERVAL,
+            settings.MESSAGING_TYPING_TIMEOUT,
+        )
+        await self.channel_layer.group_add(conversation_group(conversation_id), self.channel_name)
+    
+    async def unsubscribe(self, conversation_id):
+        typing = self.subscriptions.pop(conversation_id, None)
+        if typing is None:
+            return
+        await typing.close()
+        await self.channel_layer.group_discard(conversation_group(conversation_id), self.channel_name)
+    
+    async def participant_conversations(self, conversation_ids):
+        """Conversations de la liste dont l'utilisateur est participant (une requête)"""
+        if not conversation_ids:
+            return set()
+        return {
+            conversation_id async for conversation_id in Conversation.participants.through.objects.filter(
+                conversation_id__in=conversation_ids,
+                user_id=self.user.id
+            ).values_list('conversation_id', flat=True)
+        }
+    
+    # Trames du client
+    
+    async def handle_chat_message(self, conversation_id, data):
+        content = data.get('message')
+        
+        if not content or not content.strip():
+            await self.send_error('Le message ne peut pas être vide')
+            return
+        
+        try:
+            client_id = uuid.UUID(str(data['client_id'])) if data.get('client_id') else None
+        except ValueError:
+            await self.send_error('client_id invalide')
+            return
+        
+        # Sauvegarder le message dans la base de données
+        message, created = await self.save_message(conversation_id, content, client_id)
+        
+        if message and not created:
+            # Renvoi : le message est déjà chez les participants
+            await self.send_json({'type': 'chat_message', 'message': message})
+        elif message:
+            # Diffuser le message à tous les participants, encodé une seule fois
+            await self.channel_layer.group_send(
+                conversation_group(conversation_id),
+                {
+                    'type': 'chat_message',
+                    'text': json.dumps({
+                        'type': 'chat_message',
+                        'message': message
+                    })
+                }
+            )
+    
+    async def handle_typing(self, conversation_id, data):
+        # Seuls les changements d'état sont diffusés, au plus un par intervalle
+        await self.subscriptions[conversation_id].update(data.get('is_typing', False))
+    
+    async def handle_mark_read(self, conversation_id, data):
+        """Marquer tous les messages de la conversation comme lus"""
+        try:
+            await amark_conversation_read(conversation_id, self.user.id)
+        except Exception as e:
+            print(f"Erreur lors du marquage des messages: {e}")
+    
+    async def handle_ack(self, conversation_id, data):
+        """
+        Accusé groupé de réception et de lecture
+        
+        {"type": "ack", "delivered": [ids], "read": [ids]} ; les expéditeurs
+        des messages acquittés reçoivent un seul événement receipt.
+        """
+        delivered, read = data.get('delivered'), data.get('read')
+        if not isinstance(delivered or [], list) or not isinstance(read or [], list):
+            await self.send_error('Accusé invalide')
+            return
+        
+        try:
+            receipt = await database_sync_to_async(acknowledge)(conversation_id, self.user.id, delivered, read)
+        except Exception as e:
+            print(f"Erreur lors de l'enregistrement de l'accusé: {e}")
+            return
+        
+        if receipt is None:
+            return
+        event = {
+            'type': 'receipt_update',
+            'conversation_id': conversation_id,
+            'user_id': self.user.id,
+            'delivered_up_to': receipt['delivered_up_to'],
+            'read_up_to': receipt['read_up_to'],
+        }
+        for sender_id in receipt['sender_ids']:
+            await self.channel_layer.group_send(user_group(sender_id), event)
+    
+    async def send_backfill(self, conversation_id, data):
+        """
+        Envoie une page de l'historique après (ou avant) un message donné
+        
+        Le client envoie {"type": "backfill", "after": <dernier id reçu>} et
+        recommence avec le dernier id de la réponse tant que has_more est vrai.
+        Les messages diffusés pendant le rattrapage peuvent arriver en double
+        (même id) et sont à dédupliquer côté client.
+        """
+        try:
+            after = int(data['after']) if data.get('after') is not None else None
+            before = int(data['before']) if data.get('before') is not None else None
+        except (TypeError, ValueError):
+            await self.send_error('Curseur de rattrapage invalide')
+            return
+        
+        result = await history.apage(conversation_id, before=before, after=after, limit=data.get('limit'))
+        
+        await aapply_read_flags(result.messages, self.user)
+        
+        senders = {}
+        messages = []
+        for message in result.messages:
+            if message.sender_id not in senders:
+                senders[message.sender_id] = user_payload(message.sender)
+            messages.append(message_payload(message, senders[message.sender_id]))
+        
+        await self.send_json({
+            'type': 'backfill',
+            'conversation_id': conversation_id,
+            'messages': messages,
+            'has_more': result.has_more
+        })
+    
+    async def save_message(self, conversation_id, content, client_id=None):
+        """
+        Sauvegarder le message dans la base de données
+        
+        Returns:
+            tuple: (message sérialisé ou None en cas d'erreur, created)
+        """
+        try:
+            message, created = await asend_message(
+                self.user,
+                client_id,
+                conversation_id=conversation_id,
+                content=content
+            )
             
-            elif message_type == 'typing':
-                # Diffuser l'indicateur de frappe
-                is_typing = data.get('is_typing', False)
-                await self.channel_layer.group_send(
-                    self.conversation_group_name,
-                    {
-                        'type': 'typing_indicator',
-                        'user_id': self.user.id,
-                        'username': self.user.username,
-                        'is_typing': is_typing
-                    }
-                )
+            # Renvoi d'un message déjà enregistré : il a pu être lu depuis
+            if not created:
+                await aapply_read_flags([message], self.user)
             
-            elif message_type == 'mark_read':
-                # Marquer les messages comme lus
-                await self.mark_messages_read()
-                
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'Format JSON invalide'
-            }))
+            # Sérialiser le message sans DRF
+            return message_payload(message, self.sender_data), created
+        except DeliveryError as e:
+            await self.send_error(str(e))
+            return None, False
+        except Exception as e:
+            print(f"Erreur lors de la sauvegarde du message: {e}")
+            return None, False
+    
+    # Événements du channel layer
     
     async def chat_message(self, event):
         """Recevoir un message du groupe et l'envoyer au WebSocket"""
-        message = event['message']
-        
-        # Envoyer le message au WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': message
-        }))
+        # Le message est déjà encodé par l'expéditeur
+        await self.send(text_data=event['text'])
+    
+    async def publish_typing(self, conversation_id, is_typing):
+        """Diffuser l'indicateur de frappe (appelé par le TypingCoalescer)"""
+        await self.channel_layer.group_send(
+            conversation_group(conversation_id),
+            {
+                'type': 'typing_indicator',
+                'conversation_id': conversation_id,
+                'user_id': self.user.id,
+                'username': self.user.username,
+                'is_typing': is_typing
+            }
+        )
     
     async def typing_indicator(self, event):
         """Envoyer l'indicateur de frappe"""
         # Ne pas envoyer l'indicateur à l'utilisateur qui tape
         if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
+            await self.send_json({
                 'type': 'typing_indicator',
+                'conversation_id': event['conversation_id'],
                 'username': event['username'],
                 'is_typing': event['is_typing']
-            }))
+            })
     
-    @database_sync_to_async
-    def is_conversation_participant(self):
-        """Vérifier si l'utilisateur fait partie de la conversation"""
-        try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            return conversation.participants.filter(id=self.user.id).exists()
-        except Conversation.DoesNotExist:
-            return False
-    
-    @database_sync_to_async
-    def save_message(self, content):
-        """Sauvegarder le message dans la base de données"""
-        try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            message = Message.objects.create(
-                conversation=conversation,
-                sender=self.user,
-                content=content
-            )
-            
-            # Sérialiser le message
-            serializer = MessageSerializer(message)
-            return serializer.data
-        except Exception as e:
-            print(f"Erreur lors de la sauvegarde du message: {e}")
-            return None
+    async def presence_update(self, event):
+        """Envoyer le passage en ligne ou hors ligne d'un participant"""
+        if event['user_id'] != self.user.id:
+            await self.send_json({
+                'type': 'presence',
+                'conversation_id': event['conversation_id'],
+                'user_id': event['user_id'],
+                'online': event['online']
+            })
     
-    @database_sync_to_async
-    def mark_messages_read(self):
-        """Marquer tous les messages de la conversation comme lus"""
-        try:
-            Message.objects.filter(
-                conversation_id=self.conversation_id,
-                is_read=False
-            ).exclude(sender=self.user).update(is_read=True)
-        except Exception as e:
-            print(f"Erreur lors du marquage des messages: {e}")
+    async def inbox_update(self, event):
+        """Nouveau message dans une conversation non abonnée (liste des conversations)"""
+        if event['conversation_id'] not in self.subscriptions:
+            await self.send_json(event)
+    
+    async def receipt_update(self, event):
+        """Accusé de réception ou de lecture des messages de l'utilisateur"""
+        await self.send_json({
+            'type': 'receipt',
+            'conversation_id': event['conversation_id'],
+            'user_id': event['user_id'],
+            'delivered_up_to': event['delivered_up_to'],
+            'read_up_to': event['read_up_to']
+        })
+    
+    async def heartbeat(self):
+        """Rafraîchit la présence de l'utilisateur tant que le socket est ouvert"""
+        while True:
+            await asyncio.sleep(settings.MESSAGING_PRESENCE_HEARTBEAT)
+            try:
+                await presence.heartbeat(self.user.id)
+            except Exception as e:
+                print(f"Erreur lors du battement de présence: {e}")
+    
+    async def send_json(self, content):
+        await self.send(text_data=json.dumps(content))
+    
+    async def send_error(self, message):
+        await self.send_json({'type': 'error', 'message': message})
+
+
+class ChatConsumer(MessagingConsumer):
+    """
+    Ancienne route ws/chat/<conversation_id>/, conservée pour compatibilité
+    
+    Un socket abonné d'office à la conversation de l'URL (refusé si
+    l'utilisateur n'en fait pas partie) ; les trames sans conversation_id
+    la visent. Les nouveaux clients utilisent ws/messaging/.
+    """
+    
+    async def before_accept(self):
+        self.conversation_id = int(self.scope['url_route']['kwargs']['conversation_id'])
+        return bool(await self.participant_conversations([self.conversation_id]))
+    
+    async def after_accept(self):
+        await self.subscribe(self.conversation_id)
+        await self.send_json({
+            'type': 'connection_established',
+            'message': 'Connecté à la conversation'
+        })
+    
+    def target_conversation(self, data):
+        if data.get('conversation_id') is None:
+            return self.conversation_id
+        return super().target_conversation(data)
+    
+    async def inbox_update(self, event):
+        # Les anciens clients ne suivent que leur conversation
+        pass
+    
+    async def receipt_update(self, event):
+        if event['conversation_id'] == self.conversation_id:
+            await super().receipt_update(event)
+
 
-User = get_user_model()
\ No newline at end of file
+User = get_user_model()
@@ -0,0 +1,175 @@
+"""
+Envoi idempotent et accusés de réception
+
+Le client génère un identifiant (UUID) pour chaque message qu'il envoie,
+par le WebSocket (trame chat_message) ou par l'API (send_message). Un
+renvoi après une coupure porte le même client_id : la contrainte
+message_unique_client_id (expéditeur, client_id) garantit qu'il n'insère
+rien, et le message déjà enregistré est renvoyé au client. Un client_id
+déjà utilisé dans une autre conversation est refusé (DeliveryError).
+
+Les accusés sont groupés : une trame
+
+    {"type": "ack", "conversation_id": ..., "delivered": [ids], "read": [ids]}
+
+acquitte autant de messages que nécessaire. Les messages d'une conversation
+arrivent dans l'ordre : seul le plus grand id acquitté compte, et chaque
+accusé avance un curseur du ReadCursor du destinataire
+(last_delivered_message_id, last_read_message_id), jamais en arrière. Un
+message lu est aussi reçu. L'expéditeur des messages acquittés reçoit un
+seul événement receipt par trame avec les nouvelles positions.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Q
+from .models import Message, ReadCursor
+from .read_state import mark_read_up_to
+
+
+class DeliveryError(Exception):
+    """Message refusé (message destiné au client)"""
+
+
+def _conversation_id(fields):
+    conversation = fields.get('conversation')
+    return conversation.pk if conversation is not None else fields.get('conversation_id')
+
+
+def _replay(existing, conversation_id):
+    """Message déjà envoyé avec ce client_id, s'il appartient bien à la même conversation"""
+    if existing.conversation_id != conversation_id:
+        raise DeliveryError("client_id déjà utilisé dans une autre conversation")
+    return existing, False
+
+
+def send_message(sender, client_id=None, **fields):
+    """
+    Crée un message, ou retrouve celui déjà envoyé avec le même client_id
+
+    Args:
+        sender: Expéditeur
+        client_id: UUID généré par le client (optionnel)
+        **fields: Autres champs du message (conversation, content, attachment...)
+
+    Returns:
+        tuple: (Message, created)
+
+    Raises:
+        DeliveryError: client_id déjà utilisé par l'expéditeur dans une autre conversation
+    """
+    conversation_id = _conversation_id(fields)
+    if client_id is not None:
+        existing = Message.objects.filter(sender=sender, client_id=client_id).first()
+        if existing is not None:
+            return _replay(existing, conversation_id)
+
+    try:
+        with transaction.atomic():
+            return Message.objects.create(sender=sender, client_id=client_id, **fields), True
+    except IntegrityError:
+        # Renvoi concurrent : l'autre requête a inséré le message
+        if client_id is None:
+            raise
+        return _replay(Message.objects.get(sender=sender, client_id=client_id), conversation_id)
+
+
+async def asend_message(sender, client_id=None, **fields):
+    """Version asynchrone de send_message"""
+    conversation_id = _conversation_id(fields)
+    if client_id is not None:
+        existing = await Message.objects.filter(sender=sender, client_id=client_id).afirst()
+        if existing is not None:
+            return _replay(existing, conversation_id)
+
+    try:
+        return await Message.objects.acreate(sender=sender, client_id=client_id, **fields), True
+    except IntegrityError:
+        if client_id is None:
+            raise
+        return _replay(await Message.objects.aget(sender=sender, client_id=client_id), conversation_id)
+
+
+def _message_ids(values):
+    ids = set()
+    for value in (values or [])[:settings.MESSAGING_ACK_MAX_IDS]:
+        try:
+            ids.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return ids
+
+
+def acknowledge(conversation_id, user_id, delivered=(), read=()):
+    """
+    Enregistre un accusé groupé de réception et de lecture
+
+    Les ids qui ne désignent pas un message de la conversation envoyé par
+    un autre participant sont ignorés. Le nombre de requêtes ne dépend pas
+    du nombre d'ids acquittés.
+
+    Args:
+        delivered: Ids des messages reçus
+        read: Ids des messages lus
+
+    Returns:
+        dict: conversation_id, user_id, delivered_up_to, read_up_to et
+        sender_ids (destinataires de l'accusé), ou None si aucun curseur
+        n'a avancé
+    """
+    delivered_ids, read_ids = _message_ids(delivered), _message_ids(read)
+    if not delivered_ids and not read_ids:
+        return None
+
+    acknowledged = dict(
+        Message.objects.filter(
+            conversation_id=conversation_id, id__in=delivered_ids | read_ids
+        ).exclude(sender_id=user_id).values_list('id', 'sender_id')
+    )
+    if not acknowledged:
+        return None
+
+    cursors = ReadCursor.objects.filter(conversation_id=conversation_id, user_id=user_id)
+    advanced = False
+
+    read_up_to = max(read_ids & acknowledged.keys(), default=None)
+    if read_up_to is not None:
+        advanced = mark_read_up_to(conversation_id, user_id, read_up_to)
+
+    delivered_up_to = max(acknowledged)
+    advanced = cursors.filter(
+        Q(last_delivered_message_id__isnull=True) | Q(last_delivered_message_id__lt=delivered_up_to)
+    ).update(last_delivered_message_id=delivered_up_to) > 0 or advanced
+
+    if not advanced:
+        return None
+
+    positions = cursors.values('last_delivered_message_id', 'last_read_message_id').first()
+    return {
+        'conversation_id': conversation_id,
+        'user_id': user_id,
+        'delivered_up_to': positions['last_delivered_message_id'],
+        'read_up_to': positions['last_read_message_id'],
+        'sender_ids': sorted(set(acknowledged.values())),
+    }
+
+
+def delivery_status(message):
+    """
+    Statut d'un message d'après les curseurs des autres participants
+
+    Returns:
+        str: 'sent', 'delivered' ou 'read'
+    """
+    positions = ReadCursor.objects.filter(
+        conversation_id=message.conversation_id
+    ).exclude(user_id=message.sender_id).aggregate(
+        read=Max('last_read_message_id'),
+        delivered=Max('last_delivered_message_id'),
+    )
+
+    if (positions['read'] or 0) >= message.id:
+        return 'read'
+    if (positions['delivered'] or 0) >= message.id:
+        return 'delivered'
+    return 'sent'
@@ -0,0 +1,224 @@
+"""
+Regroupement des notifications email de la messagerie
+
+Au lieu d'un email par message et par destinataire, les notifications sont
+mises en attente par destinataire dans le cache (Redis en production) puis
+envoyées sous forme de résumé :
+
+- après MESSAGE_DIGEST_QUIET_SECONDS sans nouveau message pour ce
+  destinataire, ou dès que MESSAGE_DIGEST_BATCH_SIZE notifications attendent
+- en un seul appel send_mass_mail (une connexion SMTP) pour tous les
+  destinataires dus au même moment
+- jamais aux destinataires connectés à un WebSocket de messagerie, qui
+  voient déjà les messages en direct
+
+Les files n'utilisent que des opérations atomiques du cache (add, incr,
+get_many) : chaque élément est une clé numérotée par un compteur, et un
+pointeur retient le dernier élément envoyé. Le pointeur n'avance que sur les
+éléments effectivement lus, l'index étant attribué avant l'écriture.
+
+Les destinataires en attente sont rangés dans des tranches de temps de la
+durée de la fenêtre ; le premier ajout dans une tranche planifie la tâche
+send_message_digests qui traitera toute la tranche.
+"""
+
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import send_mass_mail
+from .presence import online_user_ids
+
+logger = logging.getLogger('messaging')
+
+QUEUE_KEY = 'messaging:digest:{}'
+SCHEDULED_KEY = 'messaging:digest:{}:scheduled'
+LAST_KEY = 'messaging:digest:{}:last'
+SENT_KEY = 'messaging:digest:{}:sent'
+GAP_KEY = 'messaging:digest:{}:gap'
+LOCK_KEY = 'messaging:digest:{}:lock'
+BUCKET_KEY = 'messaging:digest:bucket:{}'
+
+
+def _append(key, value, timeout):
+    """Ajoute value à la liste stockée sous key et retourne son index (à partir de 1)"""
+    cache.add(f'{key}:n', 0, timeout)
+    try:
+        index = cache.incr(f'{key}:n')
+    except ValueError:
+        # Compteur expiré entre add et incr
+        cache.set(f'{key}:n', 1, timeout)
+        index = 1
+    cache.touch(f'{key}:n', timeout)
+    cache.set(f'{key}:{index}', value, timeout)
+    return index
+
+
+def _read(key, start, end):
+    """Lit les éléments start..end (inclus) d'une liste du cache, dans l'ordre"""
+    keys = [f'{key}:{index}' for index in range(start, end + 1)]
+    values = cache.get_many(keys)
+    return [values[k] for k in keys if k in values]
+
+
+def _schedule(recipient_id, now):
+    """Range le destinataire dans la tranche courante et planifie son traitement"""
+    from .tasks import send_message_digests
+
+    quiet = settings.MESSAGE_DIGEST_QUIET_SECONDS
+    bucket = int(now // quiet)
+    key = BUCKET_KEY.format(bucket)
+
+    if _append(key, recipient_id, settings.MESSAGE_DIGEST_TTL) == 1:
+        # Premier de la tranche : le traitement a lieu une fenêtre après la fin de la tranche
+        countdown = (bucket + 2) * quiet - now
+        send_message_digests.apply_async(kwargs={'bucket': bucket}, countdown=countdown)
+
+
+def queue_notification(recipient, message):
+    """
+    Met en attente la notification d'un message pour un destinataire
+
+    Args:
+        recipient: Utilisateur à notifier
+        message: Message chargé avec son expéditeur
+    """
+    from .tasks import send_message_digests
+
+    if not recipient.email:
+        return
+
+    now = time.time()
+    timeout = settings.MESSAGE_DIGEST_TTL
+    queue = QUEUE_KEY.format(recipient.id)
+
+    index = _append(queue, {
+        'email': recipient.email,
+        'sender': message.sender.username,
+        'conversation_id': message.conversation_id,
+        'content': message.content[:100],
+    }, timeout)
+    cache.set(LAST_KEY.format(recipient.id), now, timeout)
+
+    if cache.add(SCHEDULED_KEY.format(recipient.id), True, timeout):
+        _schedule(recipient.id, now)
+
+    pending = index - (cache.get(SENT_KEY.format(recipient.id)) or 0)
+    if pending == settings.MESSAGE_DIGEST_BATCH_SIZE:
+        send_message_digests.delay(recipient_ids=[recipient.id], force=True)
+
+
+def _take_pending(recipient_id):
+    """
+    Retire et retourne les notifications en attente d'un destinataire
+
+    _append attribue l'index (incr) avant d'écrire l'élément : un élément
+    absent peut être en cours d'écriture, et son auteur replanifie alors le
+    destinataire. Le pointeur s'arrête donc avant le premier élément absent ;
+    un élément encore absent au passage suivant a expiré et est sauté.
+    """
+    queue = QUEUE_KEY.format(recipient_id)
+    sent = cache.get(SENT_KEY.format(recipient_id)) or 0
+    total = cache.get(f'{queue}:n') or 0
+
+    if total < sent:
+        # Compteur expiré et recréé depuis le dernier envoi
+        sent = 0
+    if total == sent:
+        return []
+
+    keys = [f'{queue}:{index}' for index in range(sent + 1, total + 1)]
+    values = cache.get_many(keys)
+    gap = cache.get(GAP_KEY.format(recipient_id))
+
+    items = []
+    read_up_to = sent
+    for index, key in enumerate(keys, start=sent + 1):
+        if key in values:
+            items.append(values[key])
+        elif index == gap:
+            cache.delete(GAP_KEY.format(recipient_id))
+        else:
+            cache.set(GAP_KEY.format(recipient_id), index, settings.MESSAGE_DIGEST_TTL)
+            break
+        read_up_to = index
+
+    cache.set(SENT_KEY.format(recipient_id), read_up_to, settings.MESSAGE_DIGEST_TTL)
+    cache.delete_many(keys[:read_up_to - sent])
+    return items
+
+
+def build_digest(items):
+    """Construit (sujet, corps) du résumé pour une liste de notifications"""
+    senders = sorted({item['sender'] for item in items})
+
+    if len(items) == 1:
+        subject = f"Nouveau message de {items[0]['sender']}"
+    else:
+        subject = f"{len(items)} nouveaux messages de {', '.join(senders)}"
+
+    lines = [f"{item['sender']}: {item['content']}" for item in items]
+    return subject, 'Vous avez reçu de nouveaux messages:\n\n' + '\n'.join(lines)
+
+
+def bucket_recipients(bucket):
+    """Destinataires rangés dans une tranche de temps"""
+    key = BUCKET_KEY.format(bucket)
+    total = cache.get(f'{key}:n') or 0
+    return list(dict.fromkeys(_read(key, 1, total)))
+
+
+def send_digests(recipient_ids, force=False):
+    """
+    Envoie les résumés dus parmi recipient_ids
+
+    Les destinataires qui ont encore reçu un message dans la fenêtre sont
+    replanifiés, sauf si force (taille de lot atteinte).
+
+    Returns:
+        dict: Nombre de résumés envoyés, ignorés (en ligne) et replanifiés
+    """
+    now = time.time()
+    quiet = settings.MESSAGE_DIGEST_QUIET_SECONDS
+    summary = {'sent': 0, 'skipped_online': 0, 'rescheduled': 0}
+
+    online = online_user_ids(recipient_ids)
+    last_seen = cache.get_many([LAST_KEY.format(recipient_id) for recipient_id in recipient_ids])
+    datatuple = []
+
+    for recipient_id in recipient_ids:
+        last = last_seen.get(LAST_KEY.format(recipient_id))
+
+        if not force and last is not None and now - last < quiet:
+            _schedule(recipient_id, now)
+            summary['rescheduled'] += 1
+            continue
+
+        if not cache.add(LOCK_KEY.format(recipient_id), True, 60):
+            continue
+
+        try:
+            # Libérer la planification d'abord : un message arrivé pendant la lecture
+            # est soit lu ici, soit replanifié par queue_notification
+            cache.delete(SCHEDULED_KEY.format(recipient_id))
+            items = _take_pending(recipient_id)
+        finally:
+            cache.delete(LOCK_KEY.format(recipient_id))
+
+        if not items:
+            continue
+
+        if recipient_id in online:
+            summary['skipped_online'] += 1
+            continue
+
+        subject, body = build_digest(items)
+        datatuple.append((subject, body, settings.DEFAULT_FROM_EMAIL, [items[-1]['email']]))
+
+    if datatuple:
+        try:
+            summary['sent'] = send_mass_mail(datatuple, fail_silently=True)
+        except Exception as e:
+            logger.error(f"Erreur d'envoi des résumés email: {e}")
+
+    return summary
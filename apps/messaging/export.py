@@ -0,0 +1,138 @@
+"""
+Export d'une conversation en JSON, en flux
+
+Le document produit a la forme de export_conversation_to_json :
+
+    {"conversation_id": ..., "participants": [...], "created_at": ...,
+     "messages": [{"id", "sender", "content", "is_read", "created_at"}, ...]}
+
+mais n'est jamais construit en mémoire : les messages sont lus par
+iterator(chunk_size) avec leur expéditeur (select_related, pas de requête
+par message) et chaque message est encodé et écrit dès sa lecture. La
+mémoire utilisée est bornée par un lot de MESSAGE_EXPORT_CHUNK_SIZE
+messages, quelle que soit la taille de la conversation.
+
+L'archive écrite avant la suppression d'une conversation (signal
+pre_delete) passe par un fichier temporaire compressé avant d'être
+enregistrée dans le stockage de fichiers (S3 en production) :
+
+    <MESSAGE_ARCHIVE_PREFIX>/conversations/<id>-<horodatage>.json.gz
+"""
+
+import gzip
+import io
+import json
+import tempfile
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from .read_state import read_by_recipients, read_positions
+
+# Au-delà, le fichier temporaire de l'archive passe de la mémoire au disque
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+def conversation_header(conversation):
+    """Champs de la conversation, sans les messages"""
+    return {
+        'conversation_id': conversation.id,
+        'participants': [
+            {'id': p.id, 'username': p.username, 'email': p.email}
+            for p in conversation.participants.all()
+        ],
+        'created_at': conversation.created_at.isoformat(),
+    }
+
+
+def iter_message_records(conversation, chunk_size=None):
+    """
+    Messages de la conversation dans l'ordre chronologique, lus par lots
+
+    Un message est lu (is_read) quand tous les autres participants l'ont
+    dépassé avec leur curseur de lecture.
+    """
+    positions = read_positions(conversation.id)
+    messages = conversation.messages.select_related('sender').only(
+        'id', 'conversation', 'content', 'created_at', 'sender__username'
+    ).order_by('created_at', 'id')
+
+    for message in messages.iterator(chunk_size=chunk_size or settings.MESSAGE_EXPORT_CHUNK_SIZE):
+        yield {
+            'id': message.id,
+            'sender': message.sender.username,
+            'content': message.content,
+            'is_read': read_by_recipients(message, positions),
+            'created_at': message.created_at.isoformat(),
+        }
+
+
+def iter_conversation_json(conversation, chunk_size=None):
+    """
+    Document JSON de la conversation, morceau par morceau
+
+    Yields:
+        str: Morceaux dont la concaténation est le document JSON
+    """
+    header = json.dumps(conversation_header(conversation), ensure_ascii=False)
+    # En-tête sans son '}' final, suivi du tableau des messages
+    yield header[:-1] + ', "messages": ['
+
+    separator = ''
+    for record in iter_message_records(conversation, chunk_size):
+        yield separator + json.dumps(record, ensure_ascii=False)
+        separator = ', '
+    yield ']}'
+
+
+def write_conversation(conversation, fileobj, compress=False, chunk_size=None):
+    """
+    Écrit le document JSON de la conversation dans un fichier binaire ouvert
+
+    Args:
+        conversation: Objet Conversation
+        fileobj: Fichier ouvert en écriture binaire
+        compress: Compresser en gzip
+        chunk_size: Messages lus par requête (défaut MESSAGE_EXPORT_CHUNK_SIZE)
+    """
+    stream = gzip.GzipFile(fileobj=fileobj, mode='wb') if compress else fileobj
+    writer = io.TextIOWrapper(stream, encoding='utf-8', write_through=True)
+    try:
+        for chunk in iter_conversation_json(conversation, chunk_size):
+            writer.write(chunk)
+        writer.flush()
+    finally:
+        # Détacher pour ne pas fermer fileobj ; fermer le GzipFile écrit sa fin
+        writer.detach()
+        if compress:
+            stream.close()
+
+
+def export_conversation(conversation, path, compress=None, chunk_size=None):
+    """
+    Exporte une conversation dans un fichier
+
+    Args:
+        path: Chemin du fichier ; compressé en gzip par défaut s'il finit par .gz
+    """
+    if compress is None:
+        compress = str(path).endswith('.gz')
+    with open(path, 'wb') as f:
+        write_conversation(conversation, f, compress=compress, chunk_size=chunk_size)
+
+
+def archive_conversation(conversation):
+    """
+    Archive la conversation compressée dans le stockage de fichiers
+
+    Returns:
+        str: Nom du fichier dans le stockage
+    """
+    name = (
+        f'{settings.MESSAGE_ARCHIVE_PREFIX}/conversations/'
+        f'{conversation.id}-{timezone.now():%Y%m%d%H%M%S}.json.gz'
+    )
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as tmp:
+        write_conversation(conversation, tmp, compress=True)
+        tmp.seek(0)
+        return default_storage.save(name, File(tmp, name=name))
@@ -0,0 +1,103 @@
+"""
+Historique des messages paginé par curseur
+
+Une page est lue par l'index (conversation, created_at, id) à partir d'un
+message de référence : `before` pour remonter dans le passé, `after` pour
+récupérer ce qui a suivi (rattrapage d'un client reconnecté). Le coût d'une
+page ne dépend pas de la longueur de la conversation, contrairement à un
+OFFSET ou au chargement de tout l'historique.
+
+Les messages d'une page sont toujours retournés du plus ancien au plus récent.
+"""
+
+from collections import namedtuple
+from django.conf import settings
+from django.db.models import Q
+from .models import Message
+
+HistoryPage = namedtuple('HistoryPage', ['messages', 'has_more'])
+
+
+def clamp_limit(limit):
+    """Taille de page demandée, bornée à MESSAGE_HISTORY_MAX_PAGE_SIZE"""
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return settings.MESSAGE_HISTORY_PAGE_SIZE
+    return max(1, min(limit, settings.MESSAGE_HISTORY_MAX_PAGE_SIZE))
+
+
+def _page_queryset(conversation_id, reference, cursor, backwards):
+    """
+    Messages strictement avant (ou après) le message de référence, dans l'ordre de l'index
+
+    cursor est le tuple (created_at, id) du message de référence. S'il a été
+    supprimé, la comparaison se fait sur l'id seul.
+    """
+    messages = Message.objects.filter(conversation_id=conversation_id).select_related('sender')
+
+    if cursor is not None:
+        created_at, message_id = cursor
+        if backwards:
+            messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+        else:
+            messages = messages.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id))
+    elif reference is not None:
+        messages = messages.filter(id__lt=reference) if backwards else messages.filter(id__gt=reference)
+
+    if backwards:
+        return messages.order_by('-created_at', '-id')
+    return messages.order_by('created_at', 'id')
+
+
+def _cursor_queryset(conversation_id, message_id):
+    return Message.objects.filter(conversation_id=conversation_id, id=message_id).values_list('created_at', 'id')
+
+
+def _direction(before, after):
+    """(message de référence, sens) ; before l'emporte si les deux sont fournis"""
+    if before is None and after is not None:
+        return after, False
+    return before, True
+
+
+def _build_page(rows, limit, backwards):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    return HistoryPage(rows, has_more)
+
+
+def page(conversation_id, before=None, after=None, limit=None):
+    """
+    Une page d'historique
+
+    Sans curseur, retourne les derniers messages.
+
+    Args:
+        conversation_id: ID de la conversation
+        before: ID du message au-dessus duquel remonter
+        after: ID du dernier message déjà reçu
+        limit: Taille de page
+
+    Returns:
+        HistoryPage: messages (du plus ancien au plus récent) et has_more, vrai
+        s'il reste des messages dans le sens de la pagination
+    """
+    limit = clamp_limit(limit)
+    reference, backwards = _direction(before, after)
+    cursor = _cursor_queryset(conversation_id, reference).first() if reference is not None else None
+
+    rows = list(_page_queryset(conversation_id, reference, cursor, backwards)[:limit + 1])
+    return _build_page(rows, limit, backwards)
+
+
+async def apage(conversation_id, before=None, after=None, limit=None):
+    """Version asynchrone de page, pour les consumers"""
+    limit = clamp_limit(limit)
+    reference, backwards = _direction(before, after)
+    cursor = await _cursor_queryset(conversation_id, reference).afirst() if reference is not None else None
+
+    rows = [m async for m in _page_queryset(conversation_id, reference, cursor, backwards)[:limit + 1]]
+    return _build_page(rows, limit, backwards)
@@ -0,0 +1,238 @@
+"""
+Banc de charge du chemin WebSocket de la messagerie
+
+Un worker ASGI est simulé dans le processus, sur le channel layer en
+mémoire : N sockets (WebsocketCommunicator sur ws/messaging/) répartis sur
+M conversations à deux, chaque socket abonné à sa conversation (plusieurs
+sockets par participant, comme plusieurs appareils). À chaque tour, un
+participant de chaque conversation envoie une trame typing puis un
+message ; le tour se termine quand tous les sockets de chaque conversation
+ont reçu le message. Sont mesurés :
+
+- la latence de diffusion de bout en bout, de l'envoi de la trame à sa
+  réception par chaque socket de la conversation (p50 et p99) ;
+- les requêtes SQL par message sur la connexion du worker, pendant le
+  trafic seulement (connexions et abonnements exclus) ;
+- le débit en messages par seconde.
+
+Les résultats de référence sont enregistrés dans loadtest_baseline.json,
+un par base de données et par scénario ; la commande benchmark_chat_load
+les compare à chaque mesure pour rendre les régressions visibles.
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from collections import namedtuple
+from pathlib import Path
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import override_settings
+from .models import Conversation
+
+BASELINE_PATH = Path(__file__).with_name('loadtest_baseline.json')
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# Écart toléré sur les latences avant de signaler une régression (+50 %)
+LATENCY_TOLERANCE = 0.5
+
+LoadReport = namedtuple('LoadReport', [
+    'sockets', 'conversations', 'messages', 'deliveries', 'elapsed',
+    'p50_ms', 'p99_ms', 'queries_per_message', 'messages_per_second',
+])
+
+
+class QueryCounter:
+    """Compte les requêtes d'une connexion (connection.execute_wrapper), sans limite de journal"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, fraction):
+    """Percentile par rang le plus proche d'une liste non vide"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def scenario_key(report):
+    return f'{connection.vendor}:{report.sockets}x{report.conversations}'
+
+
+def load_baseline(path=BASELINE_PATH):
+    path = Path(path)
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def save_baseline(report, path=BASELINE_PATH):
+    """Enregistre report comme référence de son scénario"""
+    baselines = load_baseline(path)
+    baselines[scenario_key(report)] = {
+        'p50_ms': round(report.p50_ms, 2),
+        'p99_ms': round(report.p99_ms, 2),
+        'queries_per_message': round(report.queries_per_message, 2),
+        'messages_per_second': round(report.messages_per_second),
+    }
+    Path(path).write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+
+def regressions(report, baseline, tolerance=LATENCY_TOLERANCE):
+    """
+    Écarts de report par rapport à la référence de son scénario
+
+    Les requêtes par message ne doivent pas augmenter ; les latences,
+    bruitées, peuvent dépasser la référence de tolerance.
+
+    Returns:
+        list: Descriptions des régressions (vide si aucune)
+    """
+    found = []
+    if report.queries_per_message > baseline['queries_per_message'] + 0.01:
+        found.append(
+            f"requêtes par message : {report.queries_per_message:.2f} "
+            f"(référence {baseline['queries_per_message']:.2f})"
+        )
+    for name in ('p50_ms', 'p99_ms'):
+        if getattr(report, name) > baseline[name] * (1 + tolerance):
+            found.append(f"latence {name[:3]} : {getattr(report, name):.1f} ms (référence {baseline[name]:.1f} ms)")
+    return found
+
+
+async def _receive(communicator, content):
+    """Attend la diffusion du message content, en ignorant les autres trames"""
+    while True:
+        data = json.loads(await communicator.receive_from(timeout=10))
+        if data.get('type') == 'chat_message' and data['message']['content'] == content:
+            return time.perf_counter()
+
+
+async def _connect(application, user, conversation_id):
+    communicator = WebsocketCommunicator(application, '/ws/messaging/')
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    if not connected:
+        raise RuntimeError(f"Connexion refusée pour {user.username}")
+    await communicator.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation_id': conversation_id}))
+    while json.loads(await communicator.receive_from(timeout=10)).get('type') != 'subscribed':
+        pass
+    return communicator
+
+
+async def _drive(rooms, rounds, typing, queries):
+    """
+    Connecte les sockets puis joue les tours de trafic
+
+    Args:
+        rooms: Liste de (conversation, [participants des sockets])
+        queries: QueryCounter installé sur la connexion du worker
+
+    Returns:
+        tuple: (latences en secondes, durée du trafic, requêtes pendant le trafic)
+    """
+    from pimarket.asgi import application
+
+    sockets = []
+    try:
+        for conversation, users in rooms:
+            sockets.append([await _connect(application, user, conversation.id) for user in users])
+
+        latencies = []
+        first_query = queries.count
+        started = time.perf_counter()
+
+        for turn in range(rounds):
+            sent = []
+            for (conversation, _), communicators in zip(rooms, sockets):
+                sender = communicators[turn % len(communicators)]
+                content = f'charge {conversation.id}:{turn}'
+                if typing:
+                    await sender.send_to(text_data=json.dumps({
+                        'type': 'typing', 'conversation_id': conversation.id, 'is_typing': True
+                    }))
+                sent_at = time.perf_counter()
+                await sender.send_to(text_data=json.dumps({
+                    'type': 'chat_message', 'conversation_id': conversation.id, 'message': content
+                }))
+                sent.append((content, sent_at, communicators))
+
+            received = await asyncio.gather(*(
+                _receive(communicator, content)
+                for content, _, communicators in sent
+                for communicator in communicators
+            ))
+            sent_times = [sent_at for _, sent_at, communicators in sent for _ in communicators]
+            latencies.extend(at - sent_at for at, sent_at in zip(received, sent_times))
+
+        return latencies, time.perf_counter() - started, queries.count - first_query
+    finally:
+        for communicator in (c for communicators in sockets for c in communicators):
+            await communicator.disconnect()
+
+
+def _seed(conversations, sockets_per_conversation, suffix):
+    User = get_user_model()
+    rooms = []
+    for n in range(conversations):
+        low, high = (
+            User.objects.create(username=f'load_{suffix}_{n}_{side}', phone_number=f'+1996{suffix:06d}{n:04d}{side}')
+            for side in (0, 1)
+        )
+        conversation = Conversation.objects.create()
+        conversation.participants.add(low, high)
+        rooms.append((conversation, [(low, high)[k % 2] for k in range(sockets_per_conversation)]))
+    return rooms
+
+
+def run_load(sockets=200, conversations=50, rounds=20, typing=True, in_memory_layer=True):
+    """
+    Joue le scénario de charge et mesure le chemin WebSocket
+
+    Les utilisateurs et conversations créés sont supprimés à la fin.
+
+    Args:
+        sockets: Nombre total de sockets (au moins deux par conversation)
+        conversations: Nombre de conversations à deux
+        rounds: Messages envoyés par conversation
+        typing: Envoyer une trame typing avant chaque message
+        in_memory_layer: Utiliser InMemoryChannelLayer plutôt que le channel layer configuré
+
+    Returns:
+        LoadReport
+    """
+    per_conversation = max(2, sockets // conversations)
+    rooms = _seed(conversations, per_conversation, uuid.uuid4().int % 10 ** 6)
+
+    # Mesurer le consumer lui-même, sans la limite de trames par socket
+    overrides = {'MESSAGING_SOCKET_RATE': 1e9, 'MESSAGING_SOCKET_BURST': 10 ** 9}
+    if in_memory_layer:
+        overrides['CHANNEL_LAYERS'] = IN_MEMORY_LAYER
+
+    queries = QueryCounter()
+    try:
+        # Le consumer tourne dans ce thread (async_to_sync) : ses requêtes passent par cette connexion
+        with override_settings(**overrides), connection.execute_wrapper(queries):
+            latencies, elapsed, query_count = async_to_sync(_drive)(rooms, rounds, typing, queries)
+    finally:
+        Conversation.objects.filter(id__in=[conversation.id for conversation, _ in rooms]).delete()
+        get_user_model().objects.filter(id__in={user.id for _, users in rooms for user in users}).delete()
+
+    messages = conversations * rounds
+    return LoadReport(
+        sockets=conversations * per_conversation,
+        conversations=conversations,
+        messages=messages,
+        deliveries=len(latencies),
+        elapsed=elapsed,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        queries_per_message=query_count / messages,
+        messages_per_second=messages / elapsed if elapsed else 0,
+    )
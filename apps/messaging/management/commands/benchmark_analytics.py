@@ -0,0 +1,152 @@
+"""
+Commande de mesure des statistiques de messagerie
+
+Usage: python manage.py benchmark_analytics [--messages 10000] [--contacts 200]
+
+Compare les requêtes ensemblistes d'analytics.py aux anciennes boucles
+Python (une requête par conversation, tous les messages chargés) pour un
+utilisateur qui a --messages messages répartis sur --contacts conversations.
+Le jeu de données est créé dans une transaction annulée à la fin de la
+mesure : la base n'est pas modifiée.
+
+Location: apps/messaging/management/commands/benchmark_analytics.py
+"""
+
+import random
+import time
+import uuid
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from apps.messaging import analytics
+from apps.messaging.models import Conversation, Message
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    """Annule la transaction du jeu de données"""
+
+
+def legacy_popular_contacts(user, limit=10):
+    """Ancienne implémentation : deux requêtes par conversation"""
+    contact_counts = {}
+    for conv in Conversation.objects.filter(participants=user):
+        message_count = conv.messages.count()
+        for participant in conv.participants.exclude(id=user.id):
+            contact_counts.setdefault(participant.id, {'user': participant, 'count': 0})
+            contact_counts[participant.id]['count'] += message_count
+
+    ranked = sorted(contact_counts.values(), key=lambda x: x['count'], reverse=True)[:limit]
+    return [(c['user'], c['count']) for c in ranked]
+
+
+def legacy_average_response_time(user):
+    """Ancienne implémentation : tous les messages de toutes les conversations en Python"""
+    total_time = timedelta()
+    response_count = 0
+    for conv in Conversation.objects.filter(participants=user):
+        messages = list(conv.messages.order_by('created_at'))
+        for previous, current in zip(messages, messages[1:]):
+            if current.sender == user and previous.sender != user:
+                total_time += current.created_at - previous.created_at
+                response_count += 1
+    return total_time / response_count if response_count else None
+
+
+class Command(BaseCommand):
+    help = "Compare les statistiques de messagerie en SQL ensembliste aux anciennes boucles Python"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000, help="Nombre de messages de l'utilisateur mesuré")
+        parser.add_argument('--contacts', type=int, default=200, help='Nombre de conversations')
+        parser.add_argument('--repeat', type=int, default=5, help='Nombre de mesures par implémentation')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            self.stdout.write('Jeu de données annulé')
+
+    def run(self, options):
+        rng = random.Random(options['seed'])
+        started = time.perf_counter()
+        user = self.seed(rng, options)
+        self.stdout.write(
+            f"Base: {connection.vendor}, {options['messages']} messages sur {options['contacts']} "
+            f"conversations seedés en {time.perf_counter() - started:.1f}s"
+        )
+
+        results = {}
+        for label, legacy, current in (
+            ('Contacts fréquents', lambda: legacy_popular_contacts(user), lambda: analytics.popular_contacts(user.id)),
+            ('Temps de réponse', lambda: legacy_average_response_time(user),
+             lambda: analytics.average_response_time(user.id)),
+        ):
+            results[label] = (self.measure(legacy, options['repeat']), self.measure(current, options['repeat']))
+
+        self.stdout.write(
+            f"Statistiques globales: {self.measure(lambda: analytics.compute_user_stats(user.id), 1)[1]} requêtes"
+        )
+        for label, ((legacy_time, legacy_queries), (current_time, current_queries)) in results.items():
+            self.stdout.write(
+                f"{label}: boucles {legacy_time * 1000:.1f} ms / {legacy_queries} requêtes, "
+                f"SQL {current_time * 1000:.1f} ms / {current_queries} requêtes "
+                f"(x{legacy_time / current_time:.1f})"
+            )
+
+        legacy_delay, current_delay = legacy_average_response_time(user), analytics.average_response_time(user.id)
+        self.stdout.write(self.style.SUCCESS(f'✓ Temps de réponse moyen: {legacy_delay} / {current_delay}'))
+
+    def measure(self, func, repeat):
+        """Meilleur temps sur repeat exécutions, et nombre de requêtes d'une exécution"""
+        timings = []
+        for _ in range(repeat):
+            # Le journal des requêtes est borné : le vider pour compter juste
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - started)
+        return min(timings), len(queries)
+
+    def seed(self, rng, options):
+        """Un utilisateur, ses conversations à deux et leurs messages, par bulk_create (sans signaux)"""
+        suffix = uuid.uuid4().int % 10 ** 6
+        users = User.objects.bulk_create([
+            User(username=f'bench_stats_{suffix}_{n}', phone_number=f'+1997{suffix:06d}{n:05d}')
+            for n in range(options['contacts'] + 1)
+        ])
+        if not users[0].pk:
+            users = list(User.objects.filter(username__startswith=f'bench_stats_{suffix}_').order_by('id'))
+        user, contacts = users[0], users[1:]
+
+        conversations = Conversation.objects.bulk_create([
+            Conversation(user_low=low, user_high=high)
+            for low, high in (sorted((user, contact), key=lambda u: u.id) for contact in contacts)
+        ])
+        if not conversations[0].pk:
+            conversations = list(analytics.user_conversations(user.id))
+
+        Through = Conversation.participants.through
+        Through.objects.bulk_create([
+            Through(conversation_id=conversation.id, user_id=user_id)
+            for conversation in conversations
+            for user_id in (conversation.user_low_id, conversation.user_high_id)
+        ])
+
+        Message.objects.bulk_create([
+            Message(
+                conversation_id=conversation.id,
+                sender_id=rng.choice((conversation.user_low_id, conversation.user_high_id)),
+                content=f'message {n}',
+            )
+            for n, conversation in ((n, rng.choice(conversations)) for n in range(options['messages']))
+        ], batch_size=5000)
+
+        return user
@@ -0,0 +1,95 @@
+"""
+Commande de mesure du débit du ChatConsumer
+
+Usage: python manage.py benchmark_chat [--messages 1000] [--window 50] [--in-memory-layer]
+
+Location: apps/messaging/management/commands/benchmark_chat.py
+"""
+
+import json
+import time
+import uuid
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from apps.messaging.models import Conversation
+
+User = get_user_model()
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+class Command(BaseCommand):
+    help = "Mesure les messages/seconde traités par un worker ChatConsumer (deux participants connectés)"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help='Nombre de messages à envoyer')
+        parser.add_argument(
+            '--window',
+            type=int,
+            default=50,
+            help='Messages envoyés avant de vider les réponses (reste sous la capacité du channel layer)'
+        )
+        parser.add_argument(
+            '--in-memory-layer',
+            action='store_true',
+            help='Utiliser InMemoryChannelLayer au lieu du channel layer configuré'
+        )
+    
+    def handle(self, *args, **options):
+        # Mesurer le consumer lui-même, sans la limite de trames par socket
+        overrides = {'MESSAGING_SOCKET_RATE': 1e9, 'MESSAGING_SOCKET_BURST': 10 ** 9}
+        if options['in_memory_layer']:
+            overrides['CHANNEL_LAYERS'] = IN_MEMORY_LAYER
+        
+        with override_settings(**overrides):
+            elapsed = async_to_sync(self.run)(options['messages'], options['window'])
+        
+        rate = options['messages'] / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"✓ {options['messages']} messages en {elapsed:.2f}s : {rate:.0f} messages/s"
+        ))
+    
+    async def run(self, count, window):
+        from pimarket.asgi import application
+        
+        suffix = uuid.uuid4().int % 10 ** 8
+        sender = await User.objects.acreate(username='bench_sender', phone_number=f'+1990{suffix:08d}')
+        recipient = await User.objects.acreate(username='bench_recipient', phone_number=f'+1991{suffix:08d}')
+        conversation = await Conversation.objects.acreate()
+        await conversation.participants.aadd(sender, recipient)
+        
+        communicators = []
+        try:
+            for user in (sender, recipient):
+                communicator = WebsocketCommunicator(application, f'/ws/chat/{conversation.id}/')
+                communicator.scope['user'] = user
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise RuntimeError(f"Connexion refusée pour {user.username}")
+                await communicator.receive_from()  # connection_established
+                communicators.append(communicator)
+            
+            started = time.perf_counter()
+            
+            for offset in range(0, count, window):
+                batch = min(window, count - offset)
+                for n in range(batch):
+                    await communicators[0].send_to(text_data=json.dumps({
+                        'type': 'chat_message',
+                        'message': f'Message de test {offset + n}'
+                    }))
+                # Chaque message est reçu par les deux participants
+                for communicator in communicators:
+                    for _ in range(batch):
+                        await communicator.receive_from(timeout=10)
+            
+            return time.perf_counter() - started
+        
+        finally:
+            for communicator in communicators:
+                await communicator.disconnect()
+            await conversation.adelete()
+            await User.objects.filter(id__in=[sender.id, recipient.id]).adelete()
@@ -0,0 +1,72 @@
+"""
+Commande de charge du chemin WebSocket de la messagerie
+
+Usage: python manage.py benchmark_chat_load [--sockets 200] [--conversations 50] [--rounds 20] [--save-baseline]
+
+Mesure la latence de diffusion (p50/p99) et les requêtes par message d'un
+worker ASGI chargé de --sockets sockets sur --conversations conversations
+(voir apps/messaging/loadtest.py), puis compare le résultat à la référence
+enregistrée pour le même scénario et la même base. La commande échoue en
+cas de régression ; --save-baseline remplace la référence.
+
+Location: apps/messaging/management/commands/benchmark_chat_load.py
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from apps.messaging import loadtest
+
+
+class Command(BaseCommand):
+    help = "Mesure la latence de diffusion et les requêtes par message d'un worker WebSocket chargé"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=200, help='Nombre total de sockets')
+        parser.add_argument('--conversations', type=int, default=50, help='Nombre de conversations')
+        parser.add_argument('--rounds', type=int, default=20, help='Messages envoyés par conversation')
+        parser.add_argument('--no-typing', action='store_true', help="Ne pas envoyer de trames typing")
+        parser.add_argument(
+            '--configured-layer',
+            action='store_true',
+            help='Utiliser le channel layer configuré au lieu de InMemoryChannelLayer'
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=loadtest.LATENCY_TOLERANCE,
+            help='Dépassement de latence toléré par rapport à la référence (0.5 : +50 %%)'
+        )
+        parser.add_argument('--save-baseline', action='store_true', help='Enregistrer ce résultat comme référence')
+
+    def handle(self, *args, **options):
+        report = loadtest.run_load(
+            sockets=options['sockets'],
+            conversations=options['conversations'],
+            rounds=options['rounds'],
+            typing=not options['no_typing'],
+            in_memory_layer=not options['configured_layer'],
+        )
+
+        self.stdout.write(
+            f"{report.sockets} sockets, {report.conversations} conversations : {report.messages} messages, "
+            f"{report.deliveries} réceptions en {report.elapsed:.2f}s ({report.messages_per_second:.0f} messages/s)"
+        )
+        self.stdout.write(
+            f"Latence de diffusion : p50 {report.p50_ms:.1f} ms, p99 {report.p99_ms:.1f} ms ; "
+            f"{report.queries_per_message:.2f} requêtes par message"
+        )
+
+        key = loadtest.scenario_key(report)
+        if options['save_baseline']:
+            loadtest.save_baseline(report)
+            self.stdout.write(self.style.SUCCESS(f'✓ Référence {key} enregistrée'))
+            return
+
+        baseline = loadtest.load_baseline().get(key)
+        if baseline is None:
+            self.stdout.write(f'Aucune référence pour {key} (--save-baseline pour en enregistrer une)')
+            return
+
+        found = loadtest.regressions(report, baseline, options['tolerance'])
+        if found:
+            raise CommandError(f'Régression par rapport à la référence {key} : ' + ' ; '.join(found))
+        self.stdout.write(self.style.SUCCESS(f'✓ Conforme à la référence {key}'))
@@ -0,0 +1,65 @@
+"""
+Commande de mesure du moteur de modération
+
+Usage: python manage.py benchmark_moderation [--terms 10000] [--messages 1000]
+
+Location: apps/messaging/management/commands/benchmark_moderation.py
+"""
+
+import random
+import string
+import time
+from django.core.management.base import BaseCommand
+from apps.messaging.moderation import TermMatcher
+
+
+def _word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+class Command(BaseCommand):
+    help = "Compare l'automate de modération à la boucle `in` par terme sur des termes générés"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--terms', type=int, default=10000, help='Nombre de termes surveillés')
+        parser.add_argument('--messages', type=int, default=1000, help='Nombre de messages analysés')
+        parser.add_argument('--length', type=int, default=200, help='Longueur moyenne des messages')
+        parser.add_argument('--seed', type=int, default=42)
+    
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        
+        terms = [(_word(rng, rng.randint(4, 12)), rng.choice(['spam', 'forbidden'])) for _ in range(options['terms'])]
+        messages = []
+        for _ in range(options['messages']):
+            words = [_word(rng, rng.randint(2, 9)) for _ in range(options['length'] // 6)]
+            if rng.random() < 0.1:
+                words.insert(rng.randrange(len(words) + 1), rng.choice(terms)[0])
+            messages.append(' '.join(words))
+        
+        started = time.perf_counter()
+        matcher = TermMatcher(terms)
+        build = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        automaton_hits = sum(len(matcher.find_all(message)) for message in messages)
+        automaton = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        naive_hits = 0
+        for message in messages:
+            content_lower = message.lower()
+            naive_hits += sum(content_lower.count(term) for term, _ in terms if term in content_lower)
+        naive = time.perf_counter() - started
+        
+        self.stdout.write(f"Termes: {options['terms']}, messages: {options['messages']}")
+        self.stdout.write(f"Construction de l'automate: {build * 1000:.0f} ms")
+        self.stdout.write(
+            f"Automate: {automaton * 1000:.0f} ms ({options['messages'] / automaton:.0f} messages/s), "
+            f"{automaton_hits} occurrences"
+        )
+        self.stdout.write(
+            f"Boucle par terme: {naive * 1000:.0f} ms ({options['messages'] / naive:.0f} messages/s), "
+            f"{naive_hits} occurrences"
+        )
+        self.stdout.write(self.style.SUCCESS(f'✓ Accélération: x{naive / automaton:.1f}'))
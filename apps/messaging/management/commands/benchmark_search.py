@@ -0,0 +1,140 @@
+"""
+Commande de mesure de la recherche plein texte
+
+Usage: python manage.py benchmark_search [--messages 1000000] [--users 2000] [--queries 20]
+
+Le jeu de données est créé dans une transaction annulée à la fin de la
+mesure : la base n'est pas modifiée. Sur PostgreSQL, la migration 0008 doit
+être appliquée (index GIN) ; ailleurs, la recherche de repli en Python est
+mesurée et un jeu de données plus petit est recommandé.
+
+Location: apps/messaging/management/commands/benchmark_search.py
+"""
+
+import random
+import statistics
+import string
+import time
+import uuid
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from apps.messaging.models import Conversation, Message
+from apps.messaging.search import search
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    """Annule la transaction du jeu de données"""
+
+
+def _word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+class Command(BaseCommand):
+    help = "Compare la recherche plein texte à content__icontains sur un jeu de messages généré"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000, help='Nombre de messages générés')
+        parser.add_argument('--users', type=int, default=2000, help="Nombre d'utilisateurs générés")
+        parser.add_argument('--conversations', type=int, default=10000, help='Nombre de conversations générées')
+        parser.add_argument('--queries', type=int, default=20, help='Nombre de recherches mesurées')
+        parser.add_argument('--batch', type=int, default=10000, help='Taille des lots bulk_create')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            self.stdout.write('Jeu de données annulé')
+
+    def run(self, options):
+        rng = random.Random(options['seed'])
+        vocabulary = [_word(rng, rng.randint(3, 10)) for _ in range(20000)]
+
+        started = time.perf_counter()
+        users, conversations = self.seed(rng, vocabulary, options)
+        self.stdout.write(
+            f"Base: {connection.vendor}, {options['messages']} messages seedés "
+            f"en {time.perf_counter() - started:.1f}s"
+        )
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE messaging_message')
+                cursor.execute('ANALYZE messaging_conversation')
+
+        # Des utilisateurs qui ont des conversations, et des mots présents dans les messages
+        searchers = [rng.choice(users) for _ in range(options['queries'])]
+        queries = [rng.choice(vocabulary[:2000]) for _ in range(options['queries'])]
+
+        legacy, indexed = [], []
+        for user, query in zip(searchers, queries):
+            started = time.perf_counter()
+            list(Message.objects.filter(
+                conversation__participants=user,
+                content__icontains=query
+            ).select_related('sender', 'conversation').order_by('-created_at')[:20])
+            legacy.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            search(user, query, limit=20)
+            indexed.append(time.perf_counter() - started)
+
+        for label, timings in (('content__icontains', legacy), ('Recherche indexée', indexed)):
+            timings = sorted(timings)
+            self.stdout.write(
+                f"{label}: médiane {statistics.median(timings) * 1000:.1f} ms, "
+                f"p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.1f} ms"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ Accélération (médiane): x{statistics.median(legacy) / statistics.median(indexed):.1f}'
+        ))
+
+    def seed(self, rng, vocabulary, options):
+        """Utilisateurs, conversations à deux et messages, par bulk_create (sans signaux)"""
+        suffix = uuid.uuid4().int % 10 ** 6
+        users = User.objects.bulk_create([
+            User(username=f'bench_search_{suffix}_{n}', phone_number=f'+1998{suffix:06d}{n:05d}')
+            for n in range(options['users'])
+        ], batch_size=options['batch'])
+        if not users[0].pk:
+            # Bases sans RETURNING : relire les ids
+            users = list(User.objects.filter(username__startswith=f'bench_search_{suffix}_'))
+
+        pairs = set()
+        while len(pairs) < options['conversations']:
+            low, high = sorted(rng.sample(users, 2), key=lambda user: user.id)
+            pairs.add((low, high))
+
+        conversations = Conversation.objects.bulk_create([
+            Conversation(user_low=low, user_high=high) for low, high in pairs
+        ], batch_size=options['batch'])
+        if not conversations[0].pk:
+            conversations = list(Conversation.objects.filter(user_low__in=users))
+
+        Through = Conversation.participants.through
+        Through.objects.bulk_create([
+            Through(conversation_id=conversation.id, user_id=user_id)
+            for conversation in conversations
+            for user_id in (conversation.user_low_id, conversation.user_high_id)
+        ], batch_size=options['batch'])
+
+        batch = []
+        for _ in range(options['messages']):
+            conversation = rng.choice(conversations)
+            batch.append(Message(
+                conversation_id=conversation.id,
+                sender_id=rng.choice((conversation.user_low_id, conversation.user_high_id)),
+                content=' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 30))),
+            ))
+            if len(batch) == options['batch']:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+
+        return users, conversations
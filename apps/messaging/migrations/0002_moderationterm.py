@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:49
+
+from django.db import migrations, models
+
+
+# Listes codées en dur des anciens signaux detect_spam_message et moderate_content
+INITIAL_TERMS = [
+    ('viagra', 'spam'), ('casino', 'spam'), ('lottery', 'spam'), ('winner', 'spam'),
+    ('click here', 'spam'), ('buy now', 'spam'), ('limited offer', 'spam'),
+    ('insulte1', 'forbidden'), ('insulte2', 'forbidden'), ('mot_interdit', 'forbidden'),
+]
+
+
+def seed_terms(apps, schema_editor):
+    ModerationTerm = apps.get_model('messaging', 'ModerationTerm')
+    ModerationTerm.objects.bulk_create(
+        [ModerationTerm(term=term, category=category) for term, category in INITIAL_TERMS],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModerationTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=200, unique=True)),
+                ('category', models.CharField(choices=[('spam', 'Spam'), ('forbidden', 'Interdit')], default='forbidden', max_length=20)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['term'],
+            },
+        ),
+        migrations.RunPython(seed_terms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_cursors(apps, schema_editor):
+    """Crée un curseur par participant à partir des anciens drapeaux is_read"""
+    Conversation = apps.get_model('messaging', 'Conversation')
+    Message = apps.get_model('messaging', 'Message')
+    ReadCursor = apps.get_model('messaging', 'ReadCursor')
+    
+    cursors = []
+    for conversation in Conversation.objects.prefetch_related('participants').iterator(chunk_size=500):
+        messages = Message.objects.filter(conversation_id=conversation.id)
+        
+        for user in conversation.participants.all():
+            unread = messages.filter(is_read=False).exclude(sender_id=user.id)
+            first_unread = unread.aggregate(first=models.Min('id'))['first']
+            read = messages.filter(id__lt=first_unread) if first_unread else messages
+            
+            cursors.append(ReadCursor(
+                conversation_id=conversation.id,
+                user_id=user.id,
+                last_read_message_id=read.aggregate(last=models.Max('id'))['last'],
+                unread_count=unread.count(),
+            ))
+        
+        if len(cursors) >= 1000:
+            ReadCursor.objects.bulk_create(cursors, ignore_conflicts=True)
+            cursors = []
+    
+    ReadCursor.objects.bulk_create(cursors, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messaging', '0002_moderationterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='messaging.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('conversation', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_cursors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_summaries(apps, schema_editor):
+    """Renseigne le résumé du dernier message et la paire de participants"""
+    Conversation = apps.get_model('messaging', 'Conversation')
+    Message = apps.get_model('messaging', 'Message')
+    
+    for conversation in Conversation.objects.prefetch_related('participants').iterator(chunk_size=500):
+        user_ids = sorted(user.id for user in conversation.participants.all())
+        if 1 <= len(user_ids) <= 2:
+            conversation.user_low_id, conversation.user_high_id = user_ids[0], user_ids[-1]
+        
+        last = Message.objects.filter(conversation_id=conversation.id).order_by('-id').first()
+        if last is not None:
+            conversation.last_message_id = last.id
+            conversation.last_message_preview = last.content[:255]
+            conversation.last_message_at = last.created_at
+        
+        # update() pour ne pas toucher updated_at (auto_now)
+        Conversation.objects.filter(id=conversation.id).update(
+            user_low_id=conversation.user_low_id,
+            user_high_id=conversation.user_high_id,
+            last_message_id=conversation.last_message_id,
+            last_message_preview=conversation.last_message_preview,
+            last_message_at=conversation.last_message_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messaging', '0003_read_cursors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_high',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_low',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_low', '-last_message_at'], name='conversation_low_inbox'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_high', '-last_message_at'], name='conversation_high_inbox'),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations, models
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Fusionne les conversations de même clé (user_low, user_high, product)
+
+    La plus ancienne est conservée ; elle reçoit les messages des doublons et
+    les curseurs de lecture repartent du plus ancien curseur de chaque
+    participant.
+    """
+    Conversation = apps.get_model('messaging', 'Conversation')
+    Message = apps.get_model('messaging', 'Message')
+    ReadCursor = apps.get_model('messaging', 'ReadCursor')
+
+    duplicated = Conversation.objects.filter(user_low__isnull=False).values(
+        'user_low_id', 'user_high_id', 'product_id'
+    ).annotate(total=models.Count('id'), keep=models.Min('id')).filter(total__gt=1)
+
+    for key in duplicated.iterator():
+        keep = key['keep']
+        duplicate_ids = list(Conversation.objects.filter(
+            user_low_id=key['user_low_id'], user_high_id=key['user_high_id'], product_id=key['product_id']
+        ).exclude(id=keep).values_list('id', flat=True))
+
+        Message.objects.filter(conversation_id__in=duplicate_ids).update(conversation_id=keep)
+
+        last_read = {}
+        for user_id, last_read_id in ReadCursor.objects.filter(
+            conversation_id__in=[keep, *duplicate_ids]
+        ).values_list('user_id', 'last_read_message_id'):
+            last_read[user_id] = min(last_read.get(user_id, last_read_id or 0), last_read_id or 0)
+
+        ReadCursor.objects.filter(conversation_id__in=duplicate_ids).delete()
+        messages = Message.objects.filter(conversation_id=keep)
+        for user_id, last_read_id in last_read.items():
+            ReadCursor.objects.update_or_create(conversation_id=keep, user_id=user_id, defaults={
+                'last_read_message_id': last_read_id or None,
+                'unread_count': messages.filter(id__gt=last_read_id).exclude(sender_id=user_id).count(),
+            })
+
+        Conversation.objects.filter(id__in=duplicate_ids).delete()
+
+        last = messages.order_by('-id').first()
+        Conversation.objects.filter(id=keep).update(
+            last_message_id=last.id if last else None,
+            last_message_preview=last.content[:255] if last else '',
+            last_message_at=last.created_at if last else None,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0004_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0005_merge_duplicate_conversations'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', False)), fields=('user_low', 'user_high', 'product'), name='conversation_unique_pair_product'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', True)), fields=('user_low', 'user_high'), name='conversation_unique_pair'),
+        ),
+    ]
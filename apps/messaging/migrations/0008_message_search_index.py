@@ -0,0 +1,31 @@
+from django.db import migrations
+
+# Même expression que la recherche (apps/messaging/search.py), pour que l'index soit utilisé
+CREATE_INDEX = """
+    CREATE INDEX IF NOT EXISTS message_search ON messaging_message
+    USING gin (to_tsvector('french'::regconfig, COALESCE(content, '')))
+"""
+
+DROP_INDEX = 'DROP INDEX IF EXISTS message_search'
+
+
+def create_search_index(apps, schema_editor):
+    """Index GIN plein texte, sur PostgreSQL uniquement (repli en Python ailleurs)"""
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_INDEX)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0007_message_history_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:14
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messaging', '0008_message_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserMessagingStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_conversations', models.PositiveIntegerField(default=0)),
+                ('active_conversations', models.PositiveIntegerField(default=0)),
+                ('total_messages_sent', models.PositiveIntegerField(default=0)),
+                ('total_messages_received', models.PositiveIntegerField(default=0)),
+                ('average_response_time', models.DurationField(blank=True, null=True)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+                ('most_active_conversation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messaging.conversation')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='messaging_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'User messaging stats',
+            },
+        ),
+    ]
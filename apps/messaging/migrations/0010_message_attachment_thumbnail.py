@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0009_user_messaging_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attachment_thumbnail',
+            field=models.FileField(blank=True, null=True, upload_to='message_attachments/thumbnails/'),
+        ),
+    ]
@@ -12,15 +12,49 @@ class Conversation(models.Model):
     product = models.ForeignKey('shops.Product', on_delete=models.SET_NULL, 
                                 null=True, blank=True, related_name='conversations')
     
+    # Résumé dénormalisé pour la boîte de réception, mis à jour à chaque nouveau message
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=255, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    
+    # Paire de participants d'une conversation à deux (id le plus petit, id le plus grand)
+    user_low = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, 
+                                 null=True, blank=True, related_name='+')
+    user_high = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, 
+                                  null=True, blank=True, related_name='+')
+    
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['user_low', '-last_message_at'], name='conversation_low_inbox'),
+            models.Index(fields=['user_high', '-last_message_at'], name='conversation_high_inbox'),
+        ]
+        # Clé canonique (user_low, user_high, product) : une seule conversation par paire et par produit.
+        # Deux index partiels, car NULL est distinct de NULL dans un index unique.
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high', 'product'],
+                                    condition=models.Q(product__isnull=False),
+                                    name='conversation_unique_pair_product'),
+            models.UniqueConstraint(fields=['user_low', 'user_high'],
+                                    condition=models.Q(product__isnull=True),
+                                    name='conversation_unique_pair'),
+        ]
     
     def __str__(self):
-        users = ', '.join([user.username for user in self.participants.all()])
+        # Jamais de requête : participants préchargés (prefetch_related), sinon l'id
+        participants = getattr(self, '_prefetched_objects_cache', {}).get('participants')
+        if participants is None:
+            return f"Conversation #{self.pk}"
+        users = ', '.join([user.username for user in participants])
         return f"Conversation: {users}"
     
     def get_other_participant(self, user):
         """Retourne l'autre participant de la conversation"""
+        if self.user_low_id and self.user_high_id:
+            # Sans requête quand la paire est chargée (select_related)
+            if self.user_low_id == self.user_high_id:
+                return None
+            return self.user_high if self.user_low_id == user.id else self.user_low
         return self.participants.exclude(id=user.id).first()
     
     def get_last_message(self):
@@ -28,8 +62,9 @@ class Conversation(models.Model):
         return self.messages.order_by('-created_at').first()
     
     def get_unread_count(self, user):
-        """Retourne le nombre de messages non lus pour un utilisateur"""
-        return self.messages.filter(is_read=False).exclude(sender=user).count()
+        """Retourne le nombre de messages non lus pour un utilisateur (lu sur son curseur)"""
+        cursor = self.read_cursors.filter(user=user).values_list('unread_count', flat=True).first()
+        return cursor or 0
 
 
 class Message(models.Model):
@@ -45,18 +80,61 @@ class Message(models.Model):
     # Optionnel : pour les fichiers joints
     attachment = models.FileField(upload_to='message_attachments/', 
                                   null=True, blank=True)
+    # Miniature des images jointes, produite en tâche de fond (voir uploads.py)
+    attachment_thumbnail = models.FileField(upload_to='message_attachments/thumbnails/',
+                                            null=True, blank=True)
+    # Identifiant généré par le client : un renvoi ne crée pas de doublon (voir delivery.py)
+    client_id = models.UUIDField(null=True, blank=True)
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Pagination de l'historique par curseur (voir history.py)
+            models.Index(fields=['conversation', 'created_at', 'id'], name='message_history'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_id'], condition=models.Q(client_id__isnull=False),
+                                    name='message_unique_client_id'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
     
     def mark_as_read(self):
-        """Marque le message comme lu"""
-        if not self.is_read:
-            self.is_read = True
-            self.save(update_fields=['is_read'])
+        """Marque le message comme lu pour les autres participants (avance leurs curseurs)"""
+        from .read_state import mark_read_up_to
+        
+        for user_id in self.conversation.participants.exclude(id=self.sender_id).values_list('id', flat=True):
+            mark_read_up_to(self.conversation_id, user_id, self.id)
+        self.is_read = True
+
+
+class ReadCursor(models.Model):
+    """
+    Position de lecture d'un participant dans une conversation
+    
+    last_read_message_id avance d'un coup à la lecture et unread_count est
+    incrémenté à chaque nouveau message d'un autre participant : les
+    compteurs de non-lus ne parcourent jamais les messages.
+    
+    last_delivered_message_id est le dernier message acquitté comme reçu par
+    le client : les accusés de réception tiennent en une ligne par
+    participant, quel que soit le nombre de messages.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, 
+                                     related_name='read_cursors')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, 
+                             related_name='read_cursors')
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+    last_delivered_message_id = models.BigIntegerField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ('conversation', 'user')
+    
+    def __str__(self):
+        return f"{self.user} @ {self.conversation_id}: {self.unread_count} non lu(s)"
 
 
 class MessageReadStatus(models.Model):
@@ -68,4 +146,64 @@ class MessageReadStatus(models.Model):
     
     class Meta:
         unique_together = ('message', 'user')
-        verbose_name_plural = 'Message read statuses'
\ No newline at end of file
+        verbose_name_plural = 'Message read statuses'
+
+
+class UserMessagingStats(models.Model):
+    """
+    Instantané nocturne des statistiques de messagerie d'un utilisateur
+    
+    Écrit par la tâche rollup_messaging_stats (voir analytics.py) ; les
+    non-lus n'y figurent pas, ils se lisent en temps réel sur les curseurs.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                                related_name='messaging_stats')
+    total_conversations = models.PositiveIntegerField(default=0)
+    active_conversations = models.PositiveIntegerField(default=0)
+    total_messages_sent = models.PositiveIntegerField(default=0)
+    total_messages_received = models.PositiveIntegerField(default=0)
+    average_response_time = models.DurationField(null=True, blank=True)
+    most_active_conversation = models.ForeignKey(Conversation, on_delete=models.SET_NULL,
+                                                 null=True, blank=True, related_name='+')
+    computed_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name_plural = 'User messaging stats'
+    
+    def __str__(self):
+        return f"{self.user} ({self.computed_at:%Y-%m-%d})"
+    
+    def as_dict(self):
+        return {
+            'total_conversations': self.total_conversations,
+            'active_conversations': self.active_conversations,
+            'total_messages_sent': self.total_messages_sent,
+            'total_messages_received': self.total_messages_received,
+            'average_response_time': self.average_response_time,
+            'most_active_conversation': self.most_active_conversation,
+        }
+
+
+class ModerationTerm(models.Model):
+    """Terme surveillé par le moteur de modération (voir moderation.py)"""
+    CATEGORY_CHOICES = [
+        ('spam', 'Spam'),
+        ('forbidden', 'Interdit'),
+    ]
+    
+    term = models.CharField(max_length=200, unique=True)
+    category = models.CharField(max_length=20, choices=CATEGORY_CHOICES, default='forbidden')
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['term']
+    
+    def __str__(self):
+        return f"{self.term} ({self.get_category_display()})"
+    
+    def save(self, *args, **kwargs):
+        # Le moteur compare en minuscules
+        self.term = self.term.strip().lower()
+        super().save(*args, **kwargs)
@@ -0,0 +1,121 @@
+"""
+Moteur de modération du contenu des messages
+
+Les termes surveillés (ModerationTerm, gérés dans l'admin) sont compilés en
+un automate d'Aho–Corasick : un seul parcours du texte retourne toutes les
+occurrences de tous les termes, quel que soit leur nombre, au lieu d'un test
+`in` par terme.
+
+Chaque worker garde son automate en mémoire avec la version sous laquelle
+il a été construit. Toute modification d'un terme publie une nouvelle
+version (un jeton aléatoire) dans le cache, Redis en production ; les
+workers la lisent à chaque lot et reconstruisent l'automate quand elle a
+changé.
+"""
+
+import uuid
+from collections import deque, namedtuple
+from django.core.cache import cache
+
+VERSION_KEY = 'messaging:moderation:version'
+
+ModerationMatch = namedtuple('ModerationMatch', ['term', 'category', 'start'])
+
+
+class TermMatcher:
+    """Automate d'Aho–Corasick sur des termes en minuscules"""
+
+    def __init__(self, terms):
+        """
+        Args:
+            terms: Itérable de tuples (terme, catégorie)
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self.size = 0
+
+        for term, category in terms:
+            term = term.lower()
+            if not term:
+                continue
+
+            node = 0
+            for char in term:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[node][char] = child
+                node = child
+
+            self._output[node].append((term, category))
+            self.size += 1
+
+        # Liens d'échec en largeur ; chaque nœud hérite des sorties de son lien
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find_all(self, text):
+        """Retourne toutes les occurrences (chevauchements compris) en un parcours"""
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        node = 0
+
+        for position, char in enumerate(text.lower()):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            for term, category in output[node]:
+                matches.append(ModerationMatch(term, category, position - len(term) + 1))
+
+        return matches
+
+
+_matcher = None
+_matcher_version = None
+
+
+def current_version():
+    """Version partagée de la liste des termes"""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Clé absente ou évincée : une nouvelle version force la reconstruction partout
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    """Signale aux workers que la liste des termes a changé"""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def get_matcher():
+    """Automate à jour, reconstruit seulement si la version a changé"""
+    global _matcher, _matcher_version
+    from .models import ModerationTerm
+
+    version = current_version()
+    if _matcher is None or version != _matcher_version:
+        terms = ModerationTerm.objects.filter(is_active=True).values_list('term', 'category')
+        _matcher = TermMatcher(terms.iterator())
+        _matcher_version = version
+
+    return _matcher
+
+
+def scan(text):
+    """Toutes les occurrences de termes surveillés dans un texte"""
+    return get_matcher().find_all(text)
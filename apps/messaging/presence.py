@@ -0,0 +1,102 @@
+"""
+Présence des utilisateurs sur les WebSockets de messagerie
+
+Un utilisateur connecté a une clé de présence dans le cache (Redis en
+production) qui expire après MESSAGING_PRESENCE_TTL secondes. Tant qu'un
+socket est ouvert, son consumer la rafraîchit toutes les
+MESSAGING_PRESENCE_HEARTBEAT secondes : un worker arrêté sans déconnexion
+propre laisse l'utilisateur hors ligne au plus un TTL plus tard.
+
+Un compteur de sockets par utilisateur, rafraîchi avec la clé de présence,
+repère la dernière déconnexion. Seuls le passage en ligne et le passage
+hors ligne sont publiés (presence_update) aux groupes des conversations de
+l'utilisateur.
+
+La présence d'une page entière (boîte de réception, destinataires d'un lot
+de notifications) se lit en un seul MGET (cache.get_many). Le suivi
+d'activité n'écrit jamais en base.
+"""
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from .models import Conversation
+
+ONLINE_KEY = 'messaging:online:{}'
+SOCKETS_KEY = 'messaging:online:{}:sockets'
+
+
+async def heartbeat(user_id):
+    """Prolonge la présence de l'utilisateur d'un TTL"""
+    ttl = settings.MESSAGING_PRESENCE_TTL
+    await cache.aset(ONLINE_KEY.format(user_id), time.time(), ttl)
+    await cache.atouch(SOCKETS_KEY.format(user_id), ttl)
+
+
+async def mark_online(user_id):
+    """
+    Compte un socket de plus pour l'utilisateur
+
+    Returns:
+        bool: True si l'utilisateur vient de passer en ligne
+    """
+    ttl = settings.MESSAGING_PRESENCE_TTL
+    key = SOCKETS_KEY.format(user_id)
+
+    await cache.aadd(key, 0, ttl)
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        # Clé expirée entre add et incr
+        await cache.aset(key, 1, ttl)
+
+    came_online = await cache.aadd(ONLINE_KEY.format(user_id), time.time(), ttl)
+    if not came_online:
+        await heartbeat(user_id)
+    return came_online
+
+
+async def mark_offline(user_id):
+    """
+    Compte un socket de moins pour l'utilisateur
+
+    Returns:
+        bool: True si c'était son dernier socket
+    """
+    key = SOCKETS_KEY.format(user_id)
+    try:
+        if await cache.adecr(key) > 0:
+            return False
+    except ValueError:
+        # Compteur expiré : plus aucun socket ne le rafraîchissait
+        pass
+
+    await cache.adelete_many([key, ONLINE_KEY.format(user_id)])
+    return True
+
+
+async def publish_change(channel_layer, user_id, online):
+    """Publie un passage en ligne ou hors ligne aux conversations de l'utilisateur"""
+    conversation_ids = Conversation.objects.filter(
+        Q(user_low_id=user_id) | Q(user_high_id=user_id)
+    ).values_list('id', flat=True)
+
+    async for conversation_id in conversation_ids:
+        await channel_layer.group_send(f'chat_{conversation_id}', {
+            'type': 'presence_update',
+            'conversation_id': conversation_id,
+            'user_id': user_id,
+            'online': online,
+        })
+
+
+def is_online(user_id):
+    """Vrai si l'utilisateur a au moins un socket de messagerie vivant"""
+    return cache.get(ONLINE_KEY.format(user_id)) is not None
+
+
+def online_user_ids(user_ids):
+    """Retourne les utilisateurs en ligne parmi user_ids (un seul MGET)"""
+    keys = {ONLINE_KEY.format(user_id): user_id for user_id in user_ids}
+    return {keys[key] for key in cache.get_many(list(keys))}
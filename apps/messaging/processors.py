@@ -0,0 +1,146 @@
+"""
+Chaîne de traitement des nouveaux messages
+
+Les traitements qui suivaient l'envoi d'un message (notification,
+modération, activité) tournaient comme signaux post_save dans la requête ou
+le consumer. Ils sont désormais enregistrés ici et exécutés par la tâche
+Celery process_messages, sur des lots de messages déjà chargés avec leur
+expéditeur, leur conversation et ses participants. L'activité n'est plus
+suivie ici : la conversation l'est par son résumé (summary.py), les
+utilisateurs par leur présence (presence.py).
+
+Chaque processeur reçoit la liste des messages du lot. Une erreur dans un
+processeur est journalisée sans empêcher les suivants de s'exécuter.
+"""
+
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from .consumers import user_group
+from .digests import queue_notification
+from .models import Message
+from .moderation import get_matcher
+from .presence import online_user_ids
+from .summary import preview
+from .uploads import is_image, make_thumbnail
+
+logger = logging.getLogger('messaging')
+
+# Processeurs enregistrés, dans leur ordre d'exécution
+PROCESSORS = {}
+
+MAX_NORMAL_LENGTH = 1000
+
+
+def register_processor(name):
+    """Enregistre un processeur de messages sous un nom"""
+    def decorator(func):
+        PROCESSORS[name] = func
+        return func
+    return decorator
+
+
+def run_processors(messages):
+    """Exécute toute la chaîne sur un lot de messages"""
+    for name, processor in PROCESSORS.items():
+        try:
+            processor(messages)
+        except Exception as e:
+            logger.error(f'Erreur du processeur {name} sur {len(messages)} message(s): {e}')
+
+
+@register_processor('notify')
+def notify_recipients(messages):
+    """
+    Met en attente une notification email pour les destinataires de chaque message
+
+    Les emails partent en résumés groupés (voir digests.py). Les destinataires
+    connectés à un WebSocket de messagerie ne sont pas notifiés.
+    """
+    recipients_by_message = [
+        (message, [p for p in message.conversation.participants.all() if p.id != message.sender_id])
+        for message in messages
+    ]
+    online = online_user_ids({r.id for _, recipients in recipients_by_message for r in recipients})
+
+    for message, recipients in recipients_by_message:
+        for recipient in recipients:
+            if recipient.id not in online:
+                queue_notification(recipient, message)
+
+
+@register_processor('inbox')
+def push_inbox_updates(messages):
+    """
+    Signale les nouveaux messages aux sockets des destinataires
+
+    Un événement inbox_update par message et par destinataire, sur le groupe
+    de l'utilisateur : les sockets qui ne sont pas abonnés à la conversation
+    mettent à jour la liste des conversations sans recharger.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    for message in messages:
+        event = {
+            'type': 'inbox_update',
+            'conversation_id': message.conversation_id,
+            'message_id': message.id,
+            'sender_id': message.sender_id,
+            'preview': preview(message.content),
+            'created_at': message.created_at.isoformat(),
+        }
+        for participant in message.conversation.participants.all():
+            if participant.id != message.sender_id:
+                async_to_sync(channel_layer.group_send)(user_group(participant.id), event)
+
+
+@register_processor('thumbnails')
+def make_attachment_thumbnails(messages):
+    """Produit la miniature des images jointes, hors du chemin d'envoi"""
+    for message in messages:
+        if not message.attachment or message.attachment_thumbnail or not is_image(message.attachment.name):
+            continue
+        try:
+            thumbnail = make_thumbnail(message.attachment.name)
+        except Exception as e:
+            logger.warning(f'Miniature impossible pour le message {message.id}: {e}')
+            continue
+        Message.objects.filter(id=message.id).update(attachment_thumbnail=thumbnail)
+
+
+@register_processor('moderation')
+def moderate_content(messages):
+    """
+    Détecte spam et contenu interdit, et signale les messages très longs
+
+    Un seul parcours de chaque message par l'automate de modération, qui
+    retourne les termes de toutes les catégories (voir moderation.py).
+    """
+    matcher = get_matcher()
+
+    for message in messages:
+        matches = matcher.find_all(message.content)
+
+        spam = [match.term for match in matches if match.category == 'spam']
+        if spam:
+            logger.warning(
+                f'Message potentiellement spam détecté: '
+                f'ID={message.id}, Sender={message.sender.username}, '
+                f'Keyword={spam[0]}'
+            )
+
+        forbidden = [match.term for match in matches if match.category == 'forbidden']
+        if forbidden:
+            logger.warning(
+                f'Contenu inapproprié détecté: '
+                f'ID={message.id}, Sender={message.sender.username}, '
+                f'Terms={sorted(set(forbidden))}'
+            )
+
+        if len(message.content) > MAX_NORMAL_LENGTH:
+            logger.info(
+                f'Message très long détecté: '
+                f'ID={message.id}, Length={len(message.content)}'
+            )
@@ -0,0 +1,182 @@
+"""
+Curseurs de lecture par participant
+
+Chaque participant d'une conversation a un ReadCursor : l'id du dernier
+message lu et le nombre de messages non lus. Un nouveau message incrémente
+les compteurs des autres participants (un UPDATE), marquer la conversation
+comme lue avance le curseur (un UPDATE), et les compteurs de non-lus se
+lisent directement sur les curseurs, sans COUNT(*) sur les messages.
+"""
+
+from django.db.models import F, Max, Subquery, OuterRef, Sum
+from django.db.models.functions import Coalesce, Greatest
+from .models import Message, ReadCursor
+
+
+def ensure_cursors(conversation_id, user_ids):
+    """Crée les curseurs manquants des participants d'une conversation"""
+    ReadCursor.objects.bulk_create(
+        [ReadCursor(conversation_id=conversation_id, user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def increment_unread(message):
+    """Compte un nouveau message comme non lu pour les autres participants"""
+    ReadCursor.objects.filter(
+        conversation_id=message.conversation_id
+    ).exclude(user_id=message.sender_id).update(unread_count=F('unread_count') + 1)
+
+
+def _latest_message_id(conversation_id):
+    return Message.objects.filter(conversation_id=conversation_id).order_by().values(
+        'conversation_id'
+    ).annotate(last=Max('id')).values('last')
+
+
+def _mark_read_queryset(conversation_id, user_id):
+    return ReadCursor.objects.filter(conversation_id=conversation_id, user_id=user_id)
+
+
+def mark_conversation_read(conversation_id, user_id):
+    """
+    Marque toute la conversation comme lue pour un utilisateur
+
+    Un seul UPDATE : le curseur passe au dernier message et le compteur à
+    zéro dans la même instruction, si bien qu'un message inséré en parallèle
+    est soit couvert par le curseur, soit compté après.
+    """
+    return _mark_read_queryset(conversation_id, user_id).update(
+        last_read_message_id=Subquery(_latest_message_id(conversation_id)),
+        unread_count=0,
+    )
+
+
+async def amark_conversation_read(conversation_id, user_id):
+    """Version asynchrone de mark_conversation_read"""
+    return await _mark_read_queryset(conversation_id, user_id).aupdate(
+        last_read_message_id=Subquery(_latest_message_id(conversation_id)),
+        unread_count=0,
+    )
+
+
+def mark_read_up_to(conversation_id, user_id, message_id):
+    """
+    Avance le curseur jusqu'à message_id (jamais en arrière)
+
+    Le compteur est recalculé sur les seuls messages encore non lus après
+    le curseur.
+    """
+    cursor = ReadCursor.objects.filter(conversation_id=conversation_id, user_id=user_id).first()
+    if cursor is None or (cursor.last_read_message_id or 0) >= message_id:
+        return False
+
+    remaining = Message.objects.filter(
+        conversation_id=conversation_id, id__gt=message_id
+    ).exclude(sender_id=user_id).count()
+
+    ReadCursor.objects.filter(id=cursor.id).update(
+        last_read_message_id=Greatest(Coalesce('last_read_message_id', 0), message_id),
+        unread_count=remaining,
+    )
+    return True
+
+
+def unread_count_subquery(user):
+    """Sous-requête du nombre de non-lus de user, à annoter sur des conversations"""
+    return Coalesce(
+        Subquery(
+            ReadCursor.objects.filter(conversation=OuterRef('pk'), user=user).values('unread_count')[:1]
+        ),
+        0,
+    )
+
+
+def total_unread(user):
+    """Nombre total de messages non lus de l'utilisateur"""
+    return ReadCursor.objects.filter(user=user).aggregate(total=Sum('unread_count'))['total'] or 0
+
+
+def _cursor_rows(messages):
+    return ReadCursor.objects.filter(
+        conversation_id__in={message.conversation_id for message in messages}
+    ).values_list('conversation_id', 'user_id', 'last_read_message_id')
+
+
+def _set_read_flags(messages, rows, user_id):
+    own, others = {}, {}
+    for conversation_id, cursor_user_id, last_read_id in rows:
+        last_read_id = last_read_id or 0
+        if cursor_user_id == user_id:
+            own[conversation_id] = last_read_id
+        else:
+            others[conversation_id] = min(others.get(conversation_id, last_read_id), last_read_id)
+
+    for message in messages:
+        read_up_to = others if message.sender_id == user_id else own
+        message.is_read = message.id <= read_up_to.get(message.conversation_id, 0)
+
+
+def apply_read_flags(messages, user):
+    """
+    Renseigne is_read sur des messages à partir des curseurs, pour user
+
+    La colonne Message.is_read n'est pas tenue à jour : tout message
+    sérialisé passe par ici. Un message reçu est lu si le curseur de user
+    l'a dépassé ; un message envoyé est lu si tous les autres participants
+    l'ont dépassé. Une seule requête, quelles que soient les conversations.
+    """
+    if messages:
+        _set_read_flags(messages, _cursor_rows(messages), user.id)
+    return messages
+
+
+async def aapply_read_flags(messages, user):
+    """Version asynchrone de apply_read_flags"""
+    if messages:
+        _set_read_flags(messages, [row async for row in _cursor_rows(messages)], user.id)
+    return messages
+
+
+def read_positions(conversation_id):
+    """Curseurs d'une conversation : {user_id: id du dernier message lu (0 si aucun)}"""
+    return {
+        user_id: last_read_id or 0
+        for user_id, last_read_id in ReadCursor.objects.filter(
+            conversation_id=conversation_id
+        ).values_list('user_id', 'last_read_message_id')
+    }
+
+
+def read_by_recipients(message, positions):
+    """Vrai si tous les autres participants ont lu message (positions : voir read_positions)"""
+    return message.id <= min(
+        (last_read_id for user_id, last_read_id in positions.items() if user_id != message.sender_id), default=0
+    )
+
+
+def mark_messages_read(messages):
+    """
+    Marque des messages comme lus par leurs destinataires (administration)
+
+    Le curseur de chaque destinataire avance jusqu'au plus récent des
+    messages qu'il a reçus parmi messages, jamais en arrière.
+
+    Returns:
+        int: Nombre de curseurs avancés
+    """
+    latest = list(messages.order_by().values_list('conversation_id', 'sender_id').annotate(last=Max('id')))
+    cursors = ReadCursor.objects.filter(
+        conversation_id__in={conversation_id for conversation_id, _, _ in latest}
+    ).values_list('conversation_id', 'user_id')
+
+    advanced = 0
+    for conversation_id, user_id in cursors:
+        up_to = max(
+            (last for message_conversation_id, sender_id, last in latest
+             if message_conversation_id == conversation_id and sender_id != user_id),
+            default=None,
+        )
+        if up_to is not None and mark_read_up_to(conversation_id, user_id, up_to):
+            advanced += 1
+    return advanced
@@ -0,0 +1,182 @@
+"""
+Rétention des messages et archivage à froid
+
+Les messages plus anciens que MESSAGE_RETENTION_DAYS sont parcourus par
+lots de clés primaires croissantes. Chaque lot est d'abord écrit dans le
+stockage de fichiers (S3 en production) en JSONL compressé, un fichier par
+mois de création :
+
+    <MESSAGE_ARCHIVE_PREFIX>/<AAAA-MM>/messages-<premier id>-<dernier id>.jsonl.gz
+
+puis supprimé par des DELETE bornés à la liste d'ids du lot, dans une
+transaction courte. Le collecteur de Django n'est pas utilisé : aucun
+message n'est chargé pour les cascades et aucun signal n'est émis. Ce que
+les signaux auraient fait est refait par lot : statuts de lecture
+supprimés, compteurs de non-lus diminués des messages supprimés, résumé
+des conversations dont le dernier message part recalculé. Les fichiers
+joints restent dans le stockage, référencés par l'archive.
+
+Une pause de MESSAGE_RETENTION_PAUSE secondes entre deux lots laisse
+passer le trafic. Le dernier id traité est enregistré après chaque lot
+(<MESSAGE_ARCHIVE_PREFIX>/checkpoint.json) : un passage interrompu reprend
+là où il s'était arrêté, et chaque passage ne parcourt que les messages
+postérieurs au précédent.
+"""
+
+import gzip
+import json
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .models import Message, MessageReadStatus, ReadCursor
+from .summary import refresh_after_purge
+
+logger = logging.getLogger('messaging')
+
+ARCHIVED_FIELDS = ('id', 'conversation_id', 'sender_id', 'content', 'attachment', 'created_at')
+
+
+def _checkpoint_name():
+    return f'{settings.MESSAGE_ARCHIVE_PREFIX}/checkpoint.json'
+
+
+def load_checkpoint():
+    """Dernier id archivé et supprimé (0 si aucun passage)"""
+    name = _checkpoint_name()
+    if not default_storage.exists(name):
+        return 0
+    with default_storage.open(name) as f:
+        return json.load(f)['last_id']
+
+
+def save_checkpoint(last_id):
+    name = _checkpoint_name()
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(json.dumps({'last_id': last_id}).encode()))
+
+
+def _save_archive(name, rows):
+    lines = [
+        json.dumps({**row, 'created_at': row['created_at'].isoformat()}, ensure_ascii=False)
+        for row in rows
+    ]
+    # Un lot rejoué après une interruption réécrit le même fichier
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(gzip.compress('\n'.join(lines).encode() + b'\n')))
+
+
+def archive_batch(rows):
+    """
+    Écrit un lot dans les archives, un fichier par mois de création
+
+    Returns:
+        list: Noms des fichiers écrits
+    """
+    by_month = defaultdict(list)
+    for row in rows:
+        by_month[row['created_at'].strftime('%Y-%m')].append(row)
+
+    names = []
+    for month, month_rows in sorted(by_month.items()):
+        name = (
+            f"{settings.MESSAGE_ARCHIVE_PREFIX}/{month}/"
+            f"messages-{month_rows[0]['id']:012d}-{month_rows[-1]['id']:012d}.jsonl.gz"
+        )
+        _save_archive(name, month_rows)
+        names.append(name)
+    return names
+
+
+def _forget_unread(rows):
+    """Retire des compteurs de non-lus les messages du lot que leurs lecteurs n'avaient pas lus"""
+    rows_by_conversation = defaultdict(list)
+    for row in rows:
+        rows_by_conversation[row['conversation_id']].append(row)
+
+    cursors = ReadCursor.objects.filter(conversation_id__in=rows_by_conversation).values_list(
+        'id', 'conversation_id', 'user_id', 'last_read_message_id'
+    )
+    for cursor_id, conversation_id, user_id, last_read_id in cursors:
+        unread = sum(
+            1 for row in rows_by_conversation[conversation_id]
+            if row['id'] > (last_read_id or 0) and row['sender_id'] != user_id
+        )
+        if unread:
+            ReadCursor.objects.filter(id=cursor_id).update(unread_count=Greatest(F('unread_count') - unread, 0))
+
+
+def delete_batch(rows):
+    """Supprime un lot par des DELETE bornés à ses ids, et remet à jour les données dérivées"""
+    ids = [row['id'] for row in rows]
+    placeholders = ', '.join(['%s'] * len(ids))
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {MessageReadStatus._meta.db_table} WHERE message_id IN ({placeholders})', ids
+        )
+        cursor.execute(f'DELETE FROM {Message._meta.db_table} WHERE id IN ({placeholders})', ids)
+        _forget_unread(rows)
+        refresh_after_purge(ids)
+
+
+def purge_old_messages(days=None, batch_size=None, pause=None, max_batches=None):
+    """
+    Archive puis supprime les messages plus anciens que days jours
+
+    Le parcours s'arrête au premier message trop récent : les ids croissent
+    avec la date de création.
+
+    Args:
+        days: Durée de rétention (défaut MESSAGE_RETENTION_DAYS)
+        batch_size: Messages par lot (défaut MESSAGE_RETENTION_BATCH_SIZE)
+        pause: Pause entre deux lots en secondes (défaut MESSAGE_RETENTION_PAUSE)
+        max_batches: Nombre maximal de lots pour ce passage (défaut : sans limite)
+
+    Returns:
+        dict: deleted, batches, files, last_id
+    """
+    days = settings.MESSAGE_RETENTION_DAYS if days is None else days
+    batch_size = batch_size or settings.MESSAGE_RETENTION_BATCH_SIZE
+    pause = settings.MESSAGE_RETENTION_PAUSE if pause is None else pause
+    cutoff = timezone.now() - timedelta(days=days)
+
+    summary = {'deleted': 0, 'batches': 0, 'files': 0, 'last_id': load_checkpoint()}
+
+    while max_batches is None or summary['batches'] < max_batches:
+        rows = list(
+            Message.objects.filter(id__gt=summary['last_id']).order_by('id').values(*ARCHIVED_FIELDS)[:batch_size]
+        )
+        old = []
+        for row in rows:
+            if row['created_at'] >= cutoff:
+                break
+            old.append(row)
+
+        if old:
+            summary['files'] += len(archive_batch(old))
+            delete_batch(old)
+            summary['deleted'] += len(old)
+            summary['batches'] += 1
+            summary['last_id'] = old[-1]['id']
+            save_checkpoint(summary['last_id'])
+
+        if len(old) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    logger.info(
+        f"Rétention des messages: {summary['deleted']} archivés et supprimés en {summary['batches']} lot(s), "
+        f"{summary['files']} fichier(s), reprise après l'id {summary['last_id']}"
+    )
+    return summary
@@ -2,5 +2,7 @@
 from . import consumers
 
 websocket_urlpatterns = [
+    re_path(r'ws/messaging/$', consumers.MessagingConsumer.as_asgi()),
+    # Compatibilité : un socket par conversation
     re_path(r'ws/chat/(?P<conversation_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
 ]
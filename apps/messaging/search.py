@@ -0,0 +1,196 @@
+"""
+Recherche plein texte dans les messages d'un utilisateur
+
+En production (PostgreSQL), les messages sont indexés par un index GIN sur
+to_tsvector(SEARCH_CONFIG, content), créé par la migration 0008 : l'index
+est mis à jour par la base à chaque INSERT, sans code applicatif. Une
+recherche est limitée aux conversations de l'utilisateur (par la paire
+user_low / user_high), classée par ts_rank, et seuls les messages de la page
+passent par ts_headline pour produire les extraits.
+
+Sur les autres bases (SQLite en développement et en test), une recherche de
+repli en Python parcourt les messages des conversations de l'utilisateur,
+avec la même forme de résultat : tous les mots de la requête doivent
+apparaître (sans accents ni casse, mais sans racinisation).
+
+La pagination se fait par curseur (rang, id) : le curseur renvoyé avec une
+page donne la suivante, sans OFFSET.
+"""
+
+import math
+import re
+import unicodedata
+from collections import namedtuple
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from .history import clamp_limit
+from .models import Conversation, Message
+
+# Doit rester identique à l'expression de l'index de la migration 0008
+SEARCH_CONFIG = 'french'
+
+SNIPPET_WORDS = 20
+
+# Marqueurs internes des extraits, remplacés par <mark> après échappement du contenu
+_START, _STOP = '\x02', '\x03'
+
+WORD_RE = re.compile(r'\w+')
+
+SearchHit = namedtuple('SearchHit', ['message', 'rank', 'snippet'])
+SearchPage = namedtuple('SearchPage', ['hits', 'next_cursor'])
+
+
+def encode_cursor(rank, message_id):
+    """Curseur de la page suivante : rang et id du dernier résultat"""
+    return f'{rank!r}:{message_id}'
+
+
+def decode_cursor(cursor):
+    """Inverse de encode_cursor ; ValueError si le curseur est invalide"""
+    rank, _, message_id = cursor.partition(':')
+    return float(rank), int(message_id)
+
+
+def _highlight(snippet):
+    return escape(snippet).replace(_START, '<mark>').replace(_STOP, '</mark>')
+
+
+def _user_conversations(user_id):
+    return Conversation.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)).values('id')
+
+
+def search(user, query, cursor=None, limit=None):
+    """
+    Recherche les messages de l'utilisateur contenant les mots de query
+
+    Args:
+        user: Utilisateur (seules ses conversations sont parcourues)
+        query: Texte recherché (syntaxe websearch_to_tsquery en production)
+        cursor: Curseur renvoyé par la page précédente
+        limit: Taille de page
+
+    Returns:
+        SearchPage: résultats (message, rang, extrait HTML surligné) du plus
+        pertinent au moins pertinent, et curseur de la page suivante (ou None)
+
+    Raises:
+        ValueError: curseur invalide
+    """
+    query = (query or '').strip()
+    if not query:
+        return SearchPage([], None)
+
+    limit = clamp_limit(limit)
+    after = decode_cursor(cursor) if cursor else None
+
+    if connection.vendor == 'postgresql':
+        hits = _postgres_search(user.id, query, after, limit + 1)
+    else:
+        hits = _fallback_search(user.id, query, after, limit + 1)
+
+    next_cursor = encode_cursor(hits[limit - 1].rank, hits[limit - 1].message.id) if len(hits) > limit else None
+    return SearchPage(hits[:limit], next_cursor)
+
+
+_RANKED_SQL = """
+    WITH search AS (SELECT websearch_to_tsquery(%(config)s::regconfig, %(query)s) AS query)
+    SELECT ranked.id, ranked.rank FROM (
+        SELECT m.id, ts_rank(to_tsvector(%(config)s::regconfig, COALESCE(m.content, '')), search.query) AS rank
+        FROM messaging_message m, search
+        WHERE m.conversation_id IN (
+            SELECT c.id FROM messaging_conversation c WHERE c.user_low_id = %(user)s OR c.user_high_id = %(user)s
+        )
+        AND to_tsvector(%(config)s::regconfig, COALESCE(m.content, '')) @@ search.query
+    ) ranked
+    WHERE %(rank)s::real IS NULL
+       OR ranked.rank < %(rank)s::real
+       OR (ranked.rank = %(rank)s::real AND ranked.id < %(id)s)
+    ORDER BY ranked.rank DESC, ranked.id DESC
+    LIMIT %(limit)s
+"""
+
+
+def _postgres_search(user_id, query, after, limit):
+    """
+    Rangs par l'index GIN, puis extraits pour la seule page
+
+    Deux requêtes : les (id, rang) de la page, puis les messages de la page
+    avec leur expéditeur et leur extrait ts_headline.
+    """
+    from django.contrib.postgres.search import SearchHeadline, SearchQuery
+
+    with connection.cursor() as cursor:
+        cursor.execute(_RANKED_SQL, {
+            'config': SEARCH_CONFIG,
+            'query': query,
+            'user': user_id,
+            'rank': after[0] if after else None,
+            'id': after[1] if after else None,
+            'limit': limit,
+        })
+        ranks = dict(cursor.fetchall())
+
+    messages = Message.objects.filter(id__in=ranks).select_related('sender', 'conversation').annotate(
+        snippet=SearchHeadline(
+            'content',
+            SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch'),
+            config=SEARCH_CONFIG,
+            start_sel=_START,
+            stop_sel=_STOP,
+            max_words=SNIPPET_WORDS,
+            min_words=5,
+            max_fragments=2,
+        )
+    )
+
+    hits = [SearchHit(message, ranks[message.id], _highlight(message.snippet)) for message in messages]
+    return sorted(hits, key=lambda hit: (hit.rank, hit.message.id), reverse=True)
+
+
+def _fold(text):
+    """Minuscules sans accents, caractère par caractère (même longueur que text)"""
+    return ''.join(unicodedata.normalize('NFKD', char.lower())[:1] or char for char in text)
+
+
+def _snippet(content, terms):
+    """Fenêtre de SNIPPET_WORDS mots autour de la première occurrence, mots trouvés surlignés"""
+    words = [(m.start(), m.end(), m.group() in terms) for m in WORD_RE.finditer(_fold(content))]
+    first = next((index for index, (_, _, hit) in enumerate(words) if hit), 0)
+    offset = max(0, first - SNIPPET_WORDS // 4)
+    window = words[offset:offset + SNIPPET_WORDS]
+
+    parts = ['…' if offset else '']
+    position = window[0][0] if offset else 0
+    for start, end, hit in window:
+        parts.append(content[position:start])
+        parts.append(f'{_START}{content[start:end]}{_STOP}' if hit else content[start:end])
+        position = end
+
+    # Ponctuation finale gardée si la fenêtre va jusqu'au dernier mot
+    parts.append('…' if offset + SNIPPET_WORDS < len(words) else content[position:])
+    return _highlight(''.join(parts))
+
+
+def _fallback_search(user_id, query, after, limit):
+    """Recherche de repli en Python, sur les messages des conversations de l'utilisateur"""
+    terms = set(WORD_RE.findall(_fold(query)))
+    if not terms:
+        return []
+
+    hits = []
+    messages = Message.objects.filter(conversation_id__in=_user_conversations(user_id)).select_related(
+        'sender', 'conversation'
+    )
+    for message in messages.iterator(chunk_size=2000):
+        words = WORD_RE.findall(_fold(message.content))
+        if not terms.issubset(words):
+            continue
+
+        # Fréquence des mots cherchés, normalisée par la longueur comme ts_rank
+        rank = sum(word in terms for word in words) / (1 + math.log(len(words)))
+        if after is None or (rank, message.id) < after:
+            hits.append((rank, message))
+
+    hits.sort(key=lambda hit: (hit[0], hit[1].id), reverse=True)
+    return [SearchHit(message, rank, _snippet(message.content, terms)) for rank, message in hits[:limit]]
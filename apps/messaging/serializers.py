@@ -1,6 +1,11 @@
 ﻿from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.utils import timezone
+from .delivery import DeliveryError, send_message
 from .models import Conversation, Message
+from .presence import is_online
+from .uploads import SNIFF_BYTES, UploadError, check_declared, claim_upload, sniff
+from .utils import get_or_create_conversation
 
 User = get_user_model()
 
@@ -16,46 +21,133 @@ class UserSerializer(serializers.ModelSerializer):
         return obj.get_full_name() or obj.username
 
 
+def format_time_display(created_at):
+    """Formate l'heure d'affichage d'un message"""
+    diff = timezone.now() - created_at
+    
+    if diff.days == 0:
+        return created_at.strftime('%H:%M')
+    elif diff.days == 1:
+        return 'Hier'
+    elif diff.days < 7:
+        return created_at.strftime('%A')
+    else:
+        return created_at.strftime('%d/%m/%Y')
+
+
+def user_payload(user):
+    """Même forme que UserSerializer, sans passer par DRF"""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'full_name': user.get_full_name() or user.username,
+    }
+
+
+def message_payload(message, sender_data):
+    """
+    Même forme que MessageSerializer, pour les diffusions WebSocket
+    
+    L'expéditeur est déjà sérialisé (une fois par connexion), ce qui évite
+    de recharger l'utilisateur et d'instancier les champs DRF à chaque message.
+    is_read doit avoir été renseigné par apply_read_flags, sauf pour un
+    message qui vient d'être inséré (personne ne l'a encore lu).
+    """
+    created_at = timezone.localtime(message.created_at).isoformat()
+    if created_at.endswith('+00:00'):
+        created_at = created_at[:-6] + 'Z'
+    
+    return {
+        'id': message.id,
+        'conversation': message.conversation_id,
+        'sender': sender_data,
+        'content': message.content,
+        'is_read': message.is_read,
+        'created_at': created_at,
+        'time_display': format_time_display(message.created_at),
+        'attachment': message.attachment.url if message.attachment else None,
+        'attachment_thumbnail': message.attachment_thumbnail.url if message.attachment_thumbnail else None,
+        'client_id': str(message.client_id) if message.client_id else None,
+    }
+
+
 class MessageSerializer(serializers.ModelSerializer):
-    """Sérialiseur pour les messages"""
+    """
+    Sérialiseur pour les messages
+    
+    Les pièces jointes sont envoyées directement au stockage puis rattachées
+    par upload_token (voir uploads.py) ; un fichier joint à la requête reste
+    accepté, avec la même validation du contenu.
+    
+    Un message renvoyé avec le client_id d'un message déjà enregistré n'est
+    pas recréé (voir delivery.py) : created indique s'il a été inséré.
+    
+    is_read est en lecture seule et vient des curseurs de lecture : les
+    vues appellent apply_read_flags avant de sérialiser.
+    """
     sender = UserSerializer(read_only=True)
     time_display = serializers.SerializerMethodField()
+    upload_token = serializers.CharField(write_only=True, required=False)
     
     class Meta:
         model = Message
         fields = ['id', 'conversation', 'sender', 'content', 'is_read', 
-                  'created_at', 'time_display', 'attachment']
-        read_only_fields = ['sender', 'created_at']
+                  'created_at', 'time_display', 'attachment', 'attachment_thumbnail', 'client_id', 'upload_token']
+        read_only_fields = ['sender', 'is_read', 'created_at', 'attachment_thumbnail']
     
     def get_time_display(self, obj):
         """Formate l'heure d'affichage"""
-        from django.utils import timezone
-        now = timezone.now()
-        diff = now - obj.created_at
-        
-        if diff.days == 0:
-            return obj.created_at.strftime('%H:%M')
-        elif diff.days == 1:
-            return 'Hier'
-        elif diff.days < 7:
-            return obj.created_at.strftime('%A')
-        else:
-            return obj.created_at.strftime('%d/%m/%Y')
+        return format_time_display(obj.created_at)
+    
+    def validate_attachment(self, value):
+        if value:
+            try:
+                check_declared(value.name, value.size)
+                sniff(value.read(SNIFF_BYTES), value.name)
+            except UploadError as e:
+                raise serializers.ValidationError(str(e))
+            finally:
+                value.seek(0)
+        return value
+    
+    def validate(self, attrs):
+        token = attrs.pop('upload_token', None)
+        if token:
+            request = self.context.get('request')
+            conversation = attrs.get('conversation') or self.context.get('conversation')
+            if request is None or conversation is None:
+                raise serializers.ValidationError({'upload_token': "Conversation inconnue"})
+            try:
+                attrs['attachment'] = claim_upload(token, request.user, conversation.id)
+            except UploadError as e:
+                raise serializers.ValidationError({'upload_token': str(e)})
+        return attrs
+    
+    def create(self, validated_data):
+        try:
+            message, self.created = send_message(**validated_data)
+        except DeliveryError as e:
+            raise serializers.ValidationError({'client_id': str(e)})
+        return message
 
 
 class ConversationSerializer(serializers.ModelSerializer):
     """Sérialiseur pour les conversations"""
     participants = UserSerializer(many=True, read_only=True)
-    # Utiliser directement les champs annotés par la vue
-    last_message_content = serializers.CharField(read_only=True)
-    last_message_date = serializers.DateTimeField(read_only=True)
+    # Résumé dénormalisé porté par la conversation
+    last_message_content = serializers.CharField(source='last_message_preview', read_only=True)
+    last_message_date = serializers.DateTimeField(source='last_message_at', read_only=True)
     unread_count = serializers.IntegerField(read_only=True, default=0)
     other_participant = serializers.SerializerMethodField()
+    other_participant_online = serializers.SerializerMethodField()
     
     class Meta:
         model = Conversation
         fields = ['id', 'participants', 'last_message_content', 'last_message_date', 
-                  'unread_count', 'other_participant', 'product']
+                  'unread_count', 'other_participant', 'other_participant_online', 'product']
     
     def get_other_participant(self, obj):
         request = self.context.get('request')
@@ -64,6 +156,17 @@ class ConversationSerializer(serializers.ModelSerializer):
             if other:
                 return UserSerializer(other).data
         return None
+    
+    def get_other_participant_online(self, obj):
+        request = self.context.get('request')
+        if not (request and request.user):
+            return False
+        other = obj.get_other_participant(request.user)
+        if other is None:
+            return False
+        # Présence de toute la page lue en une fois par la vue, sinon une clé
+        online_ids = self.context.get('online_ids')
+        return other.id in online_ids if online_ids is not None else is_online(other.id)
 
 
 class ConversationCreateSerializer(serializers.Serializer):
@@ -85,18 +188,14 @@ class ConversationCreateSerializer(serializers.Serializer):
         recipient_id = validated_data['recipient_id']
         recipient = User.objects.get(id=recipient_id)
         
-        # Vérifier si une conversation existe déjà
-        existing = Conversation.objects.filter(
-            participants=sender
-        ).filter(
-            participants=recipient
-        ).first()
+        # Produit associé : il fait partie de la clé de la conversation
+        product = None
+        product_id = validated_data.get('product_id')
+        if product_id:
+            from apps.shops.models import Product
+            product = Product.objects.filter(id=product_id).first()
         
-        if existing:
-            conversation = existing
-        else:
-            conversation = Conversation.objects.create()
-            conversation.participants.add(sender, recipient)
+        conversation = get_or_create_conversation(sender, recipient, product)
         
         # Ajouter un message initial si fourni
         initial_message = validated_data.get('initial_message')
@@ -107,15 +206,4 @@ class ConversationCreateSerializer(serializers.Serializer):
                 content=initial_message
             )
         
-        # Lier à un produit si spécifié
-        product_id = validated_data.get('product_id')
-        if product_id:
-            from apps.shops.models import Product
-            try:
-                product = Product.objects.get(id=product_id)
-                conversation.product = product
-                conversation.save()
-            except Product.DoesNotExist:
-                pass
-        
         return conversation
\ No newline at end of file
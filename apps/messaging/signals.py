@@ -1,52 +1,95 @@
-﻿from django.db.models.signals import post_save, pre_delete
+﻿import logging
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from django.core.mail import send_mail
-from django.conf import settings
-from .models import Message, Conversation
+from django.db import transaction
+from .export import archive_conversation
+from .models import Message, Conversation, ModerationTerm
+from .moderation import bump_version
+from .read_state import ensure_cursors, increment_unread
+from .summary import record_message, refresh_last_message, refresh_pair
+from .tasks import process_messages
+from .utils import conversation_key, merge_conversations
+
+logger = logging.getLogger('messaging')
 
 @receiver(post_save, sender=Message)
-def notify_new_message(sender, instance, created, **kwargs):
+def enqueue_message_processing(sender, instance, created, **kwargs):
     """
-    Envoie une notification lorsqu'un nouveau message est créé
+    Planifie le traitement d'un nouveau message après le commit
+    
+    Notification et modération tournent dans la tâche
+    Celery process_messages (voir processors.py) : l'envoi d'un message ne
+    coûte qu'un INSERT dans la requête ou le consumer.
     """
     if created:
-        # Récupérer les destinataires (tous les participants sauf l'expéditeur)
-        recipients = instance.conversation.participants.exclude(
-            id=instance.sender.id
-        )
-        
-        for recipient in recipients:
-            # Vérifier si l'utilisateur a activé les notifications par email
-            # (à implémenter dans le profil utilisateur)
-            
-            # Exemple : envoi d'email
-            try:
-                send_mail(
-                    subject=f'Nouveau message de {instance.sender.username}',
-                    message=f'{instance.sender.username} vous a envoyé un message:\n\n{instance.content[:100]}...',
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[recipient.email],
-                    fail_silently=True,
-                )
-            except Exception as e:
-                print(f"Erreur d'envoi d'email: {e}")
-            
-            # Ici, vous pouvez aussi ajouter :
-            # - Notification push (Firebase, OneSignal, etc.)
-            # - Notification in-app
-            # - Webhook vers un service externe
+        message_id = instance.id
+        transaction.on_commit(lambda: _enqueue(message_id))
 
 
 @receiver(post_save, sender=Message)
-def update_conversation_timestamp(sender, instance, created, **kwargs):
+def count_unread_message(sender, instance, created, **kwargs):
     """
-    Met à jour le timestamp de la conversation lors de l'ajout d'un message
+    Incrémente les non-lus des autres participants dans la même transaction
+    
+    Reste synchrone (un UPDATE indexé) pour que les compteurs ne divergent
+    jamais des curseurs de lecture.
     """
     if created:
-        conversation = instance.conversation
-        # La mise à jour automatique via auto_now devrait suffire,
-        # mais on peut forcer si nécessaire
-        conversation.save(update_fields=['updated_at'])
+        increment_unread(instance)
+
+
+@receiver(post_save, sender=Message)
+def update_conversation_summary(sender, instance, created, **kwargs):
+    """
+    Reporte le nouveau message sur le résumé de la conversation
+    
+    Un UPDATE dans la même transaction que l'INSERT : la boîte de réception
+    n'est jamais en retard sur les messages.
+    """
+    if created:
+        record_message(instance)
+
+
+@receiver(post_delete, sender=Message)
+def refresh_conversation_summary(sender, instance, **kwargs):
+    """Recalcule le résumé si le dernier message de la conversation est supprimé"""
+    refresh_last_message(instance.conversation_id, instance.id)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def update_participant_pair(sender, instance, action, pk_set, reverse, **kwargs):
+    """Maintient la paire de participants de la conversation"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    
+    if not reverse:
+        refresh_pair(instance.pk)
+    elif pk_set:
+        # user.conversations.add(...) : instance est l'utilisateur
+        for conversation_id in pk_set:
+            refresh_pair(conversation_id)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def create_read_cursors(sender, instance, action, pk_set, reverse, **kwargs):
+    """Crée le curseur de lecture de chaque nouveau participant"""
+    if action != 'post_add' or not pk_set:
+        return
+    
+    if reverse:
+        # user.conversations.add(...) : instance est l'utilisateur
+        for conversation_id in pk_set:
+            ensure_cursors(conversation_id, [instance.pk])
+    else:
+        ensure_cursors(instance.pk, pk_set)
+
+
+def _enqueue(message_id):
+    # Un broker indisponible ne doit pas faire échouer l'envoi du message
+    try:
+        process_messages.delay([message_id])
+    except Exception as e:
+        logger.error(f'Impossible de planifier le traitement du message {message_id}: {e}')
 
 
 @receiver(post_save, sender=Conversation)
@@ -66,86 +109,17 @@ def log_conversation_creation(sender, instance, created, **kwargs):
 def archive_before_delete(sender, instance, **kwargs):
     """
     Archive une conversation avant sa suppression
-    """
-    import logging
-    from .utils import export_conversation_to_json
-    
-    logger = logging.getLogger('messaging')
     
-    # Exporter les données
+    L'export est écrit en flux dans le stockage de fichiers (voir
+    export.py) ; seul le nom de l'archive est journalisé.
+    """
     try:
-        data = export_conversation_to_json(instance)
-        logger.info(f'Conversation {instance.id} archivée avant suppression: {data}')
+        name = archive_conversation(instance)
+        logger.info(f'Conversation {instance.id} archivée avant suppression: {name}')
     except Exception as e:
         logger.error(f'Erreur lors de l\'archivage de la conversation {instance.id}: {e}')
 
 
-@receiver(post_save, sender=Message)
-def detect_spam_message(sender, instance, created, **kwargs):
-    """
-    Détecte les messages potentiellement spam
-    """
-    if created:
-        # Liste de mots-clés suspects (à personnaliser)
-        spam_keywords = [
-            'viagra', 'casino', 'lottery', 'winner',
-            'click here', 'buy now', 'limited offer'
-        ]
-        
-        content_lower = instance.content.lower()
-        
-        # Vérifier les mots-clés
-        for keyword in spam_keywords:
-            if keyword in content_lower:
-                import logging
-                logger = logging.getLogger('messaging')
-                logger.warning(
-                    f'Message potentiellement spam détecté: '
-                    f'ID={instance.id}, Sender={instance.sender.username}, '
-                    f'Keyword={keyword}'
-                )
-                
-                # Optionnel : marquer le message ou notifier les admins
-                # instance.is_spam = True
-                # instance.save()
-                break
-
-
-@receiver(post_save, sender=Message)
-def track_user_activity(sender, instance, created, **kwargs):
-    """
-    Enregistre l'activité de l'utilisateur
-    """
-    if created:
-        # Mettre à jour le last_activity de l'utilisateur
-        # (nécessite un champ last_activity dans le modèle User ou UserProfile)
-        
-        from django.utils import timezone
-        user = instance.sender
-        
-        # Si vous avez un profil utilisateur avec last_activity
-        if hasattr(user, 'profile'):
-            user.profile.last_activity = timezone.now()
-            user.profile.save(update_fields=['last_activity'])
-
-
-@receiver(post_save, sender=Message)
-def check_message_length(sender, instance, created, **kwargs):
-    """
-    Vérifie la longueur des messages et log les messages très longs
-    """
-    if created:
-        max_normal_length = 1000
-        
-        if len(instance.content) > max_normal_length:
-            import logging
-            logger = logging.getLogger('messaging')
-            logger.info(
-                f'Message très long détecté: '
-                f'ID={instance.id}, Length={len(instance.content)}'
-            )
-
-
 @receiver(post_save, sender=Conversation)
 def create_welcome_message(sender, instance, created, **kwargs):
     """
@@ -162,87 +136,35 @@ def create_welcome_message(sender, instance, created, **kwargs):
         # create_system_message(instance, welcome_text)
 
 
-@receiver(post_save, sender=Message)
-def auto_translate_message(sender, instance, created, **kwargs):
+@receiver(post_save, sender=ModerationTerm)
+@receiver(post_delete, sender=ModerationTerm)
+def refresh_moderation_terms(sender, instance, **kwargs):
     """
-    Traduction automatique des messages (optionnel)
-    Nécessite une API de traduction (Google Translate, DeepL, etc.)
-    """
-    if created:
-        # Exemple de logique de traduction
-        # Si les utilisateurs ont des langues différentes
-        pass
-        
-        # from googletrans import Translator
-        # translator = Translator()
-        # translated = translator.translate(instance.content, dest='fr')
-        # instance.translated_content = translated.text
-        # instance.save()
-
-
-@receiver(post_save, sender=Message)
-def moderate_content(sender, instance, created, **kwargs):
-    """
-    Modération automatique du contenu
+    Publie une nouvelle version de la liste des termes après le commit
+    
+    Les workers reconstruisent leur automate au prochain lot de messages.
     """
-    if created:
-        # Liste de mots interdits (à personnaliser)
-        forbidden_words = ['insulte1', 'insulte2', 'mot_interdit']
-        
-        content_lower = instance.content.lower()
-        
-        for word in forbidden_words:
-            if word in content_lower:
-                import logging
-                logger = logging.getLogger('messaging')
-                logger.warning(
-                    f'Contenu inapproprié détecté: '
-                    f'ID={instance.id}, Sender={instance.sender.username}'
-                )
-                
-                # Optionnel : modérer le message
-                # instance.is_moderated = True
-                # instance.content = "[Message modéré]"
-                # instance.save()
-                break
+    transaction.on_commit(bump_version)
 
 
-@receiver(post_save, sender=Message)
-def send_realtime_notification(sender, instance, created, **kwargs):
+@receiver(pre_delete, sender='shops.Product')
+def merge_product_conversations(sender, instance, **kwargs):
     """
-    Envoie une notification en temps réel via WebSocket
-    """
-    if created:
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
-        channel_layer = get_channel_layer()
-        conversation_group_name = f'chat_{instance.conversation.id}'
-        
-        # Notifier tous les participants via WebSocket
-        # (déjà géré dans le consumer, mais on peut ajouter des notifications supplémentaires)
-        
-        # Exemple : envoyer une notification globale
-        # async_to_sync(channel_layer.group_send)(
-        #     'notifications',
-        #     {
-        #         'type': 'new_message_notification',
-        #         'conversation_id': instance.conversation.id,
-        #         'sender': instance.sender.username
-        #     }
-        # )
-
-
-# N'oubliez pas d'importer les signaux dans apps.py
-"""
-# messaging/apps.py
-
-from django.apps import AppConfig
-
-class MessagingConfig(AppConfig):
-    default_auto_field = 'django.db.models.BigAutoField'
-    name = 'messaging'
+    Fusionne les conversations d'un produit supprimé dans la conversation générale de leur paire
+    
+    Sans cela, product passerait à NULL et la conversation entrerait en
+    conflit avec la conversation sans produit de la même paire.
     
-    def ready(self):
-        import messaging.signals  # Importer les signaux
-"""
\ No newline at end of file
+    Sans conversation générale, la conversation le devient tout de suite :
+    lors d'une suppression groupée (boutique, queryset de produits), tous les
+    pre_delete passent avant le SET_NULL, et les conversations des produits
+    suivants de la même paire y sont alors fusionnées.
+    """
+    for conversation in Conversation.objects.filter(product=instance, user_low__isnull=False):
+        general = Conversation.objects.filter(
+            **conversation_key(conversation.user_low_id, conversation.user_high_id)
+        ).first()
+        if general:
+            merge_conversations(general, [conversation])
+        else:
+            Conversation.objects.filter(id=conversation.id).update(product=None)
\ No newline at end of file
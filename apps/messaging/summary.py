@@ -0,0 +1,104 @@
+"""
+Résumé dénormalisé des conversations pour la boîte de réception
+
+Chaque conversation porte l'id, un extrait et la date de son dernier message,
+ainsi que la paire de ses participants (id le plus petit, id le plus grand).
+Le résumé est mis à jour par un seul UPDATE à l'insertion d'un message, et la
+boîte de réception se lit par l'index des participants (une ligne par
+conversation de l'utilisateur), sans sous-requête ni requête par ligne.
+"""
+
+from django.db.models import F, FilteredRelation, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+from .models import Conversation, Message
+
+PREVIEW_LENGTH = 255
+
+
+def preview(content):
+    """Extrait du contenu d'un message stocké sur la conversation"""
+    return (content or '')[:PREVIEW_LENGTH]
+
+
+def record_message(message):
+    """
+    Reporte un nouveau message sur le résumé de sa conversation
+
+    L'UPDATE est gardé par l'id : un message plus ancien qui serait enregistré
+    après un plus récent ne remplace pas le résumé.
+    """
+    return Conversation.objects.filter(
+        Q(last_message_id__isnull=True) | Q(last_message_id__lt=message.id),
+        id=message.conversation_id,
+    ).update(
+        last_message_id=message.id,
+        last_message_preview=preview(message.content),
+        last_message_at=message.created_at,
+        updated_at=message.created_at,
+    )
+
+
+def refresh_last_message(conversation_id, deleted_message_id=None):
+    """
+    Recalcule le résumé à partir des messages de la conversation
+
+    Un seul UPDATE. Après une suppression, sans effet si le message supprimé
+    (deleted_message_id) n'était pas le dernier.
+    """
+    conversations = Conversation.objects.filter(id=conversation_id)
+    if deleted_message_id is not None:
+        conversations = conversations.filter(last_message_id=deleted_message_id)
+    return _refresh(conversations)
+
+
+def refresh_after_purge(deleted_message_ids):
+    """
+    Recalcule en un UPDATE le résumé des conversations dont le dernier
+    message fait partie d'un lot supprimé sans signaux (voir retention.py)
+    """
+    return _refresh(Conversation.objects.filter(last_message_id__in=deleted_message_ids))
+
+
+def _refresh(conversations):
+    latest = Message.objects.filter(conversation_id=OuterRef('pk')).order_by('-id')
+    return conversations.update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_message_preview=Coalesce(Subquery(latest.annotate(
+            extract=Substr('content', 1, PREVIEW_LENGTH)
+        ).values('extract')[:1]), Value('')),
+        last_message_at=Subquery(latest.values('created_at')[:1]),
+    )
+
+
+def refresh_pair(conversation_id):
+    """
+    Recalcule la paire de participants d'une conversation
+
+    Les conversations de plus de deux participants n'ont pas de paire.
+    """
+    user_ids = sorted(
+        Conversation.participants.through.objects.filter(conversation_id=conversation_id).values_list(
+            'user_id', flat=True
+        )
+    )
+
+    if 1 <= len(user_ids) <= 2:
+        low, high = user_ids[0], user_ids[-1]
+    else:
+        low = high = None
+
+    return Conversation.objects.filter(id=conversation_id).update(user_low_id=low, user_high_id=high)
+
+
+def inbox_queryset(user):
+    """
+    Conversations de user, de la plus récemment active à la plus ancienne
+
+    Filtrée par les participants et non par la paire : les conversations de
+    groupe, sans paire, en font partie. Les deux utilisateurs de la paire et
+    le curseur de lecture de user sont joints dans la même requête.
+    """
+    return Conversation.objects.filter(participants=user).select_related('user_low', 'user_high').annotate(
+        own_cursor=FilteredRelation('read_cursors', condition=Q(read_cursors__user=user)),
+        unread_count=Coalesce(F('own_cursor__unread_count'), 0),
+    ).order_by(F('last_message_at').desc(nulls_last=True), '-id')
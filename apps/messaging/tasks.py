@@ -0,0 +1,89 @@
+"""
+Tâches Celery de la messagerie
+
+- Traitement asynchrone des nouveaux messages (notification et
+  modération), voir processors.py
+- Envoi des résumés de notifications email, voir digests.py
+- Instantané nocturne des statistiques par utilisateur, voir analytics.py
+- Archivage et suppression des messages anciens, voir retention.py
+"""
+
+import logging
+from celery import shared_task
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import Message
+from .analytics import active_user_ids, rollup_user_stats
+from .digests import bucket_recipients, send_digests
+from .processors import run_processors
+from .retention import purge_old_messages
+
+logger = logging.getLogger('messaging')
+
+
+@shared_task
+def process_messages(message_ids):
+    """
+    Exécute la chaîne de processeurs sur des messages nouvellement créés
+    
+    Les messages sont chargés par lots avec leur expéditeur, leur
+    conversation et ses participants (trois requêtes par lot).
+    """
+    batch_size = settings.MESSAGE_PROCESSING_BATCH_SIZE
+    message_ids = sorted(message_ids)
+    
+    for start in range(0, len(message_ids), batch_size):
+        messages = list(
+            Message.objects.filter(id__in=message_ids[start:start + batch_size])
+            .select_related('sender', 'conversation')
+            .prefetch_related('conversation__participants')
+            .order_by('id')
+        )
+        
+        if messages:
+            run_processors(messages)
+
+
+@shared_task
+def send_message_digests(bucket=None, recipient_ids=None, force=False):
+    """
+    Envoie les résumés email en attente
+    
+    Args:
+        bucket: Tranche de temps dont les destinataires sont à traiter
+        recipient_ids: Destinataires explicites (taille de lot atteinte)
+        force: Envoyer même si la fenêtre de silence n'est pas écoulée
+    """
+    if recipient_ids is None:
+        recipient_ids = bucket_recipients(bucket)
+    
+    if not recipient_ids:
+        return None
+    
+    summary = send_digests(recipient_ids, force=force)
+    logger.info(
+        f"Résumés email: {summary['sent']} envoyés, {summary['skipped_online']} ignorés (en ligne), "
+        f"{summary['rescheduled']} replanifiés"
+    )
+    return summary
+
+
+@shared_task
+def rollup_messaging_stats(days=1):
+    """
+    Fige les statistiques des utilisateurs actifs ces derniers jours
+    
+    Seuls les utilisateurs dont une conversation a reçu un message depuis
+    days jours sont recalculés ; les autres instantanés restent valables.
+    """
+    user_ids = active_user_ids(timezone.now() - timedelta(days=days))
+    written = rollup_user_stats(user_ids)
+    logger.info(f"Statistiques de messagerie: {written} utilisateur(s) recalculé(s)")
+    return written
+
+
+@shared_task
+def archive_old_messages(max_batches=None):
+    """Archive puis supprime les messages au-delà de la durée de rétention, par lots"""
+    return purge_old_messages(max_batches=max_batches)
@@ -1,12 +1,46 @@
 import pytest
+import gzip
 import json
+import os
 import random
+import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
 from channels.testing import WebsocketCommunicator
+from django.contrib import admin
 from django.contrib.auth import get_user_model
+from django.core import mail
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 from channels.db import database_sync_to_async
 
 from pimarket.asgi import application  # Assurez-vous que le chemin est correct
-from .models import Conversation
+from apps.accounts.middleware import USER_CACHE_FIELDS, resolve_user, user_cache_key
+from apps.shops.models import Product, Shop
+from .models import Conversation, Message, ModerationTerm, ReadCursor
+from .moderation import ModerationMatch, TermMatcher
+from .processors import PROCESSORS
+from .tasks import process_messages, rollup_messaging_stats, send_message_digests
+from . import (
+    delivery, digests, export, history, loadtest, moderation, presence, read_state, retention, search, summary, uploads,
+)
+from .serializers import MessageSerializer, message_payload, user_payload
+from .utils import (
+    calculate_average_response_time, conversation_key, export_conversation_to_json, get_conversation_between_users,
+    get_message_delivery_status, get_or_create_conversation, get_popular_contacts, get_user_messaging_stats,
+)
 
 User = get_user_model()
 
@@ -14,6 +48,12 @@ User = get_user_model()
 pytestmark = [pytest.mark.django_db, pytest.mark.asyncio]
 
 
+@pytest.fixture(autouse=True)
+def media_root(settings, tmp_path):
+    """Archives et exports écrits par les tests hors du dépôt"""
+    settings.MEDIA_ROOT = str(tmp_path)
+
+
 @pytest.fixture
 async def test_users():
     """Fixture pour créer deux utilisateurs de test."""
@@ -58,6 +98,17 @@ class TestChatConsumer:
         connected2, _ = await communicator2.connect()
         assert connected2, "L'utilisateur 2 n'a pas pu se connecter."
 
+        # Chaque connexion reçoit d'abord la confirmation
+        for communicator in (communicator1, communicator2):
+            data = json.loads(await communicator.receive_from())
+            assert data['type'] == 'connection_established'
+
+        # L'utilisateur 1 est prévenu que l'utilisateur 2 vient de passer en ligne
+        presence_event = json.loads(await communicator1.receive_from())
+        assert presence_event == {
+            'type': 'presence', 'conversation_id': conversation_id, 'user_id': user2.id, 'online': True
+        }
+
         # L'utilisateur 1 envoie un message
         test_message = "Bonjour, monde !"
         await communicator1.send_to(text_data=json.dumps({
@@ -80,4 +131,1219 @@ class TestChatConsumer:
 
         # Fermer les connexions
         await communicator1.disconnect()
-        await communicator2.disconnect()
\ No newline at end of file
+        await communicator2.disconnect()
+
+    async def test_backfill_returns_only_missed_messages(self, test_conversation):
+        """Un client reconnecté récupère exactement les messages manqués."""
+        conversation = await test_conversation
+        user1 = await conversation.participants.order_by('id').afirst()
+        seen = await Message.objects.acreate(conversation=conversation, sender=user1, content='vu')
+        for index in range(3):
+            await Message.objects.acreate(conversation=conversation, sender=user1, content=f'manqué {index}')
+
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+        communicator.scope['user'] = user1
+        await communicator.connect()
+        await communicator.receive_from()
+
+        await communicator.send_to(text_data=json.dumps({'type': 'backfill', 'after': seen.id, 'limit': 2}))
+        first = json.loads(await communicator.receive_from())
+        await communicator.send_to(text_data=json.dumps({'type': 'backfill', 'after': first['messages'][-1]['id']}))
+        second = json.loads(await communicator.receive_from())
+
+        assert (first['type'], first['has_more'], second['has_more']) == ('backfill', True, False)
+        assert [m['content'] for m in first['messages'] + second['messages']] == ['manqué 0', 'manqué 1', 'manqué 2']
+        assert first['messages'][0]['sender']['username'] == user1.username
+        await communicator.disconnect()
+
+    async def test_presence_changes_are_published_once_per_user(self, test_conversation):
+        """Seuls la première connexion et la dernière déconnexion sont publiées."""
+        conversation = await test_conversation
+        user1, user2 = await database_sync_to_async(list)(conversation.participants.order_by('id'))
+
+        async def connect(user):
+            communicator = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+            communicator.scope['user'] = user
+            await communicator.connect()
+            await communicator.receive_from()
+            return communicator
+
+        watcher = await connect(user1)
+        first = await connect(user2)
+        second = await connect(user2)
+        assert json.loads(await watcher.receive_from())['online'] is True
+        assert await database_sync_to_async(presence.online_user_ids)([user1.id, user2.id]) == {user1.id, user2.id}
+
+        await first.disconnect()
+        assert await watcher.receive_nothing()
+        await second.disconnect()
+        assert json.loads(await watcher.receive_from()) == {
+            'type': 'presence', 'conversation_id': conversation.id, 'user_id': user2.id, 'online': False
+        }
+        assert not await database_sync_to_async(presence.is_online)(user2.id)
+        await watcher.disconnect()
+
+    async def test_typing_frames_are_coalesced_and_expire(self, test_conversation, settings):
+        """Une rafale de trames typing ne produit qu'un début et une fin de frappe."""
+        settings.MESSAGING_TYPING_INTERVAL = 0.05
+        settings.MESSAGING_TYPING_TIMEOUT = 0.1
+        conversation = await test_conversation
+        user1, user2 = await database_sync_to_async(list)(conversation.participants.order_by('id'))
+
+        communicators = []
+        for user in (user1, user2):
+            communicator = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+            communicator.scope['user'] = user
+            await communicator.connect()
+            await communicator.receive_from()
+            communicators.append(communicator)
+        typist, watcher = communicators
+        await typist.receive_from()  # présence de user2
+
+        for _ in range(10):
+            await typist.send_to(text_data=json.dumps({'type': 'typing', 'is_typing': True}))
+
+        events = [json.loads(await watcher.receive_from(timeout=1)) for _ in range(2)]
+        assert [event['is_typing'] for event in events] == [True, False]
+        assert await watcher.receive_nothing(timeout=0.2)
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_inbound_frames_are_rate_limited(self, test_conversation, settings):
+        """Au-delà de la rafale autorisée, les trames sont ignorées avec une seule erreur."""
+        settings.MESSAGING_SOCKET_BURST = 3
+        settings.MESSAGING_SOCKET_RATE = 0.001
+        conversation = await test_conversation
+        user1 = await conversation.participants.order_by('id').afirst()
+
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+        communicator.scope['user'] = user1
+        await communicator.connect()
+        await communicator.receive_from()
+
+        for index in range(6):
+            await communicator.send_to(text_data=json.dumps({'type': 'chat_message', 'message': f'm{index}'}))
+
+        replies = [json.loads(await communicator.receive_from()) for _ in range(4)]
+        assert [reply['type'] for reply in replies].count('chat_message') == 3
+        assert [reply['type'] for reply in replies].count('error') == 1
+        assert await communicator.receive_nothing()
+        assert await Message.objects.filter(conversation=conversation).acount() == 3
+        await communicator.disconnect()
+
+    async def test_non_participant_is_rejected(self, test_conversation):
+        """Un utilisateur hors de la conversation ne peut pas se connecter."""
+        conversation = await test_conversation
+        outsider = await User.objects.acreate(username='outsider', phone_number='+33312345678')
+
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+        communicator.scope['user'] = outsider
+        connected, _ = await communicator.connect()
+        assert not connected
+
+    async def test_single_socket_multiplexes_conversations(self, test_conversation):
+        """Un socket par utilisateur s'abonne à plusieurs conversations par commandes."""
+        conversation = await test_conversation
+        user1, user2 = await database_sync_to_async(list)(conversation.participants.order_by('id'))
+        user3 = await User.objects.acreate(username='user3', phone_number=f'+333{random.randint(10000, 99999)}')
+        other = await Conversation.objects.acreate()
+        await other.participants.aadd(user1, user3)
+        foreign = await Conversation.objects.acreate()
+        await foreign.participants.aadd(user2, user3)
+
+        communicator = WebsocketCommunicator(application, "/ws/messaging/")
+        communicator.scope['user'] = user1
+        connected, _ = await communicator.connect()
+        assert connected
+        assert json.loads(await communicator.receive_from())['type'] == 'connection_established'
+
+        await communicator.send_to(text_data=json.dumps({
+            'type': 'subscribe',
+            'conversation_ids': [conversation.id, other.id, foreign.id]
+        }))
+        replies = [json.loads(await communicator.receive_from()) for _ in range(3)]
+        assert [(reply['type'], reply['conversation_id']) for reply in replies] == [
+            ('subscribed', conversation.id), ('subscribed', other.id), ('error', foreign.id)
+        ]
+
+        for target in (conversation, other):
+            await communicator.send_to(text_data=json.dumps({
+                'type': 'chat_message', 'conversation_id': target.id, 'message': f'pour {target.id}'
+            }))
+            data = json.loads(await communicator.receive_from())
+            assert data['message']['content'] == f'pour {target.id}'
+
+        await communicator.send_to(text_data=json.dumps({'type': 'unsubscribe', 'conversation_id': other.id}))
+        assert json.loads(await communicator.receive_from()) == {'type': 'unsubscribed', 'conversation_id': other.id}
+        await communicator.send_to(text_data=json.dumps({
+            'type': 'chat_message', 'conversation_id': other.id, 'message': 'refusé'
+        }))
+        assert json.loads(await communicator.receive_from())['type'] == 'error'
+        assert await Message.objects.filter(conversation=other).acount() == 1
+        await communicator.disconnect()
+
+    async def test_inbox_update_reaches_unsubscribed_socket(self, test_conversation):
+        """Les nouveaux messages d'une conversation non abonnée arrivent par le groupe de l'utilisateur."""
+        conversation = await test_conversation
+        user1, user2 = await database_sync_to_async(list)(conversation.participants.order_by('id'))
+
+        communicator = WebsocketCommunicator(application, "/ws/messaging/")
+        communicator.scope['user'] = user2
+        await communicator.connect()
+        await communicator.receive_from()
+
+        message = await Message.objects.acreate(conversation=conversation, sender=user1, content='Coucou')
+        await database_sync_to_async(process_messages)([message.id])
+
+        data = json.loads(await communicator.receive_from())
+        assert data['type'] == 'inbox_update'
+        assert (data['conversation_id'], data['message_id'], data['preview']) == (conversation.id, message.id, 'Coucou')
+        await communicator.disconnect()
+
+    async def test_resent_message_with_client_id_is_stored_and_broadcast_once(self, test_conversation):
+        """Un renvoi après coupure (même client_id) n'est confirmé qu'à l'expéditeur."""
+        conversation = await test_conversation
+        user1, user2 = await database_sync_to_async(list)(conversation.participants.order_by('id'))
+
+        sender = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+        sender.scope['user'] = user1
+        await sender.connect()
+        await sender.receive_from()
+        recipient = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+        recipient.scope['user'] = user2
+        await recipient.connect()
+        await recipient.receive_from()
+        await sender.receive_from()  # présence de l'utilisateur 2
+
+        frame = json.dumps({'type': 'chat_message', 'message': 'Une fois', 'client_id': str(uuid.uuid4())})
+        await sender.send_to(text_data=frame)
+        first = json.loads(await sender.receive_from())
+        assert json.loads(await recipient.receive_from()) == first
+
+        await sender.send_to(text_data=frame)
+        resent = json.loads(await sender.receive_from())
+        assert resent['message']['id'] == first['message']['id']
+        assert resent['message']['client_id'] == first['message']['client_id']
+        assert await recipient.receive_nothing()
+        assert await Message.objects.filter(conversation=conversation, content='Une fois').acount() == 1
+
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    async def test_batched_ack_sends_one_receipt_to_the_sender(self, test_conversation):
+        """Une trame ack acquitte plusieurs messages et l'expéditeur reçoit les nouvelles positions."""
+        conversation = await test_conversation
+        user1, user2 = await database_sync_to_async(list)(conversation.participants.order_by('id'))
+        messages = [
+            await Message.objects.acreate(conversation=conversation, sender=user1, content=f'message {index}')
+            for index in range(3)
+        ]
+
+        sender = WebsocketCommunicator(application, "/ws/messaging/")
+        sender.scope['user'] = user1
+        await sender.connect()
+        await sender.receive_from()
+        recipient = WebsocketCommunicator(application, f"/ws/chat/{conversation.id}/")
+        recipient.scope['user'] = user2
+        await recipient.connect()
+        await recipient.receive_from()
+
+        ack = {'type': 'ack', 'delivered': [m.id for m in messages], 'read': [messages[0].id]}
+        await recipient.send_to(text_data=json.dumps(ack))
+        assert json.loads(await sender.receive_from()) == {
+            'type': 'receipt', 'conversation_id': conversation.id, 'user_id': user2.id,
+            'delivered_up_to': messages[-1].id, 'read_up_to': messages[0].id,
+        }
+
+        # Un accusé rejoué ne fait plus avancer les curseurs : rien n'est envoyé
+        await recipient.send_to(text_data=json.dumps(ack))
+        assert await sender.receive_nothing()
+        statuses = await database_sync_to_async(lambda: [get_message_delivery_status(m) for m in messages])()
+        assert statuses == ['read', 'delivered', 'delivered']
+
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    async def test_broadcast_payload_matches_message_serializer(self, test_conversation):
+        """Le sérialiseur léger produit la même forme que MessageSerializer."""
+        conversation = await test_conversation
+        user1 = await conversation.participants.order_by('id').afirst()
+        message = await Message.objects.acreate(conversation=conversation, sender=user1, content='Salut')
+
+        expected = await database_sync_to_async(lambda: dict(MessageSerializer(message).data))()
+        expected['sender'] = dict(expected['sender'])
+        assert message_payload(message, user_payload(user1)) == expected
+
+
+class TestTokenAuthentication:
+    """Connexion des clients mobiles aux WebSockets par jeton JWT."""
+
+    async def connect(self, path, headers=None):
+        communicator = WebsocketCommunicator(application, path, headers=headers or [])
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_bearer_token_connects_without_session(self, test_users):
+        user1, _ = await test_users
+        token = str(AccessToken.for_user(user1))
+
+        communicator, connected = await self.connect('/ws/messaging/', [(b'authorization', f'Bearer {token}'.encode())])
+        assert connected
+        assert json.loads(await communicator.receive_from())['type'] == 'connection_established'
+        await communicator.disconnect()
+
+        # Reconnexion : l'utilisateur vient du cache, sans lecture de la table
+        await User.objects.filter(id=user1.id).aupdate(username='renommé')
+        communicator, connected = await self.connect(f'/ws/messaging/?token={token}')
+        assert connected
+        assert (await resolve_user(token)).username == 'user1'
+        await communicator.disconnect()
+
+        # Seule l'identité publique est en cache, jamais le mot de passe
+        cached = await cache.aget(user_cache_key(user1.id))
+        assert set(cached) == set(USER_CACHE_FIELDS) and 'password' not in cached
+
+    async def test_saving_the_user_clears_the_cache(self, test_users):
+        user1, _ = await test_users
+        token = str(AccessToken.for_user(user1))
+        assert (await resolve_user(token)).id == user1.id
+
+        user1.is_active = False
+        await database_sync_to_async(user1.save)()
+
+        assert not (await resolve_user(token)).is_authenticated
+        _, connected = await self.connect(f'/ws/messaging/?token={token}')
+        assert not connected
+
+    async def test_invalid_token_is_rejected(self):
+        _, connected = await self.connect('/ws/messaging/?token=invalide')
+        assert not connected
+
+
+class TestMessageProcessing(TestCase):
+    """Traitement des nouveaux messages hors du chemin d'envoi."""
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(username='alice', phone_number='+33600000001', email='alice@example.com')
+        self.recipient = User.objects.create(username='bob', phone_number='+33600000002', email='bob@example.com')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.sender, self.recipient)
+
+    def test_sending_a_message_defers_processing(self):
+        with mock.patch('apps.messaging.signals.process_messages') as task:
+            with self.captureOnCommitCallbacks() as callbacks:
+                # L'INSERT, l'incrément des curseurs de lecture et le résumé de la conversation
+                with self.assertNumQueries(3):
+                    message = Message.objects.create(conversation=self.conversation, sender=self.sender,
+                                                     content='Bonjour')
+
+            task.delay.assert_not_called()
+            callbacks[0]()
+            task.delay.assert_called_once_with([message.id])
+
+    def test_processors_run_on_the_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            # Semé par la migration 0002 : ne pas le recréer (term est unique)
+            ModerationTerm.objects.update_or_create(term='buy now', defaults={'category': 'spam', 'is_active': True})
+        messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.sender, content='Buy now !'),
+            Message.objects.create(conversation=self.conversation, sender=self.recipient, content='Non merci'),
+        ]
+
+        with mock.patch.object(send_message_digests, 'apply_async'):
+            with self.assertLogs('messaging', level='WARNING') as logs:
+                process_messages([m.id for m in messages])
+
+        assert mail.outbox == []
+        send_message_digests(recipient_ids=[self.sender.id, self.recipient.id], force=True)
+        assert {email.to[0] for email in mail.outbox} == {'alice@example.com', 'bob@example.com'}
+        assert any('spam' in line for line in logs.output)
+        self.conversation.refresh_from_db()
+        assert self.conversation.updated_at == messages[-1].created_at
+
+    def test_failing_processor_does_not_stop_the_chain(self):
+        message = Message.objects.create(conversation=self.conversation, sender=self.sender, content='Salut')
+        calls = []
+
+        with mock.patch.dict(PROCESSORS, {'notify': mock.Mock(side_effect=RuntimeError('SMTP')),
+                                          'activity': calls.append}, clear=True):
+            with self.assertLogs('messaging', level='ERROR'):
+                process_messages([message.id])
+
+        assert [[m.id for m in batch] for batch in calls] == [[message.id]]
+
+
+
+@override_settings(MESSAGE_DIGEST_QUIET_SECONDS=300, MESSAGE_DIGEST_BATCH_SIZE=5)
+class TestMessageDigests(TestCase):
+    """Regroupement des notifications email par destinataire."""
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(username='alice', phone_number='+33600000001')
+        self.recipient = User.objects.create(username='bob', phone_number='+33600000002', email='bob@example.com')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.sender, self.recipient)
+        self.now = 1_000_000.0
+        patcher = mock.patch('apps.messaging.digests.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, count):
+        for n in range(count):
+            message = Message.objects.create(conversation=self.conversation, sender=self.sender,
+                                             content=f'Message {n}')
+            digests.queue_notification(self.recipient, message)
+
+    def test_messages_are_sent_as_one_digest_after_the_quiet_window(self):
+        with mock.patch.object(send_message_digests, 'apply_async') as schedule:
+            self.queue(3)
+
+        schedule.assert_called_once()
+        assert mail.outbox == []
+
+        self.now += schedule.call_args.kwargs['countdown']
+        summary = send_message_digests(**schedule.call_args.kwargs['kwargs'])
+
+        assert summary['sent'] == 1
+        assert len(mail.outbox) == 1
+        assert mail.outbox[0].subject == '3 nouveaux messages de alice'
+        assert 'alice: Message 2' in mail.outbox[0].body
+
+    def test_recipient_still_receiving_is_rescheduled(self):
+        with mock.patch.object(send_message_digests, 'apply_async') as schedule:
+            self.queue(1)
+            bucket = schedule.call_args.kwargs['kwargs']['bucket']
+            self.now += 500
+            self.queue(1)
+            self.now += 100
+            summary = send_message_digests(bucket=bucket)
+
+        assert summary['rescheduled'] == 1
+        assert mail.outbox == []
+
+    def test_batch_size_flushes_immediately(self):
+        with mock.patch.object(send_message_digests, 'apply_async'), \
+                mock.patch.object(send_message_digests, 'delay') as flush:
+            self.queue(5)
+
+        flush.assert_called_once_with(recipient_ids=[self.recipient.id], force=True)
+
+    def test_online_recipient_is_skipped(self):
+        with mock.patch.object(send_message_digests, 'apply_async'):
+            self.queue(2)
+        async_to_sync(presence.mark_online)(self.recipient.id)
+
+        summary = send_message_digests(recipient_ids=[self.recipient.id], force=True)
+
+        assert summary['skipped_online'] == 1
+        assert mail.outbox == []
+
+    def test_item_being_written_is_not_skipped(self):
+        with mock.patch.object(send_message_digests, 'apply_async'):
+            self.queue(2)
+        queue = digests.QUEUE_KEY.format(self.recipient.id)
+        # Index attribué par incr, élément pas encore écrit
+        in_flight = cache.incr(f'{queue}:n')
+
+        assert [item['content'] for item in digests._take_pending(self.recipient.id)] == ['Message 0', 'Message 1']
+
+        cache.set(f'{queue}:{in_flight}', {'email': 'bob@example.com', 'sender': 'alice', 'content': 'En vol'})
+        assert [item['content'] for item in digests._take_pending(self.recipient.id)] == ['En vol']
+
+    def test_expired_item_is_skipped_on_the_next_pass(self):
+        with mock.patch.object(send_message_digests, 'apply_async'):
+            self.queue(3)
+        cache.delete(f'{digests.QUEUE_KEY.format(self.recipient.id)}:2')
+
+        assert [item['content'] for item in digests._take_pending(self.recipient.id)] == ['Message 0']
+        assert [item['content'] for item in digests._take_pending(self.recipient.id)] == ['Message 2']
+        assert digests._take_pending(self.recipient.id) == []
+
+
+class TestModeration(TestCase):
+    """Moteur de modération compilé."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_all_overlapping_matches_in_one_pass(self):
+        matcher = TermMatcher([('he', 'spam'), ('she', 'forbidden'), ('hers', 'spam'), ('his', 'spam')])
+
+        matches = matcher.find_all('uSHErs')
+
+        assert sorted(matches) == sorted([
+            ModerationMatch('she', 'forbidden', 1),
+            ModerationMatch('he', 'spam', 2),
+            ModerationMatch('hers', 'spam', 2),
+        ])
+
+    def test_matcher_is_rebuilt_when_terms_change(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ModerationTerm.objects.create(term='Roulette', category='spam')
+        assert [m.term for m in moderation.scan('La roulette en ligne')] == ['roulette']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ModerationTerm.objects.create(term='en ligne', category='forbidden')
+
+        matcher = moderation.get_matcher()
+        with self.assertNumQueries(0):
+            assert moderation.get_matcher() is matcher
+        assert {m.term for m in moderation.scan('La roulette en ligne')} == {'roulette', 'en ligne'}
+
+    def test_admin_actions_publish_the_new_version_on_commit(self):
+        from .admin import ModerationTermAdmin
+
+        term = ModerationTerm.objects.create(term='roulette', category='spam', is_active=False)
+        term_admin = ModerationTermAdmin(ModerationTerm, admin.site)
+        version = moderation.current_version()
+
+        with mock.patch.object(term_admin, 'message_user'), self.captureOnCommitCallbacks() as callbacks:
+            term_admin.activate_terms(None, ModerationTerm.objects.filter(id=term.id))
+            assert moderation.current_version() == version
+
+        for callback in callbacks:
+            callback()
+        assert moderation.current_version() != version
+
+
+class TestReadCursors(TestCase):
+    """Curseurs de lecture par participant."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.alice, self.bob)
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def send(self, sender, content='Salut'):
+        return Message.objects.create(conversation=self.conversation, sender=sender, content=content)
+
+    def cursor(self, user):
+        return ReadCursor.objects.get(conversation=self.conversation, user=user)
+
+    def test_new_messages_increment_the_other_participants_only(self):
+        self.send(self.alice)
+        self.send(self.alice)
+        self.send(self.bob)
+
+        assert self.cursor(self.bob).unread_count == 2
+        assert self.cursor(self.alice).unread_count == 1
+        assert self.conversation.get_unread_count(self.bob) == 2
+
+    def test_mark_read_is_a_single_update(self):
+        self.send(self.alice)
+        last = self.send(self.alice)
+
+        with self.assertNumQueries(1):
+            read_state.mark_conversation_read(self.conversation.id, self.bob.id)
+
+        cursor = self.cursor(self.bob)
+        assert (cursor.last_read_message_id, cursor.unread_count) == (last.id, 0)
+
+    def test_mark_single_message_read_keeps_later_messages_unread(self):
+        first = self.send(self.alice)
+        self.send(self.alice)
+
+        response = self.client.post(f'/api/messaging/messages/{first.id}/mark_read/')
+
+        assert response.status_code == 200
+        assert self.cursor(self.bob).unread_count == 1
+        assert self.cursor(self.bob).last_read_message_id == first.id
+
+    def test_send_message_with_client_id_is_idempotent(self):
+        client_id = str(uuid.uuid4())
+        url = f'/api/messaging/conversations/{self.conversation.id}/send_message/'
+
+        data = {'conversation': self.conversation.id, 'content': 'Salut', 'client_id': client_id}
+
+        first = self.client.post(url, data)
+        resent = self.client.post(url, data)
+
+        assert (first.status_code, resent.status_code) == (201, 200)
+        assert resent.data['id'] == first.data['id'] and resent.data['client_id'] == client_id
+        assert Message.objects.filter(conversation=self.conversation).count() == 1
+        assert self.cursor(self.alice).unread_count == 1
+
+    def test_client_id_of_another_conversation_is_rejected(self):
+        carol = User.objects.create(username='carol', phone_number='+33600000003')
+        other = Conversation.objects.create()
+        other.participants.add(self.bob, carol)
+        client_id = uuid.uuid4()
+        delivery.send_message(self.bob, client_id, conversation=self.conversation, content='Salut')
+
+        with self.assertRaises(delivery.DeliveryError):
+            delivery.send_message(self.bob, client_id, conversation=other, content='Salut')
+
+        response = self.client.post(f'/api/messaging/conversations/{other.id}/send_message/',
+                                    {'conversation': other.id, 'content': 'Salut', 'client_id': str(client_id)})
+        assert response.status_code == 400 and 'client_id' in response.data
+        assert not Message.objects.filter(conversation=other).exists()
+
+    def test_acks_advance_cursors_without_going_back(self):
+        messages = [self.send(self.alice) for _ in range(4)]
+        own = self.send(self.bob)
+
+        assert delivery.delivery_status(messages[0]) == 'sent'
+        with self.assertNumQueries(6):
+            receipt = delivery.acknowledge(
+                self.conversation.id, self.bob.id, delivered=[m.id for m in messages] + [own.id], read=[messages[1].id]
+            )
+        assert receipt['sender_ids'] == [self.alice.id]
+        assert (receipt['delivered_up_to'], receipt['read_up_to']) == (messages[-1].id, messages[1].id)
+        assert self.cursor(self.bob).unread_count == 2
+
+        assert delivery.acknowledge(self.conversation.id, self.bob.id, delivered=[messages[0].id]) is None
+        assert [delivery.delivery_status(m) for m in messages] == ['read', 'read', 'delivered', 'delivered']
+        assert delivery.delivery_status(own) == 'sent'
+
+    def test_unread_apis_read_from_cursors(self):
+        self.send(self.alice)
+        self.send(self.alice)
+
+        assert self.client.get('/api/messaging/conversations/unread_count/').data == {'unread_count': 2}
+        listing = self.client.get('/api/messaging/conversations/')
+        assert listing.status_code == 200
+        results = listing.data['results'] if isinstance(listing.data, dict) else listing.data
+        assert results[0]['unread_count'] == 2
+
+        messages = self.client.get(f'/api/messaging/conversations/{self.conversation.id}/messages/').data['results']
+        assert [m['is_read'] for m in messages] == [True, True]
+        assert self.client.get('/api/messaging/conversations/unread_count/').data == {'unread_count': 0}
+
+    def test_message_endpoints_derive_is_read_from_cursors(self):
+        first = self.send(self.alice)
+        second = self.send(self.alice)
+        read_state.mark_read_up_to(self.conversation.id, self.bob.id, first.id)
+
+        alice = APIClient()
+        alice.force_authenticate(self.alice)
+        assert alice.get(f'/api/messaging/messages/{first.id}/').data['is_read'] is True
+        assert self.client.get(f'/api/messaging/messages/{second.id}/').data['is_read'] is False
+
+        listing = alice.get('/api/messaging/messages/').data
+        results = listing['results'] if isinstance(listing, dict) else listing
+        assert {m['id']: m['is_read'] for m in results} == {first.id: True, second.id: False}
+
+        # is_read est en lecture seule
+        self.client.patch(f'/api/messaging/messages/{second.id}/', {'is_read': True})
+        assert self.client.get(f'/api/messaging/messages/{second.id}/').data['is_read'] is False
+
+    def test_admin_mark_as_read_advances_recipient_cursors(self):
+        from django.contrib.admin.sites import site
+        from .admin import MessageAdmin
+        from .export import iter_message_records
+
+        first = self.send(self.alice)
+        second = self.send(self.alice)
+        own = self.send(self.bob)
+
+        admin = MessageAdmin(Message, site)
+        admin.message_user = lambda request, message: None
+        admin.mark_as_read(None, Message.objects.filter(id__in=[first.id, own.id]))
+
+        # Bob a lu jusqu'au premier message, Alice jusqu'à la réponse de Bob
+        assert read_state.read_positions(self.conversation.id) == {self.alice.id: own.id, self.bob.id: first.id}
+        assert [m['is_read'] for m in iter_message_records(self.conversation)] == [True, False, True]
+
+        # Les curseurs ne reculent jamais
+        assert read_state.mark_messages_read(Message.objects.filter(id=second.id)) == 1
+        assert read_state.mark_messages_read(Message.objects.filter(id=first.id)) == 0
+        assert read_state.read_positions(self.conversation.id)[self.bob.id] == second.id
+
+
+class TestConversationSummary(TestCase):
+    """Résumé dénormalisé des conversations et boîte de réception."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.carol = User.objects.create(username='carol', phone_number='+33600000003')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.bob, self.alice)
+
+    def send(self, conversation, sender, content):
+        return Message.objects.create(conversation=conversation, sender=sender, content=content)
+
+    def test_pair_and_last_message_are_maintained(self):
+        self.send(self.conversation, self.alice, 'Bonjour')
+        last = self.send(self.conversation, self.bob, 'x' * 300)
+
+        self.conversation.refresh_from_db()
+        assert (self.conversation.user_low_id, self.conversation.user_high_id) == (self.alice.id, self.bob.id)
+        assert self.conversation.last_message_id == last.id
+        assert self.conversation.last_message_preview == 'x' * summary.PREVIEW_LENGTH
+        assert self.conversation.last_message_at == last.created_at
+
+    def test_deleting_the_last_message_restores_the_previous_one(self):
+        first = self.send(self.conversation, self.alice, 'Premier')
+        self.send(self.conversation, self.bob, 'Second').delete()
+
+        self.conversation.refresh_from_db()
+        assert (self.conversation.last_message_id, self.conversation.last_message_preview) == (first.id, 'Premier')
+
+        first.delete()
+        self.conversation.refresh_from_db()
+        assert (self.conversation.last_message_id, self.conversation.last_message_at) == (None, None)
+
+    def test_inbox_is_a_single_query_ordered_by_last_message(self):
+        other = Conversation.objects.create()
+        other.participants.add(self.carol, self.alice)
+        self.send(self.conversation, self.bob, 'Ancien')
+        self.send(other, self.carol, 'Récent')
+        self.send(other, self.carol, 'Encore')
+
+        with self.assertNumQueries(1):
+            rows = [
+                (c.id, c.get_other_participant(self.alice).username, c.last_message_preview, c.unread_count)
+                for c in summary.inbox_queryset(self.alice)
+            ]
+
+        assert rows == [(other.id, 'carol', 'Encore', 2), (self.conversation.id, 'bob', 'Ancien', 1)]
+        assert [c.id for c in summary.inbox_queryset(self.carol)] == [other.id]
+
+    def test_group_conversations_without_a_pair_are_reachable(self):
+        group = Conversation.objects.create()
+        group.participants.add(self.alice, self.bob, self.carol)
+        self.send(group, self.carol, 'Bonjour à tous')
+        group.refresh_from_db()
+        assert (group.user_low_id, group.user_high_id) == (None, None)
+
+        assert group.id in [c.id for c in summary.inbox_queryset(self.alice)]
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        url = f'/api/messaging/conversations/{group.id}/'
+        assert client.get(url).status_code == 200
+        assert client.get(f'{url}messages/').data['results'][0]['content'] == 'Bonjour à tous'
+        assert client.post(f'{url}send_message/', {'conversation': group.id, 'content': 'Salut'}).status_code == 201
+
+    def test_conversation_list_api_uses_the_summary(self):
+        self.send(self.conversation, self.alice, 'Bonjour Bob')
+        client = APIClient()
+        client.force_authenticate(self.bob)
+
+        listing = client.get('/api/messaging/conversations/')
+        results = listing.data['results'] if isinstance(listing.data, dict) else listing.data
+
+        assert results[0]['last_message_content'] == 'Bonjour Bob'
+        assert results[0]['other_participant']['username'] == 'alice'
+        assert results[0]['unread_count'] == 1
+
+    def test_messages_sent_through_the_api_update_the_summary(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        url = f'/api/messaging/conversations/{self.conversation.id}/send_message/'
+
+        for content in ('Premier', 'Second'):
+            assert client.post(url, {'conversation': self.conversation.id, 'content': content}).status_code == 201
+
+        self.conversation.refresh_from_db()
+        last = self.conversation.messages.latest('id')
+        assert (self.conversation.last_message_id, self.conversation.last_message_preview) == (last.id, 'Second')
+        assert self.conversation.updated_at == last.created_at
+
+
+class TestConversationKey(TestCase):
+    """Clé canonique (user_low, user_high, product) des conversations."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        shop = Shop.objects.create(owner=self.alice, name='Boutique', address_text='1 rue du Test',
+                                   latitude=48.85, longitude=2.35)
+        self.product = Product.objects.create(shop=shop, title='Vélo', description='Vélo de ville',
+                                              price_fiat=Decimal('100.00'), price_pi=Decimal('31.41'), stock=1)
+
+    def test_get_or_create_is_order_independent(self):
+        conversation = get_or_create_conversation(self.bob, self.alice)
+
+        with self.assertNumQueries(1):
+            assert get_or_create_conversation(self.alice, self.bob) == conversation
+        assert get_conversation_between_users(self.bob.id, self.alice.id) == conversation
+        assert set(conversation.participants.all()) == {self.alice, self.bob}
+
+    def test_product_conversations_are_distinct(self):
+        general = get_or_create_conversation(self.alice, self.bob)
+        about_product = get_or_create_conversation(self.bob, self.alice, self.product)
+
+        assert general != about_product
+        assert get_or_create_conversation(self.alice, self.bob, self.product) == about_product
+
+    def test_duplicate_pair_is_rejected_by_the_database(self):
+        get_or_create_conversation(self.alice, self.bob)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Conversation.objects.create(**conversation_key(self.alice.id, self.bob.id))
+
+    def test_deleting_a_product_merges_its_conversation(self):
+        general = get_or_create_conversation(self.alice, self.bob)
+        Message.objects.create(conversation=general, sender=self.alice, content='Bonjour')
+        about_product = get_or_create_conversation(self.alice, self.bob, self.product)
+        last = Message.objects.create(conversation=about_product, sender=self.alice, content='Toujours dispo ?')
+
+        self.product.delete()
+
+        assert list(Conversation.objects.filter(id__in=[general.id, about_product.id])) == [general]
+        general.refresh_from_db()
+        assert (general.messages.count(), general.last_message_id) == (2, last.id)
+        assert ReadCursor.objects.get(conversation=general, user=self.bob).unread_count == 2
+
+    def test_deleting_a_shop_merges_the_conversations_of_its_products(self):
+        other = Product.objects.create(shop=self.product.shop, title='Casque', description='Casque de vélo',
+                                       price_fiat=Decimal('30.00'), price_pi=Decimal('9.42'), stock=1)
+        first = get_or_create_conversation(self.alice, self.bob, self.product)
+        Message.objects.create(conversation=first, sender=self.bob, content='Le vélo est dispo ?')
+        second = get_or_create_conversation(self.alice, self.bob, other)
+        last = Message.objects.create(conversation=second, sender=self.bob, content='Et le casque ?')
+
+        self.product.shop.delete()
+
+        general = Conversation.objects.get(**conversation_key(self.alice.id, self.bob.id))
+        assert list(Conversation.objects.filter(participants=self.alice)) == [general]
+        assert (general.messages.count(), general.last_message_id) == (2, last.id)
+        assert ReadCursor.objects.get(conversation=general, user=self.alice).unread_count == 2
+
+
+class TestMessageHistory(TestCase):
+    """Historique paginé par curseur."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.conversation = get_or_create_conversation(self.alice, self.bob)
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.alice, content=f'm{index}')
+            for index in range(5)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+        self.url = f'/api/messaging/conversations/{self.conversation.id}/messages/'
+
+    def contents(self, result):
+        return [message.content for message in result.messages]
+
+    def test_pages_walk_backwards_and_forwards(self):
+        latest = history.page(self.conversation.id, limit=2)
+        older = history.page(self.conversation.id, before=latest.messages[0].id, limit=2)
+        oldest = history.page(self.conversation.id, before=older.messages[0].id, limit=2)
+
+        assert [self.contents(p) for p in (oldest, older, latest)] == [['m0'], ['m1', 'm2'], ['m3', 'm4']]
+        assert [p.has_more for p in (oldest, older, latest)] == [False, True, True]
+
+        newer = history.page(self.conversation.id, after=self.messages[1].id, limit=2)
+        assert (self.contents(newer), newer.has_more) == (['m2', 'm3'], True)
+
+    def test_page_cost_does_not_depend_on_history_length(self):
+        with self.assertNumQueries(2):
+            history.page(self.conversation.id, before=self.messages[-1].id, limit=2)
+
+    def test_messages_api_returns_a_page_with_cursors(self):
+        response = self.client.get(self.url, {'limit': 2})
+
+        assert response.status_code == 200
+        assert [m['content'] for m in response.data['results']] == ['m3', 'm4']
+        assert (response.data['before'], response.data['after']) == (self.messages[3].id, self.messages[4].id)
+        assert response.data['has_more'] is True
+
+        older = self.client.get(self.url, {'before': response.data['before'], 'limit': 10}).data
+        assert ([m['content'] for m in older['results']], older['has_more']) == (['m0', 'm1', 'm2'], False)
+
+    def test_messages_api_rejects_invalid_cursors(self):
+        assert self.client.get(self.url, {'before': 'abc'}).status_code == 400
+
+
+class TestMessageSearch(TestCase):
+    """Recherche plein texte (repli en Python hors PostgreSQL)."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.carol = User.objects.create(username='carol', phone_number='+33600000003')
+        self.conversation = get_or_create_conversation(self.alice, self.bob)
+        self.other = get_or_create_conversation(self.bob, self.carol)
+
+    def send(self, conversation, sender, content):
+        return Message.objects.create(conversation=conversation, sender=sender, content=content)
+
+    def test_results_are_scoped_ranked_and_highlighted(self):
+        once = self.send(self.conversation, self.bob, 'Le vélo est encore disponible, le prix est ferme')
+        twice = self.send(self.conversation, self.alice, 'Vélo <b>rouge</b> ou vélo bleu ?')
+        self.send(self.other, self.carol, 'Mon vélo aussi est à vendre')
+        self.send(self.conversation, self.alice, 'Bonjour')
+
+        page = search.search(self.alice, 'velo')
+
+        assert [hit.message.id for hit in page.hits] == [twice.id, once.id]
+        assert page.hits[0].snippet == '<mark>Vélo</mark> &lt;b&gt;rouge&lt;/b&gt; ou <mark>vélo</mark> bleu ?'
+        assert page.next_cursor is None
+
+    def test_all_words_must_match(self):
+        match = self.send(self.conversation, self.bob, 'Livraison possible samedi')
+        self.send(self.conversation, self.bob, 'Livraison impossible')
+
+        assert [hit.message.id for hit in search.search(self.alice, 'LIVRAISON samedi').hits] == [match.id]
+
+    def test_cursor_pagination(self):
+        sent = [self.send(self.conversation, self.bob, f'annonce numéro {n}') for n in range(5)]
+
+        first = search.search(self.alice, 'annonce', limit=2)
+        second = search.search(self.alice, 'annonce', cursor=first.next_cursor, limit=2)
+        last = search.search(self.alice, 'annonce', cursor=second.next_cursor, limit=2)
+
+        found = [hit.message.id for page in (first, second, last) for hit in page.hits]
+        assert found == [m.id for m in reversed(sent)]
+        assert last.next_cursor is None
+
+    def test_search_api(self):
+        self.send(self.conversation, self.bob, 'Le prix est négociable')
+        client = APIClient()
+        client.force_authenticate(self.alice)
+
+        response = client.get('/api/messaging/messages/search/', {'q': 'negociable'})
+
+        assert response.status_code == 200
+        assert response.data['results'][0]['snippet'] == 'Le prix est <mark>négociable</mark>'
+        assert client.get('/api/messaging/messages/search/', {'q': 'prix', 'cursor': 'x'}).status_code == 400
+
+
+class TestPresence(TestCase):
+    """Présence par battements dans le cache, sans écriture en base."""
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.carol = User.objects.create(username='carol', phone_number='+33600000003')
+        get_or_create_conversation(self.alice, self.bob)
+        get_or_create_conversation(self.alice, self.carol)
+
+    def test_presence_expires_without_heartbeat(self):
+        with self.assertNumQueries(0):
+            assert async_to_sync(presence.mark_online)(self.bob.id) is True
+            assert async_to_sync(presence.mark_online)(self.bob.id) is False
+        assert presence.is_online(self.bob.id)
+
+        # Worker arrêté sans déconnexion : la clé expire au bout du TTL
+        cache.delete(presence.ONLINE_KEY.format(self.bob.id))
+        assert not presence.is_online(self.bob.id)
+
+    def test_inbox_presence_is_one_lookup(self):
+        async_to_sync(presence.mark_online)(self.carol.id)
+        client = APIClient()
+        client.force_authenticate(self.alice)
+
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            listing = client.get('/api/messaging/conversations/')
+
+        results = listing.data['results'] if isinstance(listing.data, dict) else listing.data
+        online = {row['other_participant']['username']: row['other_participant_online'] for row in results}
+        assert online == {'bob': False, 'carol': True}
+        get_many.assert_called_once()
+
+
+class TestMessagingAnalytics(TestCase):
+    """Statistiques de messagerie en requêtes groupées."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.carol = User.objects.create(username='carol', phone_number='+33600000003')
+        self.with_bob = get_or_create_conversation(self.alice, self.bob)
+        self.with_carol = get_or_create_conversation(self.carol, self.alice)
+
+        # bob, alice (+60s), alice, carol, alice (+120s), bob
+        start = timezone.now() - timedelta(hours=1)
+        for offset, conversation, sender in (
+            (0, self.with_bob, self.bob), (60, self.with_bob, self.alice), (90, self.with_bob, self.alice),
+            (100, self.with_carol, self.carol), (220, self.with_carol, self.alice), (300, self.with_bob, self.bob),
+        ):
+            message = Message.objects.create(conversation=conversation, sender=sender, content='Bonjour')
+            Message.objects.filter(id=message.id).update(created_at=start + timedelta(seconds=offset))
+
+    def test_popular_contacts_are_grouped_in_two_queries(self):
+        with self.assertNumQueries(2):
+            contacts = get_popular_contacts(self.alice)
+        assert contacts == [(self.bob, 4), (self.carol, 2)]
+
+    def test_average_response_time_uses_previous_message_of_each_conversation(self):
+        with self.assertNumQueries(1):
+            delay = calculate_average_response_time(self.alice)
+        assert abs(delay - timedelta(seconds=90)) < timedelta(milliseconds=10)
+        dave = User.objects.create(username='dave', phone_number='+33600000004')
+        assert calculate_average_response_time(dave) is None
+
+    def test_user_stats_and_nightly_rollup(self):
+        stats = get_user_messaging_stats(self.alice)
+        assert {key: stats[key] for key in ('total_conversations', 'active_conversations', 'total_messages_sent',
+                                            'total_messages_received', 'unread_messages')} == {
+            'total_conversations': 2, 'active_conversations': 2, 'total_messages_sent': 3,
+            'total_messages_received': 3, 'unread_messages': 3,
+        }
+        assert stats['most_active_conversation'] == self.with_bob
+
+        assert rollup_messaging_stats() >= 3
+        Message.objects.create(conversation=self.with_carol, sender=self.carol, content='Encore là ?')
+        rolled_up = get_user_messaging_stats(self.alice, use_rollup=True)
+        assert (rolled_up['total_messages_received'], rolled_up['unread_messages']) == (3, 4)
+        assert rolled_up['average_response_time'] == stats['average_response_time']
+
+        # Conversation devenue inactive depuis l'instantané
+        Conversation.objects.filter(id=self.with_bob.id).update(last_message_at=timezone.now() - timedelta(days=31))
+        assert get_user_messaging_stats(self.alice, use_rollup=True)['active_conversations'] == 1
+
+
+class TestMessageRetention(TestCase):
+    """Archivage puis suppression des messages anciens, par lots."""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media.name, MESSAGE_RETENTION_PAUSE=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.carol = User.objects.create(username='carol', phone_number='+33600000003')
+        self.conversation = get_or_create_conversation(self.alice, self.bob)
+        self.dormant = get_or_create_conversation(self.alice, self.carol)
+
+        self.old = []
+        for conversation, created_at in (
+            (self.conversation, datetime(2020, 1, 15, tzinfo=dt_timezone.utc)),
+            (self.dormant, datetime(2020, 2, 15, tzinfo=dt_timezone.utc)),
+            (self.conversation, datetime(2020, 2, 20, tzinfo=dt_timezone.utc)),
+        ):
+            message = Message.objects.create(
+                conversation=conversation, sender=self.alice, content=f'Vieux {created_at:%m}'
+            )
+            Message.objects.filter(id=message.id).update(created_at=created_at)
+            self.old.append(message)
+        self.recent = Message.objects.create(conversation=self.conversation, sender=self.alice, content='Récent')
+        # Les messages laissés par les tests asynchrones précèdent ceux-ci
+        retention.save_checkpoint(self.old[0].id - 1)
+
+    def read_archive(self, name):
+        with default_storage.open(name) as f:
+            return [json.loads(line) for line in gzip.decompress(f.read()).decode().splitlines()]
+
+    def test_old_messages_are_archived_by_month_then_deleted(self):
+        summary = retention.purge_old_messages(days=365, batch_size=2)
+
+        assert (summary['deleted'], summary['batches'], summary['last_id']) == (3, 2, self.old[-1].id)
+        assert list(Message.objects.filter(id__in=[m.id for m in self.old + [self.recent]])) == [self.recent]
+
+        first_id = f'{self.old[0].id:012d}'
+        january = self.read_archive(f'message_archives/2020-01/messages-{first_id}-{first_id}.jsonl.gz')
+        assert [row['content'] for row in january] == ['Vieux 01']
+        _, files = default_storage.listdir('message_archives/2020-02')
+        archived = [
+            row['id'] for name in sorted(files) for row in self.read_archive(f'message_archives/2020-02/{name}')
+        ]
+        assert archived == [self.old[1].id, self.old[2].id]
+
+        # Non-lus et résumés sans les messages supprimés
+        assert ReadCursor.objects.get(conversation=self.conversation, user=self.bob).unread_count == 1
+        assert ReadCursor.objects.get(conversation=self.dormant, user=self.carol).unread_count == 0
+        self.dormant.refresh_from_db()
+        self.conversation.refresh_from_db()
+        assert (self.dormant.last_message_id, self.conversation.last_message_id) == (None, self.recent.id)
+
+    def test_interrupted_run_resumes_from_checkpoint(self):
+        first = retention.purge_old_messages(days=365, batch_size=1, max_batches=1)
+        assert (first['deleted'], retention.load_checkpoint()) == (1, self.old[0].id)
+
+        second = retention.purge_old_messages(days=365, batch_size=1)
+        assert (second['deleted'], second['batches'], retention.load_checkpoint()) == (2, 2, self.old[-1].id)
+        assert Message.objects.filter(id=self.recent.id).exists()
+
+
+class TestConversationExport(TestCase):
+    """Export en flux des conversations."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.conversation = get_or_create_conversation(self.alice, self.bob)
+        for index in range(5):
+            sender = (self.alice, self.bob)[index % 2]
+            Message.objects.create(conversation=self.conversation, sender=sender, content=f'Message "{index}" é')
+
+    def test_streamed_export_matches_in_memory_export(self):
+        path = os.path.join(settings.MEDIA_ROOT, 'export.json.gz')
+
+        # Participants, puis les messages avec leur expéditeur : pas de requête par message
+        third = self.conversation.messages.order_by('id')[2]
+        read_state.mark_read_up_to(self.conversation.id, self.bob.id, third.id)
+
+        with self.assertNumQueries(3):
+            export.export_conversation(self.conversation, path, chunk_size=2)
+
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            exported = json.load(f)
+        assert exported == export_conversation_to_json(self.conversation)
+        assert [m['sender'] for m in exported['messages']] == ['alice', 'bob', 'alice', 'bob', 'alice']
+        assert [m['is_read'] for m in exported['messages']] == [True, False, True, False, False]
+
+    def test_deleted_conversation_is_archived_without_logging_its_content(self):
+        conversation_id = self.conversation.id
+
+        with self.assertLogs('messaging', level='INFO') as logs:
+            self.conversation.delete()
+
+        name = next(line for line in logs.output if 'archivée' in line).rsplit(' ', 1)[-1]
+        assert 'Message' not in ''.join(logs.output)
+        with default_storage.open(name) as f:
+            archived = json.loads(gzip.decompress(f.read()))
+        assert archived['conversation_id'] == conversation_id
+        assert len(archived['messages']) == 5
+
+
+
+class TestAttachmentUploads(TestCase):
+    """Pièces jointes envoyées directement au stockage (stockage local en test)."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.bob = User.objects.create(username='bob', phone_number='+33600000002')
+        self.conversation = get_or_create_conversation(self.alice, self.bob)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def upload(self, filename, body):
+        grant = self.client.post(
+            f'/api/messaging/conversations/{self.conversation.id}/attachment_upload/',
+            {'filename': filename, 'size': len(body)}, format='json'
+        )
+        assert grant.status_code == 201, grant.data
+        assert grant.data['method'] == 'PUT'
+        stored = APIClient().put(grant.data['url'], body, content_type='application/octet-stream')
+        assert stored.status_code == 201
+        return grant.data
+
+    def send(self, token, client=None):
+        return (client or self.client).post(
+            f'/api/messaging/conversations/{self.conversation.id}/send_message/',
+            {'conversation': self.conversation.id, 'content': 'Pièce jointe', 'upload_token': token}, format='json'
+        )
+
+    def test_image_is_moved_out_of_reach_and_thumbnailed(self):
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(buffer, 'PNG')
+        grant = self.upload('photo.png', buffer.getvalue())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.send(grant['upload_token'])
+        assert response.status_code == 201, response.data
+
+        message = Message.objects.get(id=response.data['id'])
+        assert message.attachment.name == uploads.final_name(grant['key'])
+        assert not default_storage.exists(grant['key'])
+        with default_storage.open(message.attachment_thumbnail.name) as f:
+            assert max(Image.open(f).size) == settings.MESSAGE_THUMBNAIL_SIZE
+
+    def test_content_not_matching_extension_is_rejected_and_removed(self):
+        grant = self.upload('facture.pdf', b'MZ\x90\x00' + b'\x00' * 100)
+
+        response = self.send(grant['upload_token'])
+
+        assert response.status_code == 400
+        assert 'upload_token' in response.data
+        assert not default_storage.exists(grant['key'])
+
+    def test_upload_is_bound_to_its_user_and_declared_size(self):
+        assert self.client.post(
+            f'/api/messaging/conversations/{self.conversation.id}/attachment_upload/',
+            {'filename': 'script.exe', 'size': 10}, format='json'
+        ).status_code == 400
+
+        grant = self.upload('notes.txt', 'Bonjour à tous'.encode())
+        too_big = APIClient().put(grant['url'], b'x' * 1000, content_type='application/octet-stream')
+        assert too_big.status_code == 400
+
+        other = APIClient()
+        other.force_authenticate(self.bob)
+        assert self.send(grant['upload_token'], client=other).status_code == 400
+        assert self.send(grant['upload_token']).status_code == 201
+
+    def test_claimed_upload_cannot_be_overwritten(self):
+        grant = self.upload('notes.txt', 'Bonjour à tous'.encode())
+        message = Message.objects.get(id=self.send(grant['upload_token']).data['id'])
+
+        body = b'<html><script>alert(1)</script>'
+        rewrite = APIClient().put(grant['url'], body, content_type='application/octet-stream')
+
+        assert rewrite.status_code == 400
+        with default_storage.open(message.attachment.name) as f:
+            assert f.read() == 'Bonjour à tous'.encode()
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class TestMessagingAdmin(TestCase):
+    """Listes de l'administration en nombre de requêtes constant."""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='x', phone_number='+33600000000')
+        self.client.force_login(self.admin)
+        self.alice = User.objects.create(username='alice', phone_number='+33600000001')
+        self.shop = Shop.objects.create(owner=self.alice, name='Boutique', address_text='1 rue du Test',
+                                        latitude=48.85, longitude=2.35)
+
+    def add_conversations(self, count):
+        for _ in range(count):
+            contact = User.objects.create(username=f'contact{User.objects.count()}',
+                                          phone_number=f'+3370000{User.objects.count():04d}')
+            product = Product.objects.create(shop=self.shop, title='Vélo', description='Vélo de ville',
+                                             price_fiat=Decimal('100.00'), price_pi=Decimal('31.41'), stock=1)
+            conversation = get_or_create_conversation(self.alice, contact, product)
+            Message.objects.create(conversation=conversation, sender=contact, content='Bonjour')
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        assert response.status_code == 200
+        return len(queries)
+
+    def test_changelists_do_not_query_per_row(self):
+        for url in ('/admin/messaging/conversation/', '/admin/messaging/message/'):
+            self.add_conversations(2)
+            few = self.changelist_queries(url)
+            self.add_conversations(5)
+            assert self.changelist_queries(url) == few
+
+    def test_message_counts_are_annotated(self):
+        self.add_conversations(1)
+        response = self.client.get('/admin/messaging/conversation/')
+        assert '1 message<' in response.content.decode()
+
+    def test_paginator_counts_exactly_outside_postgres(self):
+        from .admin import EstimatedCountPaginator
+
+        self.add_conversations(3)
+        paginator = EstimatedCountPaginator(Message.objects.filter(sender__username__startswith='contact'), 2)
+        assert paginator.count == Message.objects.filter(sender__username__startswith='contact').count()
+
+
+class TestChatLoad(TestCase):
+    """Banc de charge du chemin WebSocket (petit scénario)."""
+
+    def test_load_report_measures_every_delivery(self):
+        # Les tests tournent déjà sur InMemoryChannelLayer : garder l'instance configurée
+        report = loadtest.run_load(sockets=8, conversations=2, rounds=3, in_memory_layer=False)
+
+        assert (report.sockets, report.messages, report.deliveries) == (8, 6, 24)
+        assert 0 < report.p50_ms <= report.p99_ms
+        # INSERT et compteurs de la conversation : rien par socket abonné
+        assert report.queries_per_message <= 3
+        assert not User.objects.filter(username__startswith='load_').exists()
+
+    def test_regressions_compare_to_baseline(self):
+        report = loadtest.LoadReport(8, 2, 6, 24, 1.0, 10.0, 40.0, 3.0, 6.0)
+
+        assert loadtest.regressions(report, {'p50_ms': 8.0, 'p99_ms': 30.0, 'queries_per_message': 3.0}) == []
+        found = loadtest.regressions(report, {'p50_ms': 5.0, 'p99_ms': 30.0, 'queries_per_message': 2.0})
+        assert [line.split(' :')[0] for line in found] == ['requêtes par message', 'latence p50']
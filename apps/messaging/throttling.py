@@ -0,0 +1,111 @@
+"""
+Limitation du trafic des WebSockets de messagerie
+
+- TokenBucket : limite de trames entrantes par socket, tous types confondus
+- TypingCoalescer : au plus un changement d'état de frappe diffusé par
+  intervalle, et retour automatique à is_typing=false sans trafic client
+
+Les deux vivent dans le consumer (un par socket) : aucune donnée partagée,
+aucun aller-retour vers le channel layer pour décider.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Seau à jetons : rate jetons par seconde, au plus burst en réserve"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def consume(self):
+        """Prend un jeton ; False si le seau est vide"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class TypingCoalescer:
+    """
+    État de frappe d'un utilisateur dans une conversation
+
+    Les trames `typing` mettent à jour l'état voulu ; seul un changement par
+    rapport au dernier état diffusé est publié, au plus une fois par
+    intervalle (un changement trop rapproché est différé à la fin de
+    l'intervalle, et annulé s'il est revenu à l'état diffusé entre-temps).
+    Sans nouvelle trame is_typing=true pendant timeout secondes, l'état
+    repasse à false.
+    """
+
+    def __init__(self, publish, interval, timeout):
+        """
+        Args:
+            publish: Coroutine appelée avec le nouvel état (bool) à diffuser
+            interval: Délai minimal entre deux diffusions, en secondes
+            timeout: Durée après laquelle la frappe expire, en secondes
+        """
+        self._publish = publish
+        self.interval = interval
+        self.timeout = timeout
+        self.published = False
+        self._wanted = False
+        self._last_sent = None
+        self._flush_task = None
+        self._expiry_task = None
+
+    async def update(self, is_typing):
+        """Prend en compte une trame typing du client"""
+        self._wanted = bool(is_typing)
+
+        if self._expiry_task:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+        if self._wanted:
+            self._expiry_task = asyncio.ensure_future(self._expire())
+
+        await self._flush()
+
+    async def close(self):
+        """Arrête les minuteries ; diffuse la fin de frappe si nécessaire"""
+        for task in (self._flush_task, self._expiry_task):
+            if task:
+                task.cancel()
+        self._flush_task = self._expiry_task = None
+
+        if self.published:
+            self.published = False
+            await self._publish(False)
+
+    async def _expire(self):
+        await asyncio.sleep(self.timeout)
+        self._expiry_task = None
+        self._wanted = False
+        await self._flush()
+
+    async def _flush(self):
+        if self._wanted == self.published or self._flush_task:
+            return
+
+        loop = asyncio.get_running_loop()
+        wait = 0 if self._last_sent is None else self._last_sent + self.interval - loop.time()
+        if wait > 0:
+            self._flush_task = asyncio.ensure_future(self._flush_later(wait))
+            return
+
+        self.published = self._wanted
+        self._last_sent = loop.time()
+        await self._publish(self.published)
+
+    async def _flush_later(self, wait):
+        await asyncio.sleep(wait)
+        self._flush_task = None
+        await self._flush()
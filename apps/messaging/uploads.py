@@ -0,0 +1,258 @@
+"""
+Pièces jointes envoyées directement au stockage
+
+Les fichiers ne transitent plus par les workers Django :
+
+1. Le client demande une autorisation d'envoi pour une conversation
+   (POST /api/messaging/conversations/<id>/attachment_upload/ avec le nom
+   et la taille du fichier). Il reçoit un jeton signé et l'URL où envoyer
+   le fichier : un POST présigné S3 en production (taille bornée par la
+   condition content-length-range), sinon l'URL locale de secours
+   PUT /api/messaging/uploads/<jeton>/ (stockage de fichiers local, en
+   développement et en test).
+2. Le client envoie le fichier directement à cette URL.
+3. Le client envoie son message avec upload_token. Le fichier est alors
+   déplacé de la clé d'envoi (sous incoming/) vers une clé définitive où
+   le client ne peut plus écrire, puis validé sur cette copie : premiers
+   octets (signature du format, cohérente avec l'extension) et taille
+   réelle. Un fichier refusé est supprimé du stockage.
+
+Le jeton ne sert qu'une fois : après le rattachement, l'URL locale refuse
+tout nouvel envoi, et un nouveau POST présigné S3 n'écrit que sous la clé
+d'envoi, qui n'est plus lue. Un message renvoyé avec le même jeton (même
+client_id, voir delivery.py) retrouve la clé définitive.
+
+Les miniatures des images sont produites ensuite par le processeur
+'thumbnails' (tâche Celery process_messages, voir processors.py).
+"""
+
+import os
+import uuid
+from io import BytesIO
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils.text import get_valid_filename
+
+UPLOAD_PREFIX = 'message_attachments'
+INCOMING_PREFIX = 'message_attachments/incoming'
+THUMBNAIL_PREFIX = 'message_attachments/thumbnails'
+SIGNING_SALT = 'messaging.attachment-upload'
+# Clé définitive d'un envoi déjà rattaché, par clé d'envoi
+CLAIMED_KEY = 'messaging:upload-claimed:{}'
+
+# Octets lus en tête de fichier pour reconnaître son format
+SNIFF_BYTES = 2048
+
+# Signatures par extension autorisée ; None : texte (UTF-8 sans octet nul)
+SIGNATURES = {
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'pdf': (b'%PDF-',),
+    'zip': (b'PK\x03\x04',),
+    'docx': (b'PK\x03\x04',),
+    'xlsx': (b'PK\x03\x04',),
+    'doc': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+    'xls': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+    'txt': None,
+}
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif'}
+
+
+class UploadError(Exception):
+    """Fichier ou jeton d'envoi refusé (message destiné au client)"""
+
+
+def extension(name):
+    return os.path.splitext(name)[1].lstrip('.').lower()
+
+
+def check_declared(filename, size):
+    """Contrôle le nom et la taille annoncés avant d'autoriser l'envoi"""
+    ext = extension(filename or '')
+    if ext not in SIGNATURES:
+        raise UploadError(f"Extension {ext} non autorisée")
+    if size is None or not 0 < size <= settings.MESSAGE_ATTACHMENT_MAX_SIZE:
+        raise UploadError(f"Taille invalide (max {settings.MESSAGE_ATTACHMENT_MAX_SIZE // (1024 * 1024)} MB)")
+
+
+def sniff(prefix, name):
+    """
+    Vérifie que les premiers octets du fichier correspondent à son extension
+
+    Raises:
+        UploadError: format non reconnu ou différent de l'extension
+    """
+    ext = extension(name)
+    if ext not in SIGNATURES:
+        raise UploadError(f"Extension {ext} non autorisée")
+
+    signatures = SIGNATURES[ext]
+    if signatures is None:
+        # Un préfixe coupé au milieu d'un caractère reste du texte
+        try:
+            prefix.decode('utf-8')
+        except UnicodeDecodeError as e:
+            if e.start < len(prefix) - 3:
+                raise UploadError("Le contenu ne correspond pas à l'extension") from None
+        if b'\x00' in prefix:
+            raise UploadError("Le contenu ne correspond pas à l'extension")
+        return
+
+    if not prefix.startswith(signatures):
+        raise UploadError("Le contenu ne correspond pas à l'extension")
+
+
+def read_prefix(name, storage=None):
+    """Premiers octets d'un fichier du stockage (lecture partielle, sans tout télécharger)"""
+    with (storage or default_storage).open(name, 'rb') as f:
+        return f.read(SNIFF_BYTES)
+
+
+def issue_upload(user, conversation, filename, size):
+    """
+    Autorise l'envoi d'un fichier dans une conversation
+
+    Returns:
+        dict: upload_token, key, method, url, fields, expires_in
+    """
+    check_declared(filename, size)
+
+    safe_name = get_valid_filename(os.path.basename(filename))[:100] or f'fichier.{extension(filename)}'
+    key = f'{INCOMING_PREFIX}/{conversation.id}/{uuid.uuid4().hex}/{safe_name}'
+    token = signing.dumps(
+        {'key': key, 'user': user.id, 'conversation': conversation.id, 'size': size},
+        salt=SIGNING_SALT, compress=True,
+    )
+
+    expires = settings.MESSAGE_UPLOAD_URL_TTL
+    upload = {'upload_token': token, 'key': key, 'expires_in': expires}
+
+    bucket = getattr(default_storage, 'bucket_name', None)
+    if bucket:
+        # S3 (django-storages) : POST présigné, taille bornée côté S3
+        client = default_storage.connection.meta.client
+        presigned = client.generate_presigned_post(
+            Bucket=bucket,
+            Key=default_storage._normalize_name(key),
+            Conditions=[['content-length-range', 1, settings.MESSAGE_ATTACHMENT_MAX_SIZE]],
+            ExpiresIn=expires,
+        )
+        upload.update(method='POST', url=presigned['url'], fields=presigned['fields'])
+    else:
+        upload.update(method='PUT', url=reverse('messaging:attachment-upload', args=[token]), fields={})
+    return upload
+
+
+def read_token(token):
+    """
+    Contenu d'un jeton d'envoi encore valide
+
+    Raises:
+        UploadError: jeton invalide ou expiré
+    """
+    try:
+        return signing.loads(token, salt=SIGNING_SALT, max_age=settings.MESSAGE_UPLOAD_URL_TTL)
+    except signing.SignatureExpired:
+        raise UploadError("Autorisation d'envoi expirée") from None
+    except signing.BadSignature:
+        raise UploadError("Autorisation d'envoi invalide") from None
+
+
+def store_local_upload(token, stream, length):
+    """
+    Écrit un envoi direct dans le stockage local (URL de secours sans S3)
+
+    Le corps de la requête est copié par blocs dans le stockage, sans être
+    chargé en mémoire.
+    """
+    data = read_token(token)
+    if cache.get(CLAIMED_KEY.format(data['key'])) is not None:
+        raise UploadError("Autorisation d'envoi déjà utilisée")
+    if not 0 < length <= min(data['size'], settings.MESSAGE_ATTACHMENT_MAX_SIZE):
+        raise UploadError("Taille différente de la taille annoncée")
+
+    if default_storage.exists(data['key']):
+        default_storage.delete(data['key'])
+    return default_storage.save(data['key'], File(stream, name=data['key']))
+
+
+def final_name(key):
+    """Clé définitive d'une clé d'envoi (hors de incoming/)"""
+    return f'{UPLOAD_PREFIX}/{key[len(INCOMING_PREFIX) + 1:]}'
+
+
+def claim_upload(token, user, conversation_id):
+    """
+    Rattache un fichier envoyé et retourne son nom pour Message.attachment
+
+    Le fichier est déplacé vers sa clé définitive avant d'être validé : le
+    contenu contrôlé est celui qui sera servi. Un jeton déjà rattaché
+    renvoie la même clé définitive.
+
+    Raises:
+        UploadError: jeton d'un autre utilisateur ou d'une autre conversation,
+        fichier absent, trop gros ou dont le contenu ne correspond pas à
+        l'extension (il est alors supprimé)
+    """
+    data = read_token(token)
+    if data['user'] != user.id or data['conversation'] != conversation_id:
+        raise UploadError("Autorisation d'envoi invalide")
+
+    key = data['key']
+    claimed = cache.get(CLAIMED_KEY.format(key))
+    if claimed:
+        return claimed
+    if claimed is not None or not default_storage.exists(key):
+        raise UploadError("Fichier non reçu")
+
+    # Jeton marqué comme utilisé avant le déplacement : l'URL locale n'accepte plus d'envoi
+    cache.set(CLAIMED_KEY.format(key), '', settings.MESSAGE_UPLOAD_URL_TTL)
+    with default_storage.open(key, 'rb') as f:
+        name = default_storage.save(final_name(key), File(f, name=final_name(key)))
+    default_storage.delete(key)
+
+    try:
+        if default_storage.size(name) > settings.MESSAGE_ATTACHMENT_MAX_SIZE:
+            raise UploadError("Le fichier est trop volumineux")
+        sniff(read_prefix(name), name)
+    except UploadError:
+        default_storage.delete(name)
+        raise
+
+    cache.set(CLAIMED_KEY.format(key), name, settings.MESSAGE_UPLOAD_URL_TTL)
+    return name
+
+
+def is_image(name):
+    return extension(name) in IMAGE_EXTENSIONS
+
+
+def make_thumbnail(name):
+    """
+    Miniature JPEG d'une image du stockage
+
+    Returns:
+        str: Nom de la miniature dans le stockage
+    """
+    from PIL import Image
+
+    size = settings.MESSAGE_THUMBNAIL_SIZE
+    with default_storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        # Décodage réduit pour les JPEG : pas d'image pleine taille en mémoire
+        image.draft('RGB', (size, size))
+        image = image.convert('RGB')
+        image.thumbnail((size, size))
+
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=80)
+    base = os.path.splitext(name[len(UPLOAD_PREFIX) + 1:] if name.startswith(UPLOAD_PREFIX) else name)[0]
+    return default_storage.save(f'{THUMBNAIL_PREFIX}/{base}.jpg', ContentFile(buffer.getvalue()))
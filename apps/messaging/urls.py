@@ -1,6 +1,6 @@
 ﻿from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ConversationViewSet, MessageViewSet
+from .views import ConversationViewSet, MessageViewSet, attachment_upload_view
 
 router = DefaultRouter()
 router.register(r'conversations', ConversationViewSet, basename='conversation')
@@ -10,6 +10,8 @@ app_name = 'messaging'
 
 urlpatterns = [
     path('', include(router.urls)),
+    # Envoi direct des pièces jointes sans S3 (voir uploads.py)
+    path('uploads/<str:token>/', attachment_upload_view, name='attachment-upload'),
 ]
 
 # Les URLs disponibles seront :
@@ -18,6 +20,8 @@ urlpatterns = [
 # GET    /api/conversations/{id}/         - Détails d'une conversation
 # GET    /api/conversations/{id}/messages/ - Messages d'une conversation
 # POST   /api/conversations/{id}/send_message/ - Envoyer un message
+# POST   /api/conversations/{id}/attachment_upload/ - Autoriser l'envoi direct d'une pièce jointe
+# PUT    /api/uploads/{token}/                - Envoi direct local (sans S3)
 # GET    /api/conversations/unread_count/ - Nombre de messages non lus
 # POST   /api/messages/                   - Créer un message
 # POST   /api/messages/{id}/mark_read/    - Marquer comme lu
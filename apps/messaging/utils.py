@@ -1,12 +1,41 @@
 ﻿from django.utils import timezone
 from django.contrib.auth import get_user_model
-from .models import Conversation, Message
+from django.db import transaction
+from django.db.models import Sum
+from .models import Conversation, Message, ReadCursor
+from .retention import purge_old_messages
+from .delivery import delivery_status
+from .read_state import ensure_cursors, mark_conversation_read, total_unread, unread_count_subquery
+from .export import conversation_header, export_conversation, iter_message_records
+from .analytics import average_response_time, most_active_conversation, popular_contacts, user_stats
+from .presence import is_online
+from .search import search
+from .summary import refresh_last_message
+from .uploads import SNIFF_BYTES, UploadError, check_declared, sniff
 from datetime import timedelta
 
+def conversation_key(user1_id, user2_id, product_id=None):
+    """
+    Clé canonique d'une conversation à deux
+    
+    L'ordre des utilisateurs n'importe pas : la paire est rangée par id.
+    
+    Returns:
+        dict: user_low_id, user_high_id et product_id, utilisable comme filtre
+    """
+    user_low_id, user_high_id = sorted((user1_id, user2_id))
+    return {'user_low_id': user_low_id, 'user_high_id': user_high_id, 'product_id': product_id}
+
+
 def get_or_create_conversation(user1, user2, product=None):
     """
     Récupère ou crée une conversation entre deux utilisateurs
     
+    Recherche par l'index unique (user_low, user_high, product). Deux
+    requêtes concurrentes ne peuvent pas créer deux conversations : la
+    seconde insertion viole la contrainte et get_or_create relit la
+    conversation créée par la première.
+    
     Args:
         user1: Premier utilisateur
         user2: Deuxième utilisateur
@@ -15,20 +44,58 @@ def get_or_create_conversation(user1, user2, product=None):
     Returns:
         Conversation object
     """
-    # Chercher une conversation existante
-    conversation = Conversation.objects.filter(
-        participants=user1
-    ).filter(
-        participants=user2
-    ).first()
+    key = conversation_key(user1.id, user2.id, product.id if product else None)
     
-    if not conversation:
-        conversation = Conversation.objects.create(product=product)
-        conversation.participants.add(user1, user2)
+    conversation = Conversation.objects.filter(**key).first()
+    if conversation is None:
+        with transaction.atomic():
+            conversation, created = Conversation.objects.get_or_create(**key)
+            if created:
+                conversation.participants.add(user1, user2)
     
     return conversation
 
 
+def merge_conversations(target, duplicates):
+    """
+    Fusionne des conversations en double dans target
+    
+    Les messages sont rattachés à target, les curseurs de lecture repartent
+    du plus ancien curseur de chaque participant (un message lu dans une
+    seule des conversations peut redevenir non lu, jamais l'inverse), puis
+    les doublons sont supprimés.
+    
+    Args:
+        target: Conversation conservée
+        duplicates: Conversations à fusionner puis supprimer
+    """
+    duplicate_ids = [conversation.id for conversation in duplicates if conversation.id != target.id]
+    if not duplicate_ids:
+        return target
+    
+    with transaction.atomic():
+        Message.objects.filter(conversation_id__in=duplicate_ids).update(conversation=target)
+        
+        last_read = {}
+        for user_id, last_read_id in ReadCursor.objects.filter(
+            conversation_id__in=[target.id, *duplicate_ids]
+        ).values_list('user_id', 'last_read_message_id'):
+            last_read[user_id] = min(last_read.get(user_id, last_read_id or 0), last_read_id or 0)
+        
+        ensure_cursors(target.id, last_read)
+        messages = Message.objects.filter(conversation=target)
+        for user_id, last_read_id in last_read.items():
+            ReadCursor.objects.filter(conversation=target, user_id=user_id).update(
+                last_read_message_id=last_read_id or None,
+                unread_count=messages.filter(id__gt=last_read_id).exclude(sender_id=user_id).count(),
+            )
+        
+        Conversation.objects.filter(id__in=duplicate_ids).delete()
+        refresh_last_message(target.id)
+    
+    return target
+
+
 def send_message(conversation, sender, content, attachment=None):
     """
     Envoie un message dans une conversation
@@ -49,9 +116,7 @@ def send_message(conversation, sender, content, attachment=None):
         attachment=attachment
     )
     
-    # Mettre à jour la date de modification de la conversation
-    conversation.save()
-    
+    # Le résumé de la conversation (et updated_at) est mis à jour par le signal post_save du message
     return message
 
 
@@ -66,11 +131,9 @@ def get_unread_conversations(user):
         QuerySet de Conversations
     """
     return Conversation.objects.filter(
-        participants=user,
-        messages__is_read=False
-    ).exclude(
-        messages__sender=user
-    ).distinct()
+        read_cursors__user=user,
+        read_cursors__unread_count__gt=0
+    )
 
 
 def get_total_unread_count(user):
@@ -83,10 +146,7 @@ def get_total_unread_count(user):
     Returns:
         int: Nombre de messages non lus
     """
-    return Message.objects.filter(
-        conversation__participants=user,
-        is_read=False
-    ).exclude(sender=user).count()
+    return total_unread(user)
 
 
 def mark_conversation_as_read(conversation, user):
@@ -97,16 +157,13 @@ def mark_conversation_as_read(conversation, user):
         conversation: Objet Conversation
         user: Utilisateur qui lit les messages
     """
-    Message.objects.filter(
-        conversation=conversation,
-        is_read=False
-    ).exclude(sender=user).update(is_read=True)
+    mark_conversation_read(conversation.id, user.id)
 
 
 def delete_old_messages(days=365):
     """
     Supprime les messages plus anciens que X jours
-    Utile pour le nettoyage automatique
+    Utile pour le nettoyage automatique (archivés d'abord, par lots : voir retention.py)
     
     Args:
         days: Nombre de jours (défaut: 365)
@@ -114,11 +171,7 @@ def delete_old_messages(days=365):
     Returns:
         int: Nombre de messages supprimés
     """
-    cutoff_date = timezone.now() - timedelta(days=days)
-    deleted_count, _ = Message.objects.filter(
-        created_at__lt=cutoff_date
-    ).delete()
-    return deleted_count
+    return purge_old_messages(days=days)['deleted']
 
 
 def get_user_conversations_with_stats(user):
@@ -131,35 +184,31 @@ def get_user_conversations_with_stats(user):
     Returns:
         QuerySet avec annotations
     """
-    from django.db.models import Count, Q, Max
+    from django.db.models import Count, Max
     
     return Conversation.objects.filter(
         participants=user
     ).annotate(
         message_count=Count('messages'),
-        unread_count=Count(
-            'messages',
-            filter=Q(messages__is_read=False) & ~Q(messages__sender=user)
-        ),
+        unread_count=unread_count_subquery(user),
         last_message_date=Max('messages__created_at')
     ).order_by('-last_message_date')
 
 
-def search_messages(user, query):
+def search_messages(user, query, cursor=None, limit=None):
     """
     Recherche dans les messages de l'utilisateur
     
     Args:
         user: Utilisateur
         query: Texte à rechercher
+        cursor: Curseur de la page précédente (optionnel)
+        limit: Taille de page (optionnel)
     
     Returns:
-        QuerySet de Messages
+        SearchPage : résultats classés avec extraits, et curseur suivant (voir search.py)
     """
-    return Message.objects.filter(
-        conversation__participants=user,
-        content__icontains=query
-    ).select_related('sender', 'conversation').order_by('-created_at')
+    return search(user, query, cursor=cursor, limit=limit)
 
 
 def get_conversation_participants_except(conversation, user):
@@ -176,23 +225,18 @@ def get_conversation_participants_except(conversation, user):
     return conversation.participants.exclude(id=user.id)
 
 
-def is_user_online(user, threshold_minutes=5):
+def is_user_online(user):
     """
     Vérifie si un utilisateur est en ligne
-    (basé sur sa dernière activité)
+    (au moins un WebSocket de messagerie ouvert, voir presence.py)
     
     Args:
         user: Utilisateur
-        threshold_minutes: Seuil en minutes (défaut: 5)
     
     Returns:
         bool: True si en ligne
     """
-    if not hasattr(user, 'last_activity'):
-        return False
-    
-    threshold = timezone.now() - timedelta(minutes=threshold_minutes)
-    return user.last_activity > threshold
+    return is_online(user.id)
 
 
 def format_message_time(message):
@@ -242,7 +286,7 @@ def get_conversation_statistics(conversation):
     
     stats = {
         'total_messages': messages.count(),
-        'unread_messages': messages.filter(is_read=False).count(),
+        'unread_messages': conversation.read_cursors.aggregate(total=Sum('unread_count'))['total'] or 0,
         'messages_by_sender': {}
     }
     
@@ -305,6 +349,7 @@ def clean_message_content(content):
 def export_conversation_to_json(conversation):
     """
     Exporte une conversation au format JSON
+    (en mémoire : pour les grandes conversations, voir export.py)
     
     Args:
         conversation: Objet Conversation
@@ -312,29 +357,9 @@ def export_conversation_to_json(conversation):
     Returns:
         dict: Données de la conversation
     """
-    messages = conversation.messages.all()
-    
     return {
-        'conversation_id': conversation.id,
-        'participants': [
-            {
-                'id': p.id,
-                'username': p.username,
-                'email': p.email
-            }
-            for p in conversation.participants.all()
-        ],
-        'created_at': conversation.created_at.isoformat(),
-        'messages': [
-            {
-                'id': msg.id,
-                'sender': msg.sender.username,
-                'content': msg.content,
-                'is_read': msg.is_read,
-                'created_at': msg.created_at.isoformat()
-            }
-            for msg in messages
-        ]
+        **conversation_header(conversation),
+        'messages': list(iter_message_records(conversation)),
     }
 
 
@@ -393,12 +418,7 @@ def get_message_delivery_status(message):
     Returns:
         str: 'sent', 'delivered', 'read'
     """
-    if message.is_read:
-        return 'read'
-    elif message.created_at < timezone.now() - timedelta(minutes=1):
-        return 'delivered'
-    else:
-        return 'sent'
+    return delivery_status(message)
 
 
 def generate_conversation_summary(conversation, max_messages=5):
@@ -418,7 +438,7 @@ def generate_conversation_summary(conversation, max_messages=5):
         'conversation_id': conversation.id,
         'participants_count': conversation.participants.count(),
         'total_messages': conversation.messages.count(),
-        'unread_messages': conversation.messages.filter(is_read=False).count(),
+        'unread_messages': conversation.read_cursors.aggregate(total=Sum('unread_count'))['total'] or 0,
         'last_activity': conversation.updated_at,
         'recent_messages': [
             {
@@ -434,6 +454,7 @@ def generate_conversation_summary(conversation, max_messages=5):
 def validate_message_attachment(file):
     """
     Valide un fichier attaché à un message
+    (extension, taille et signature des premiers octets, voir uploads.py)
     
     Args:
         file: Fichier uploadé
@@ -441,45 +462,30 @@ def validate_message_attachment(file):
     Returns:
         tuple: (bool, str) - (Valide, Message d'erreur)
     """
-    # Taille maximale: 10 MB
-    max_size = 10 * 1024 * 1024
-    
-    if file.size > max_size:
-        return False, "Le fichier est trop volumineux (max 10 MB)"
-    
-    # Extensions autorisées
-    allowed_extensions = [
-        'jpg', 'jpeg', 'png', 'gif', 'pdf', 
-        'doc', 'docx', 'xls', 'xlsx', 'txt', 'zip'
-    ]
-    
-    file_extension = file.name.split('.')[-1].lower()
-    
-    if file_extension not in allowed_extensions:
-        return False, f"Extension {file_extension} non autorisée"
+    try:
+        check_declared(file.name, file.size)
+        sniff(file.read(SNIFF_BYTES), file.name)
+    except UploadError as e:
+        return False, str(e)
+    finally:
+        file.seek(0)
     
     return True, "OK"
 
 
-def get_conversation_between_users(user1_id, user2_id):
+def get_conversation_between_users(user1_id, user2_id, product_id=None):
     """
     Trouve une conversation entre deux utilisateurs par leurs IDs
     
     Args:
         user1_id: ID du premier utilisateur
         user2_id: ID du second utilisateur
+        product_id: ID du produit associé (optionnel)
     
     Returns:
         Conversation ou None
     """
-    try:
-        return Conversation.objects.filter(
-            participants__id=user1_id
-        ).filter(
-            participants__id=user2_id
-        ).first()
-    except Exception:
-        return None
+    return Conversation.objects.filter(**conversation_key(user1_id, user2_id, product_id)).first()
 
 
 def bulk_mark_as_read(user, conversation_ids):
@@ -490,10 +496,8 @@ def bulk_mark_as_read(user, conversation_ids):
         user: Utilisateur
         conversation_ids: Liste des IDs de conversations
     """
-    Message.objects.filter(
-        conversation_id__in=conversation_ids,
-        is_read=False
-    ).exclude(sender=user).update(is_read=True)
+    for conversation_id in conversation_ids:
+        mark_conversation_read(conversation_id, user.id)
 
 
 def get_popular_contacts(user, limit=10):
@@ -507,30 +511,7 @@ def get_popular_contacts(user, limit=10):
     Returns:
         List de tuples (User, message_count)
     """
-    from django.db.models import Count
-    
-    conversations = Conversation.objects.filter(participants=user)
-    
-    contact_counts = {}
-    for conv in conversations:
-        other_participants = conv.participants.exclude(id=user.id)
-        message_count = conv.messages.count()
-        
-        for participant in other_participants:
-            if participant.id not in contact_counts:
-                contact_counts[participant.id] = {
-                    'user': participant,
-                    'count': 0
-                }
-            contact_counts[participant.id]['count'] += message_count
-    
-    sorted_contacts = sorted(
-        contact_counts.values(),
-        key=lambda x: x['count'],
-        reverse=True
-    )[:limit]
-    
-    return [(c['user'], c['count']) for c in sorted_contacts]
+    return popular_contacts(user.id, limit=limit)
 
 
 def create_system_message(conversation, content):
@@ -550,8 +531,7 @@ def create_system_message(conversation, content):
     return Message.objects.create(
         conversation=conversation,
         sender=system_user,
-        content=f"[SYSTÈME] {content}",
-        is_read=True
+        content=f"[SYSTÈME] {content}"
     )
 
 
@@ -578,31 +558,19 @@ def get_conversation_activity_timeline(conversation):
     return list(daily_activity)
 
 
-def get_user_messaging_stats(user):
+def get_user_messaging_stats(user, use_rollup=False):
     """
     Récupère des statistiques globales de messagerie pour un utilisateur
+    (requêtes groupées, voir analytics.py)
     
     Args:
         user: Utilisateur
+        use_rollup: Lire l'instantané nocturne s'il existe
     
     Returns:
         dict: Statistiques
     """
-    conversations = Conversation.objects.filter(participants=user)
-    sent_messages = Message.objects.filter(sender=user)
-    received_messages = Message.objects.filter(
-        conversation__participants=user
-    ).exclude(sender=user)
-    
-    return {
-        'total_conversations': conversations.count(),
-        'active_conversations': get_active_conversations(user).count(),
-        'total_messages_sent': sent_messages.count(),
-        'total_messages_received': received_messages.count(),
-        'unread_messages': get_total_unread_count(user),
-        'average_response_time': calculate_average_response_time(user),
-        'most_active_conversation': get_most_active_conversation(user)
-    }
+    return user_stats(user, use_rollup=use_rollup)
 
 
 def calculate_average_response_time(user):
@@ -615,34 +583,7 @@ def calculate_average_response_time(user):
     Returns:
         timedelta ou None
     """
-    from django.db.models import F, ExpressionWrapper, DurationField
-    
-    # Messages de l'utilisateur
-    user_messages = Message.objects.filter(sender=user).order_by('created_at')
-    
-    if user_messages.count() < 2:
-        return None
-    
-    total_time = timedelta()
-    response_count = 0
-    
-    for conv in Conversation.objects.filter(participants=user):
-        messages = list(conv.messages.order_by('created_at'))
-        
-        for i in range(1, len(messages)):
-            prev_msg = messages[i-1]
-            curr_msg = messages[i]
-            
-            # Si le message actuel est de l'utilisateur et le précédent n'est pas de lui
-            if curr_msg.sender == user and prev_msg.sender != user:
-                time_diff = curr_msg.created_at - prev_msg.created_at
-                total_time += time_diff
-                response_count += 1
-    
-    if response_count == 0:
-        return None
-    
-    return total_time / response_count
+    return average_response_time(user.id)
 
 
 def get_most_active_conversation(user):
@@ -655,13 +596,7 @@ def get_most_active_conversation(user):
     Returns:
         Conversation ou None
     """
-    from django.db.models import Count
-    
-    return Conversation.objects.filter(
-        participants=user
-    ).annotate(
-        msg_count=Count('messages')
-    ).order_by('-msg_count').first()
+    return most_active_conversation(user.id)
 
 
 def sanitize_html_content(content):
@@ -686,13 +621,8 @@ def create_conversation_backup(conversation, backup_path):
     
     Args:
         conversation: Objet Conversation
-        backup_path: Chemin du fichier de sauvegarde
+        backup_path: Chemin du fichier de sauvegarde (compressé en gzip s'il finit par .gz)
     """
-    import json
-    
-    data = export_conversation_to_json(conversation)
-    
-    with open(backup_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    export_conversation(conversation, backup_path)
 
 User = get_user_model()
\ No newline at end of file
@@ -1,10 +1,25 @@
 ﻿from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Q, Max, OuterRef, Subquery, Count, F, Value
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
+from django.core.files.storage import default_storage
+from django.http import Http404, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
 from .models import Conversation, Message
+from .read_state import (
+    apply_read_flags,
+    mark_conversation_read,
+    mark_read_up_to,
+    total_unread
+)
+from . import history
+from .presence import online_user_ids
+from .search import search
+from .summary import inbox_queryset
+from .uploads import UploadError, issue_upload, store_local_upload
+from .utils import get_or_create_conversation
 from django.contrib.auth import get_user_model
 from .serializers import (
     ConversationSerializer, 
@@ -12,31 +27,36 @@ from .serializers import (
     ConversationCreateSerializer
 )
 
-# Vue template pour l'interface
 User = get_user_model()
 
+
+def message_id_param(value):
+    """ID de message passé en paramètre de requête (None si absent, ValueError si invalide)"""
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+# Vue template pour l'interface
 @login_required
 def messages_view(request):
     """
     Vue principale pour l'interface de messagerie
     """
     # Récupérer toutes les conversations de l'utilisateur
-    conversations = Conversation.objects.filter(participants=request.user).prefetch_related('participants', 'messages').order_by('-updated_at')
+    conversations = inbox_queryset(request.user)
     
     active_conversation = None
     messages = []
+    has_older = False
     
     # Tenter de démarrer une nouvelle conversation
     recipient_id = request.GET.get('start_with')
     if recipient_id:
         try:
             recipient = User.objects.get(id=recipient_id)
-            # Chercher une conversation existante
-            active_conversation = Conversation.objects.filter(participants=request.user).filter(participants=recipient).first()
-            if not active_conversation:
-                # Créer une nouvelle conversation
-                active_conversation = Conversation.objects.create()
-                active_conversation.participants.add(request.user, recipient)
+            # Conversation existante ou nouvelle, par la clé canonique de la paire
+            active_conversation = get_or_create_conversation(request.user, recipient)
             # Rediriger vers l'URL propre de la conversation
             return redirect(f"{request.path}?conversation={active_conversation.id}")
         except User.DoesNotExist:
@@ -47,9 +67,16 @@ def messages_view(request):
     if conversation_id:
         try:
             active_conversation = Conversation.objects.get(id=conversation_id, participants=request.user)
-            messages = active_conversation.messages.all().order_by('created_at')
-            # Marquer les messages comme lus
-            active_conversation.messages.filter(is_read=False).exclude(sender=request.user).update(is_read=True)
+            # Dernière page de l'historique, ou la page précédant ?before=
+            try:
+                before = message_id_param(request.GET.get('before'))
+            except ValueError:
+                before = None
+            result = history.page(active_conversation.id, before=before)
+            messages = result.messages
+            has_older = result.has_more
+            # Marquer les messages comme lus (avance le curseur)
+            mark_conversation_read(active_conversation.id, request.user.id)
         except Conversation.DoesNotExist:
             # Gérer le cas où l'ID de conversation n'est pas valide ou n'appartient pas à l'utilisateur
             pass
@@ -69,9 +96,32 @@ def messages_view(request):
         'conversations': conversations,
         'active_conversation': active_conversation,
         'messages': messages,
+        'has_older': has_older,
     }
     return render(request, 'messaging/messages.html', context)
 
+
+@csrf_exempt
+@require_http_methods(['PUT'])
+def attachment_upload_view(request, token):
+    """
+    Réception directe d'une pièce jointe quand le stockage n'est pas S3
+    
+    Remplace le POST présigné S3 en développement et en test : le jeton
+    signé tient lieu d'authentification, et le corps est copié par blocs
+    dans le stockage.
+    """
+    if getattr(default_storage, 'bucket_name', None):
+        raise Http404
+    
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        key = store_local_upload(token, request, length)
+    except (UploadError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'key': key}, status=201)
+
+
 class ConversationViewSet(viewsets.ModelViewSet):
     """
     ViewSet pour gérer les conversations
@@ -81,30 +131,23 @@ class ConversationViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         """Retourne uniquement les conversations de l'utilisateur connecté"""
-        user = self.request.user
-
-        # Sous-requête pour trouver le contenu du dernier message
-        last_message_content = Message.objects.filter(
-            conversation=OuterRef('pk')
-        ).order_by('-created_at').values('content')[:1]
-
-        # Sous-requête pour trouver la date du dernier message
-        last_message_date = Message.objects.filter(
-            conversation=OuterRef('pk')
-        ).order_by('-created_at').values('created_at')[:1]
-        
-        # Compter les messages non lus pour chaque conversation
-        unread_count = Message.objects.filter(
-            conversation=OuterRef('pk'), is_read=False
-        ).exclude(sender=user).values('conversation').annotate(count=Count('id')).values('count')
-
-        return Conversation.objects.filter(
-            participants=user
-        ).prefetch_related('participants').annotate(
-            last_message_content=Subquery(last_message_content),
-            last_message_date=Subquery(last_message_date),
-            unread_count=Subquery(unread_count, output_field=models.IntegerField())
-        ).order_by(F('last_message_date').desc(nulls_last=True))
+        # Résumé du dernier message et non-lus lus sur la ligne de la conversation
+        return inbox_queryset(self.request.user).prefetch_related('participants')
+    
+    def list(self, request, *args, **kwargs):
+        """Liste paginée, avec la présence des interlocuteurs de la page en un MGET"""
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        conversations = page if page is not None else list(queryset)
+        
+        others = {c.user_high_id if c.user_low_id == request.user.id else c.user_low_id for c in conversations}
+        context = self.get_serializer_context()
+        context['online_ids'] = online_user_ids(others - {None})
+        
+        serializer = self.get_serializer_class()(conversations, many=True, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
     
     def create(self, request, *args, **kwargs):
         """Créer une nouvelle conversation"""
@@ -121,45 +164,91 @@ class ConversationViewSet(viewsets.ModelViewSet):
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
-        """Récupérer tous les messages d'une conversation"""
+        """
+        Récupérer une page de l'historique d'une conversation
+        
+        Paramètres : before ou after (ID de message) et limit. Sans curseur,
+        retourne les derniers messages. La réponse donne les curseurs des
+        pages voisines : ?before=<before> pour les messages plus anciens,
+        ?after=<after> pour les suivants.
+        """
         conversation = self.get_object()
-        messages = conversation.messages.all()
         
-        # Marquer les messages comme lus
-        messages.filter(is_read=False).exclude(
-            sender=request.user
-        ).update(is_read=True)
+        try:
+            before = message_id_param(request.query_params.get('before'))
+            after = message_id_param(request.query_params.get('after'))
+        except ValueError:
+            return Response(
+                {'error': 'before and after must be message ids'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        result = history.page(conversation.id, before=before, after=after,
+                              limit=request.query_params.get('limit'))
+        messages = result.messages
         
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        # Marquer comme lu jusqu'au dernier message renvoyé (avance le curseur)
+        if messages and before is None:
+            mark_read_up_to(conversation.id, request.user.id, messages[-1].id)
+        
+        apply_read_flags(messages, request.user)
+        return Response({
+            'results': MessageSerializer(messages, many=True).data,
+            'has_more': result.has_more,
+            'before': messages[0].id if messages else before,
+            'after': messages[-1].id if messages else after,
+        })
     
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
-        """Envoyer un message dans une conversation"""
+        """
+        Envoyer un message dans une conversation
+        
+        Avec client_id, un renvoi du même message renvoie le message déjà
+        enregistré (200) au lieu d'en créer un second.
+        """
         conversation = self.get_object()
         
-        serializer = MessageSerializer(data=request.data)
+        serializer = MessageSerializer(data=request.data, context={'request': request, 'conversation': conversation})
         if serializer.is_valid():
             serializer.save(
                 conversation=conversation,
                 sender=request.user
             )
             
-            # Mettre à jour la date de modification de la conversation
-            conversation.save()
+            # Renvoi d'un message déjà enregistré (même client_id) : rien n'est créé
+            if not serializer.created:
+                apply_read_flags([serializer.instance], request.user)
+                return Response(serializer.data, status=status.HTTP_200_OK)
             
+            # Le résumé de la conversation (et updated_at) est mis à jour par le signal post_save du message
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=True, methods=['post'])
+    def attachment_upload(self, request, pk=None):
+        """
+        Autoriser l'envoi direct d'une pièce jointe au stockage
+        
+        Paramètres : filename et size (octets). Le fichier est ensuite envoyé
+        à l'URL renvoyée, puis le message est envoyé avec upload_token.
+        """
+        conversation = self.get_object()
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            size = None
+        
+        try:
+            upload = issue_upload(request.user, conversation, request.data.get('filename'), size)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(upload, status=status.HTTP_201_CREATED)
+    
     @action(detail=False, methods=['get'])
     def unread_count(self, request):
         """Obtenir le nombre total de messages non lus"""
-        count = Message.objects.filter(
-            conversation__participants=request.user,
-            is_read=False
-        ).exclude(sender=request.user).count()
-        
-        return Response({'unread_count': count})
+        return Response({'unread_count': total_unread(request.user)})
 
 
 class MessageViewSet(viewsets.ModelViewSet):
@@ -175,17 +264,52 @@ class MessageViewSet(viewsets.ModelViewSet):
             conversation__participants=self.request.user
         ).select_related('sender', 'conversation')
     
+    def get_serializer(self, *args, **kwargs):
+        """Renseigne is_read depuis les curseurs sur les messages sérialisés (liste, détail)"""
+        if args and 'data' not in kwargs:
+            messages = list(args[0]) if kwargs.get('many') else [args[0]]
+            apply_read_flags(messages, self.request.user)
+            args = (messages if kwargs.get('many') else messages[0], *args[1:])
+        return super().get_serializer(*args, **kwargs)
+    
     def perform_create(self, serializer):
         """Créer un nouveau message"""
         serializer.save(sender=self.request.user)
     
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Recherche plein texte dans les messages de l'utilisateur
+        
+        Paramètres : q, cursor (renvoyé par la page précédente) et limit.
+        Résultats classés par pertinence, avec un extrait HTML surligné.
+        """
+        try:
+            page = search(request.user, request.query_params.get('q'),
+                          cursor=request.query_params.get('cursor'), limit=request.query_params.get('limit'))
+        except ValueError:
+            return Response(
+                {'error': 'Invalid cursor'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        apply_read_flags([hit.message for hit in page.hits], request.user)
+        
+        results = []
+        for hit in page.hits:
+            data = MessageSerializer(hit.message).data
+            data.update(rank=hit.rank, snippet=hit.snippet)
+            results.append(data)
+        
+        return Response({'results': results, 'next_cursor': page.next_cursor})
+    
     @action(detail=True, methods=['post'])
     def mark_read(self, request, pk=None):
         """Marquer un message comme lu"""
         message = self.get_object()
         
         if message.sender != request.user:
-            message.mark_as_read()
+            mark_read_up_to(message.conversation_id, request.user.id, message.id)
             return Response({'status': 'message marked as read'})
         
         return Response(
@@ -204,9 +328,6 @@ class MessageViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        Message.objects.filter(
-            conversation_id=conversation_id,
-            is_read=False
-        ).exclude(sender=request.user).update(is_read=True)
+        mark_conversation_read(conversation_id, request.user.id)
         
         return Response({'status': 'all messages marked as read'})
\ No newline at end of file
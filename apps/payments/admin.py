@@ -1,5 +1,5 @@
 ﻿from django.contrib import admin
-from .models import Payment, EscrowTransaction
+from .models import Payment, EscrowTransaction, LedgerEntry, SellerBalance
 
 
 @admin.register(Payment)
@@ -39,4 +39,33 @@ class EscrowTransactionAdmin(admin.ModelAdmin):
         for escrow in queryset.filter(status='held'):
             release_escrow_funds.delay(escrow.payment.order.id)
         self.message_user(request, f"Triggered escrow release for {queryset.count()} transactions")
-    release_escrow_manual.short_description = "Release selected escrow transactions"
\ No newline at end of file
+    release_escrow_manual.short_description = "Release selected escrow transactions"
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = [
+        'id', 'transaction_id', 'entry_type', 'account', 'seller', 'payment', 'amount', 'currency', 'created_at'
+    ]
+    list_filter = ['entry_type', 'account', 'currency']
+    search_fields = ['transaction_id', 'payment__provider_payment_id', 'payment__order__order_number']
+    list_select_related = ['seller', 'payment']
+    
+    # Append-only: entries are written by the payment flows, never by hand
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(SellerBalance)
+class SellerBalanceAdmin(admin.ModelAdmin):
+    list_display = ['seller', 'currency', 'escrow_balance', 'available_balance', 'updated_at']
+    list_filter = ['currency']
+    search_fields = ['seller__phone_number', 'seller__display_name']
+    list_select_related = ['seller']
+    readonly_fields = ['seller', 'currency', 'escrow_balance', 'available_balance', 'updated_at']
@@ -3,4 +3,8 @@ from django.apps import AppConfig
 class PaymentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.payments'
-    verbose_name = 'Payments'
\ No newline at end of file
+    verbose_name = 'Payments'
+    
+    def ready(self):
+        # Status push receivers for orders and payments
+        from . import signals
@@ -0,0 +1,30 @@
+import json
+from channels.generic.websocket import AsyncWebsocketConsumer
+from .signals import user_status_group
+
+
+class StatusConsumer(AsyncWebsocketConsumer):
+    """
+    Per-user WebSocket pushing order and payment status transitions
+    
+    Server-push only: events are published by apps.payments.signals once
+    the transition commits. Incoming frames are ignored.
+    """
+    
+    async def connect(self):
+        self.user = self.scope['user']
+        
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        
+        self.group_name = user_status_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+    
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+    
+    async def status_update(self, event):
+        await self.send(text_data=json.dumps(event['event']))
@@ -0,0 +1,240 @@
+"""
+Double-entry ledger for escrow money movements
+
+Every escrow transition posts a balanced transaction (lines summing to zero)
+in the same database transaction as the state change, and bumps the seller's
+materialized SellerBalance row, so balance lookups never aggregate orders.
+
+Postings (positive = debit, negative = credit):
+- hold:    seller_escrow +A, provider_clearing -A
+- release: seller_escrow -A, seller_available +A
+- fee:     seller_available -F, platform_fees +F
+- refund:  provider_clearing +A, and -A from seller_escrow (before release)
+           or from seller_available and platform_fees (after release)
+
+Each (payment, entry_type, account) line is unique, so replaying a webhook
+or racing a task against a webhook never double-posts.
+"""
+
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from .models import LedgerEntry, SellerBalance
+
+# Seller accounts mirrored on SellerBalance
+BALANCE_FIELDS = {
+    'seller_escrow': 'escrow_balance',
+    'seller_available': 'available_balance',
+}
+
+
+def _payment_amount(payment):
+    return payment.amount_pi if payment.currency == 'pi' else payment.amount_fiat
+
+
+def _platform_fee(amount):
+    percent = Decimal(str(settings.PLATFORM_FEE_PERCENT))
+    return (amount * percent / 100).quantize(Decimal('0.01'))
+
+
+def _post(payment, entry_type, lines):
+    """
+    Write one balanced posting and apply it to the seller's balance
+
+    Args:
+        payment: Payment the money movement belongs to
+        entry_type: One of LedgerEntry.ENTRY_TYPE_CHOICES
+        lines: List of (account, amount) tuples summing to zero
+
+    Returns:
+        bool: False if this posting already exists for the payment
+    """
+    lines = [(account, amount) for account, amount in lines if amount]
+    if not lines:
+        return False
+
+    if sum(amount for _, amount in lines) != 0:
+        raise ValueError(f"Unbalanced {entry_type} posting for payment {payment.id}: {lines}")
+
+    seller_id = payment.order.shop.owner_id
+    transaction_id = uuid.uuid4()
+
+    try:
+        # Savepoint, so a duplicate leaves the caller's transaction usable
+        with transaction.atomic():
+            LedgerEntry.objects.bulk_create([
+                LedgerEntry(
+                    transaction_id=transaction_id,
+                    entry_type=entry_type,
+                    account=account,
+                    seller_id=seller_id,
+                    payment=payment,
+                    currency=payment.currency,
+                    amount=amount,
+                )
+                for account, amount in lines
+            ])
+    except IntegrityError:
+        return False
+
+    deltas = {
+        BALANCE_FIELDS[account]: F(BALANCE_FIELDS[account]) + amount
+        for account, amount in lines
+        if account in BALANCE_FIELDS
+    }
+    if deltas:
+        SellerBalance.objects.get_or_create(seller_id=seller_id, currency=payment.currency)
+        SellerBalance.objects.filter(seller_id=seller_id, currency=payment.currency).update(**deltas)
+
+    return True
+
+
+def record_hold(payment):
+    """Record funds entering escrow for a payment"""
+    amount = _payment_amount(payment)
+    return _post(payment, 'hold', [
+        ('seller_escrow', amount),
+        ('provider_clearing', -amount),
+    ])
+
+
+def record_release(payment):
+    """Record escrow released to the seller, net of the platform fee"""
+    amount = _payment_amount(payment)
+    released = _post(payment, 'release', [
+        ('seller_escrow', -amount),
+        ('seller_available', amount),
+    ])
+
+    if released:
+        fee = _platform_fee(amount)
+        _post(payment, 'fee', [
+            ('seller_available', -fee),
+            ('platform_fees', fee),
+        ])
+
+    return released
+
+
+def record_refund(payment, released=False):
+    """
+    Record a refund to the buyer
+
+    Args:
+        payment: Refunded Payment
+        released: Whether the escrow had already been released to the seller
+    """
+    amount = _payment_amount(payment)
+
+    if not released:
+        return _post(payment, 'refund', [
+            ('seller_escrow', -amount),
+            ('provider_clearing', amount),
+        ])
+
+    fee = LedgerEntry.objects.filter(
+        payment=payment, entry_type='fee', account='platform_fees'
+    ).values_list('amount', flat=True).first() or Decimal('0')
+
+    return _post(payment, 'refund', [
+        ('seller_available', -(amount - fee)),
+        ('platform_fees', -fee),
+        ('provider_clearing', amount),
+    ])
+
+
+def get_seller_balances(seller):
+    """Return the seller's balances keyed by currency (one indexed lookup)"""
+    return {
+        balance.currency: {
+            'escrow': balance.escrow_balance,
+            'available': balance.available_balance,
+        }
+        for balance in SellerBalance.objects.filter(seller=seller)
+    }
+
+
+def replay_ledger(chunk_size=2000):
+    """
+    Recompute seller balances by replaying every ledger entry in order
+
+    Returns:
+        dict: {(seller_id, currency): {'escrow_balance': ..., 'available_balance': ...}}
+    """
+    balances = defaultdict(lambda: {field: Decimal('0') for field in BALANCE_FIELDS.values()})
+
+    entries = LedgerEntry.objects.filter(
+        account__in=list(BALANCE_FIELDS)
+    ).order_by('id').values_list('seller_id', 'currency', 'account', 'amount').iterator(chunk_size=chunk_size)
+
+    for seller_id, currency, account, amount in entries:
+        balances[(seller_id, currency)][BALANCE_FIELDS[account]] += amount
+
+    return balances
+
+
+def verify_ledger():
+    """
+    Check the ledger is consistent
+
+    Verifies that every posting sums to zero and that replaying the ledger
+    reproduces every SellerBalance row.
+
+    Returns:
+        dict: 'unbalanced_transactions' and 'balance_mismatches' lists
+    """
+    unbalanced = list(
+        LedgerEntry.objects.order_by().values('transaction_id').annotate(
+            total=Sum('amount')
+        ).exclude(total=0).values_list('transaction_id', flat=True)
+    )
+
+    expected = replay_ledger()
+    mismatches = []
+
+    for balance in SellerBalance.objects.all().iterator():
+        replayed = expected.pop((balance.seller_id, balance.currency), None) or {
+            field: Decimal('0') for field in BALANCE_FIELDS.values()
+        }
+        for field, value in replayed.items():
+            if getattr(balance, field) != value:
+                mismatches.append({
+                    'seller_id': balance.seller_id,
+                    'currency': balance.currency,
+                    'field': field,
+                    'stored': str(getattr(balance, field)),
+                    'replayed': str(value),
+                })
+
+    # Ledger activity with no balance row at all
+    for (seller_id, currency), replayed in expected.items():
+        for field, value in replayed.items():
+            if value:
+                mismatches.append({
+                    'seller_id': seller_id,
+                    'currency': currency,
+                    'field': field,
+                    'stored': None,
+                    'replayed': str(value),
+                })
+
+    return {
+        'unbalanced_transactions': [str(transaction_id) for transaction_id in unbalanced],
+        'balance_mismatches': mismatches,
+    }
+
+
+@transaction.atomic
+def rebuild_balances():
+    """Overwrite every SellerBalance row with the replayed ledger totals"""
+    replayed = replay_ledger()
+
+    SellerBalance.objects.update(escrow_balance=0, available_balance=0)
+
+    for (seller_id, currency), fields in replayed.items():
+        SellerBalance.objects.update_or_create(seller_id=seller_id, currency=currency, defaults=fields)
+
+    return len(replayed)
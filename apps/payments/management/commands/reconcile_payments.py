@@ -0,0 +1,51 @@
+"""
+Management command to reconcile payments against provider records
+
+Usage: python manage.py reconcile_payments stripe --start 2025-10-01 --end 2025-10-02 --output report.jsonl
+
+Location: apps/payments/management/commands/reconcile_payments.py
+"""
+
+from datetime import datetime, time, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from apps.payments.reconciliation import DISCREPANCY_TYPES, PROVIDER_LISTINGS, reconcile_payments
+
+
+class Command(BaseCommand):
+    help = 'Reconcile Payment rows against provider records for a date range'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('provider', choices=sorted(PROVIDER_LISTINGS), help='Payment provider to reconcile')
+        parser.add_argument('--start', help='First day to reconcile (YYYY-MM-DD, default: yesterday)')
+        parser.add_argument('--end', help='Day after the last day to reconcile (YYYY-MM-DD, default: start + 1 day)')
+        parser.add_argument('--output', help='Write discrepancies to this file as JSON lines')
+    
+    def parse_day(self, value):
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError(f'Invalid date: {value} (expected YYYY-MM-DD)')
+        return timezone.make_aware(datetime.combine(day, time.min))
+    
+    def handle(self, *args, **options):
+        if options['start']:
+            start = self.parse_day(options['start'])
+        else:
+            start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        
+        end = self.parse_day(options['end']) if options['end'] else start + timedelta(days=1)
+        
+        if end <= start:
+            raise CommandError('--end must be after --start')
+        
+        summary = reconcile_payments(options['provider'], start, end, report_path=options['output'])
+        
+        for discrepancy_type in DISCREPANCY_TYPES:
+            self.stdout.write(f'{discrepancy_type}: {summary[discrepancy_type]}')
+        
+        style = self.style.SUCCESS if summary['total'] == 0 else self.style.WARNING
+        self.stdout.write(style(f"{summary['total']} discrepancies for {options['provider']}"))
+        
+        if options['output']:
+            self.stdout.write(f"Report written to {options['output']}")
@@ -12,6 +12,7 @@ from django.db import transaction
 from datetime import timedelta
 from apps.shops.models import Order
 from apps.payments.models import Payment, EscrowTransaction
+from apps.payments import ledger
 
 
 class Command(BaseCommand):
@@ -56,9 +57,11 @@ class Command(BaseCommand):
                 payment=payment,
                 defaults={
                     'status': 'held',
-                    'auto_release_date': auto_release_date
+                    'auto_release_date': auto_release_date,
+                    'next_release_check': auto_release_date
                 }
             )
+            ledger.record_hold(payment)
             
             # Update order status
             order.status = 'paid_in_escrow'
@@ -0,0 +1,41 @@
+"""
+Management command to verify the payment ledger
+
+Usage: python manage.py verify_ledger [--rebuild]
+
+Location: apps/payments/management/commands/verify_ledger.py
+"""
+
+from django.core.management.base import BaseCommand
+from apps.payments.ledger import rebuild_balances, verify_ledger
+
+
+class Command(BaseCommand):
+    help = 'Replay the ledger and check postings balance and seller balances match'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Overwrite seller balances with the replayed ledger totals'
+        )
+    
+    def handle(self, *args, **options):
+        result = verify_ledger()
+        
+        for transaction_id in result['unbalanced_transactions']:
+            self.stdout.write(self.style.ERROR(f'Unbalanced posting: {transaction_id}'))
+        
+        for mismatch in result['balance_mismatches']:
+            self.stdout.write(self.style.ERROR(
+                f"Seller {mismatch['seller_id']} ({mismatch['currency']}) {mismatch['field']}: "
+                f"stored {mismatch['stored']}, replayed {mismatch['replayed']}"
+            ))
+        
+        if not result['unbalanced_transactions'] and not result['balance_mismatches']:
+            self.stdout.write(self.style.SUCCESS('✓ Ledger is consistent'))
+            return
+        
+        if options['rebuild']:
+            count = rebuild_balances()
+            self.stdout.write(self.style.SUCCESS(f'✓ Rebuilt {count} seller balances from the ledger'))
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='escrowtransaction',
+            index=models.Index(fields=['status', 'auto_release_date'], name='payments_es_status_f38998_idx'),
+        ),
+    ]
@@ -0,0 +1,129 @@
+# Generated by Django 4.2.7 on 2026-10-18 22:34
+
+from collections import defaultdict
+from decimal import Decimal
+import uuid
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _escrow_postings(escrow, amount, fee):
+    """
+    Postings an escrow went through before the ledger existed, like apps.payments.ledger posts them
+
+    Every refund path also sets released_at, and nothing left on the row tells
+    whether a refunded escrow had been released first, so refunded escrows are
+    posted as refunded from escrow (no release, no fee).
+    """
+    postings = [('hold', [('seller_escrow', amount), ('provider_clearing', -amount)])]
+
+    if escrow.status == 'released':
+        postings.append(('release', [('seller_escrow', -amount), ('seller_available', amount)]))
+        postings.append(('fee', [('seller_available', -fee), ('platform_fees', fee)]))
+    elif escrow.status == 'refunded':
+        postings.append(('refund', [('seller_escrow', -amount), ('provider_clearing', amount)]))
+
+    return postings
+
+
+def backfill_ledger(apps, schema_editor):
+    """Post the ledger entries of escrows held, released or refunded before the ledger existed"""
+    EscrowTransaction = apps.get_model('payments', 'EscrowTransaction')
+    LedgerEntry = apps.get_model('payments', 'LedgerEntry')
+    SellerBalance = apps.get_model('payments', 'SellerBalance')
+
+    percent = Decimal(str(settings.PLATFORM_FEE_PERCENT))
+    balances = defaultdict(lambda: {'escrow_balance': Decimal('0'), 'available_balance': Decimal('0')})
+    fields = {'seller_escrow': 'escrow_balance', 'seller_available': 'available_balance'}
+
+    entries = []
+    escrows = EscrowTransaction.objects.select_related('payment__order__shop').order_by('id')
+    for escrow in escrows.iterator(chunk_size=500):
+        payment = escrow.payment
+        amount = payment.amount_pi if payment.currency == 'pi' else payment.amount_fiat
+        if not amount:
+            continue
+
+        seller_id = payment.order.shop.owner_id
+        fee = (amount * percent / 100).quantize(Decimal('0.01'))
+
+        for entry_type, lines in _escrow_postings(escrow, amount, fee):
+            transaction_id = uuid.uuid4()
+            for account, line_amount in lines:
+                if not line_amount:
+                    continue
+                entries.append(LedgerEntry(
+                    transaction_id=transaction_id,
+                    entry_type=entry_type,
+                    account=account,
+                    seller_id=seller_id,
+                    payment_id=payment.id,
+                    currency=payment.currency,
+                    amount=line_amount,
+                ))
+                if account in fields:
+                    balances[(seller_id, payment.currency)][fields[account]] += line_amount
+
+        if len(entries) >= 1000:
+            LedgerEntry.objects.bulk_create(entries)
+            entries = []
+
+    LedgerEntry.objects.bulk_create(entries)
+    SellerBalance.objects.bulk_create([
+        SellerBalance(seller_id=seller_id, currency=currency, **amounts)
+        for (seller_id, currency), amounts in balances.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('payments', '0002_escrow_status_release_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SellerBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=10)),
+                ('escrow_balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('available_balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balances', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Seller Balance',
+                'verbose_name_plural': 'Seller Balances',
+                'unique_together': {('seller', 'currency')},
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_id', models.UUIDField(db_index=True)),
+                ('entry_type', models.CharField(choices=[('hold', 'Hold in Escrow'), ('release', 'Release to Seller'), ('fee', 'Platform Fee'), ('refund', 'Refund to Buyer')], max_length=20)),
+                ('account', models.CharField(choices=[('provider_clearing', 'Provider Clearing'), ('seller_escrow', 'Seller Escrow'), ('seller_available', 'Seller Available'), ('platform_fees', 'Platform Fees')], max_length=30)),
+                ('currency', models.CharField(max_length=10)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('payment', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='payments.payment')),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ledger_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Ledger Entry',
+                'verbose_name_plural': 'Ledger Entries',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['seller', 'currency', 'account'], name='payments_le_seller__246a35_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ledgerentry',
+            constraint=models.UniqueConstraint(fields=('payment', 'entry_type', 'account'), name='unique_ledger_line_per_payment'),
+        ),
+        migrations.RunPython(backfill_ledger, migrations.RunPython.noop),
+    ]
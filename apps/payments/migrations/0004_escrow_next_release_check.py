@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0003_ledger'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='escrowtransaction',
+            name='payments_es_status_f38998_idx',
+        ),
+        migrations.AddField(
+            model_name='escrowtransaction',
+            name='next_release_check',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='escrowtransaction',
+            index=models.Index(fields=['status', 'auto_release_date', 'next_release_check'], name='payments_es_status_8b6e69_idx'),
+        ),
+    ]
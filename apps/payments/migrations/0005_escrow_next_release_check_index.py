@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 00:14
+
+from django.db import migrations, models
+
+
+def backfill_next_release_check(apps, schema_editor):
+    """Escrows never deferred are first checked at their auto_release_date"""
+    EscrowTransaction = apps.get_model('payments', 'EscrowTransaction')
+    EscrowTransaction.objects.filter(next_release_check__isnull=True).update(
+        next_release_check=models.F('auto_release_date')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_escrow_next_release_check'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_next_release_check, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='escrowtransaction',
+            name='payments_es_status_8b6e69_idx',
+        ),
+        migrations.AddIndex(
+            model_name='escrowtransaction',
+            index=models.Index(fields=['status', 'next_release_check'], name='payments_es_status_72a888_idx'),
+        ),
+    ]
@@ -66,6 +66,9 @@ class EscrowTransaction(models.Model):
     held_at = models.DateTimeField(auto_now_add=True)
     released_at = models.DateTimeField(null=True, blank=True)
     auto_release_date = models.DateTimeField(null=True, blank=True)
+    # When auto_release_escrow next looks at this escrow: auto_release_date on creation, pushed back
+    # while the order is not releasable; auto_release_date is left as promised
+    next_release_check = models.DateTimeField(null=True, blank=True)
     
     notes = models.TextField(blank=True)
     
@@ -73,6 +76,92 @@ class EscrowTransaction(models.Model):
         verbose_name = 'Escrow Transaction'
         verbose_name_plural = 'Escrow Transactions'
         ordering = ['-held_at']
+        indexes = [
+            # Due-release lookups: status='held' AND next_release_check <= now
+            models.Index(fields=['status', 'next_release_check']),
+        ]
+    
+    def __str__(self):
+        return f"Escrow for Payment {self.payment.id} - {self.status}"
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only double-entry ledger line
+    
+    Every posting (hold, release, fee, refund) writes lines sharing a
+    transaction_id whose amounts sum to zero. Amounts are signed: positive
+    debits, negative credits.
+    """
+    
+    ENTRY_TYPE_CHOICES = [
+        ('hold', 'Hold in Escrow'),
+        ('release', 'Release to Seller'),
+        ('fee', 'Platform Fee'),
+        ('refund', 'Refund to Buyer'),
+    ]
+    
+    ACCOUNT_CHOICES = [
+        ('provider_clearing', 'Provider Clearing'),
+        ('seller_escrow', 'Seller Escrow'),
+        ('seller_available', 'Seller Available'),
+        ('platform_fees', 'Platform Fees'),
+    ]
+    
+    transaction_id = models.UUIDField(db_index=True)
+    entry_type = models.CharField(max_length=20, choices=ENTRY_TYPE_CHOICES)
+    account = models.CharField(max_length=30, choices=ACCOUNT_CHOICES)
+    
+    seller = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='ledger_entries')
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, related_name='ledger_entries')
+    
+    currency = models.CharField(max_length=10)  # fiat, pi
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name = 'Ledger Entry'
+        verbose_name_plural = 'Ledger Entries'
+        ordering = ['id']
+        constraints = [
+            # A payment is held, released, charged a fee and refunded at most once
+            models.UniqueConstraint(
+                fields=['payment', 'entry_type', 'account'],
+                name='unique_ledger_line_per_payment'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['seller', 'currency', 'account']),
+        ]
+    
+    def __str__(self):
+        return f"{self.entry_type} {self.account} {self.amount} {self.currency}"
+    
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError("Ledger entries are append-only")
+        super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries are append-only")
+
+
+class SellerBalance(models.Model):
+    """Materialized seller balance, kept in step with the ledger"""
+    
+    seller = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='balances')
+    currency = models.CharField(max_length=10)  # fiat, pi
+    
+    escrow_balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    available_balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = 'Seller Balance'
+        verbose_name_plural = 'Seller Balances'
+        unique_together = ('seller', 'currency')
     
     def __str__(self):
-        return f"Escrow for Payment {self.payment.id} - {self.status}"
\ No newline at end of file
+        return f"Balance for {self.seller_id} ({self.currency})"
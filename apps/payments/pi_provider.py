@@ -112,6 +112,17 @@ class PiNetworkProvider:
         # Mock implementation - always return True
         return True
     
+    def list_payments(self, created_gte, created_lt, page_size=100):
+        """
+        Stream Pi Network payments created in [created_gte, created_lt)
+        
+        TODO: Replace with real Pi Network API pagination
+        Records must use the same shape as StripeProvider.list_payments:
+        {'id', 'status', 'amount', 'created'}
+        """
+        # Mock implementation - the mock API keeps no payment history
+        return iter(())
+    
     def get_balance(self, user_pi_id):
         """
         Get user's Pi balance
@@ -0,0 +1,260 @@
+"""
+Payment reconciliation against provider records
+
+Compares our Payment rows with what the provider actually holds for a date
+range. Both sides are streamed and walked in provider_payment_id order with a
+sorted merge join, so memory stays bounded regardless of volume:
+
+- Local rows come from a server-side cursor ordered by provider_payment_id
+- Provider listings are not ordered by id, so they go through an external
+  sort that spills fixed-size sorted runs to temporary files
+
+Discrepancies are yielded one at a time (and written as JSON lines by
+reconcile_payments), never accumulated.
+"""
+
+import heapq
+import json
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models.functions import Collate
+
+from .models import Payment
+from .pi_provider import pi_provider
+from .stripe_provider import StripeProvider
+
+MISSING_LOCALLY = 'missing_locally'
+MISSING_AT_PROVIDER = 'missing_at_provider'
+STATUS_MISMATCH = 'status_mismatch'
+AMOUNT_MISMATCH = 'amount_mismatch'
+
+DISCREPANCY_TYPES = [MISSING_LOCALLY, MISSING_AT_PROVIDER, STATUS_MISMATCH, AMOUNT_MISMATCH]
+
+# Provider objects are created a moment before our Payment row, so the
+# provider window is widened to catch rows sitting on the range boundaries
+BOUNDARY_SLACK = timedelta(minutes=10)
+
+# Binary collations, so the database orders ids exactly like Python str
+BINARY_COLLATIONS = {
+    'postgresql': 'C',
+    'sqlite': 'BINARY',
+    'mysql': 'utf8mb4_bin',
+}
+
+PROVIDER_LISTINGS = {
+    'stripe': StripeProvider.list_payments,
+    'pi': pi_provider.list_payments,
+}
+
+# Providers reconciled when none is given (nightly task). Pi Network has no
+# payment listing yet, so every Pi payment would be reported missing.
+DEFAULT_PROVIDERS = ['stripe']
+
+
+def _dump_record(record):
+    return json.dumps({**record, 'amount': str(record['amount'])}) + '\n'
+
+
+def _load_record(line):
+    record = json.loads(line)
+    record['amount'] = Decimal(record['amount'])
+    return record
+
+
+def _read_run(run):
+    run.seek(0)
+    for line in run:
+        yield _load_record(line)
+
+
+def external_sort(records, key, chunk_size=50000):
+    """
+    Sort an arbitrarily large stream of records by key
+
+    At most chunk_size records are held in memory. Each full chunk is
+    sorted and spilled to a temporary file, then the runs are lazily
+    merged with heapq.merge.
+    """
+    runs = []
+    chunk = []
+
+    try:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                chunk.sort(key=key)
+                run = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+                run.writelines(_dump_record(r) for r in chunk)
+                runs.append(run)
+                chunk = []
+
+        chunk.sort(key=key)
+
+        if not runs:
+            yield from chunk
+            return
+
+        yield from heapq.merge(*[_read_run(run) for run in runs], iter(chunk), key=key)
+
+    finally:
+        for run in runs:
+            run.close()
+
+
+def stream_local_payments(provider, start, end, chunk_size=2000):
+    """
+    Stream our Payment rows for a provider, ordered by provider_payment_id
+
+    Uses a binary collation so the order matches Python string comparison,
+    which the merge join relies on.
+    """
+    queryset = Payment.objects.filter(
+        provider=provider,
+        created_at__gte=start,
+        created_at__lt=end,
+    ).exclude(provider_payment_id='')
+
+    collation = BINARY_COLLATIONS.get(connection.vendor)
+    order_key = Collate('provider_payment_id', collation) if collation else 'provider_payment_id'
+
+    rows = queryset.order_by(order_key).values_list(
+        'id', 'provider_payment_id', 'status', 'amount_fiat', 'amount_pi'
+    ).iterator(chunk_size=chunk_size)
+
+    for payment_id, provider_payment_id, status, amount_fiat, amount_pi in rows:
+        yield {
+            'payment_id': payment_id,
+            'id': provider_payment_id,
+            'status': status,
+            'amount': amount_pi if provider == 'pi' else amount_fiat,
+        }
+
+
+def _cents(amount):
+    return Decimal(amount).quantize(Decimal('0.01'))
+
+
+def _ordered(records, side):
+    """Guard the merge join against a stream that is not sorted by id"""
+    previous = None
+    for record in records:
+        if previous is not None and record['id'] < previous:
+            raise ValueError(
+                f"{side} records are not sorted by provider_payment_id "
+                f"({record['id']!r} after {previous!r})"
+            )
+        previous = record['id']
+        yield record
+
+
+def merge_join(local_records, provider_records, start=None, end=None):
+    """
+    Walk two id-sorted streams together and yield discrepancies
+
+    Provider-only records created outside [start, end) are ignored: they
+    were only fetched because of the boundary slack.
+    """
+    local_iter = _ordered(local_records, 'Local')
+    provider_iter = _ordered(provider_records, 'Provider')
+
+    local = next(local_iter, None)
+    remote = next(provider_iter, None)
+
+    start_ts = int(start.timestamp()) if start else None
+    end_ts = int(end.timestamp()) if end else None
+
+    while local is not None or remote is not None:
+        if remote is None or (local is not None and local['id'] < remote['id']):
+            yield {
+                'type': MISSING_AT_PROVIDER,
+                'provider_payment_id': local['id'],
+                'payment_id': local['payment_id'],
+                'local_status': local['status'],
+                'local_amount': str(local['amount']),
+            }
+            local = next(local_iter, None)
+
+        elif local is None or remote['id'] < local['id']:
+            created = remote.get('created')
+            in_range = created is None or (
+                (start_ts is None or created >= start_ts) and (end_ts is None or created < end_ts)
+            )
+            if in_range:
+                yield {
+                    'type': MISSING_LOCALLY,
+                    'provider_payment_id': remote['id'],
+                    'provider_status': remote['status'],
+                    'provider_amount': str(remote['amount']),
+                }
+            remote = next(provider_iter, None)
+
+        else:
+            if local['status'] != remote['status']:
+                yield {
+                    'type': STATUS_MISMATCH,
+                    'provider_payment_id': local['id'],
+                    'payment_id': local['payment_id'],
+                    'local_status': local['status'],
+                    'provider_status': remote['status'],
+                }
+            if _cents(local['amount']) != _cents(remote['amount']):
+                yield {
+                    'type': AMOUNT_MISMATCH,
+                    'provider_payment_id': local['id'],
+                    'payment_id': local['payment_id'],
+                    'local_amount': str(local['amount']),
+                    'provider_amount': str(remote['amount']),
+                }
+            local = next(local_iter, None)
+            remote = next(provider_iter, None)
+
+
+def find_discrepancies(provider, start, end, sort_chunk_size=50000):
+    """Yield discrepancies between our Payment rows and a provider's records"""
+    if provider not in PROVIDER_LISTINGS:
+        raise ValueError(f"Unsupported provider for reconciliation: {provider}")
+
+    listing = PROVIDER_LISTINGS[provider](start - BOUNDARY_SLACK, end + BOUNDARY_SLACK)
+    provider_records = external_sort(listing, key=lambda r: r['id'], chunk_size=sort_chunk_size)
+    local_records = stream_local_payments(provider, start, end)
+
+    return merge_join(local_records, provider_records, start=start, end=end)
+
+
+def reconcile_payments(provider, start, end, report_path=None, sort_chunk_size=50000):
+    """
+    Reconcile a provider for [start, end) and write a discrepancy report
+
+    Args:
+        provider: 'stripe' or 'pi'
+        start, end: Aware datetimes bounding Payment.created_at
+        report_path: File to write discrepancies to as JSON lines (optional)
+
+    Returns:
+        dict: Summary with a count per discrepancy type
+    """
+    summary = {
+        'provider': provider,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'report_path': str(report_path) if report_path else None,
+        'total': 0,
+        **{discrepancy_type: 0 for discrepancy_type in DISCREPANCY_TYPES},
+    }
+
+    report = open(report_path, 'w', encoding='utf-8') if report_path else None
+
+    try:
+        for discrepancy in find_discrepancies(provider, start, end, sort_chunk_size=sort_chunk_size):
+            summary[discrepancy['type']] += 1
+            summary['total'] += 1
+            if report:
+                report.write(json.dumps(discrepancy) + '\n')
+    finally:
+        if report:
+            report.close()
+
+    return summary
@@ -0,0 +1,224 @@
+"""
+Batch refunds for dispute resolution
+
+Resolving a backlog of disputes one refund_order call at a time serializes
+every provider round trip behind a row lock. refund_disputes instead:
+
+- Loads the selected open disputes with their succeeded payment in one query
+- Groups them by provider and walks each group in fixed-size chunks
+- Runs the provider refunds of a chunk concurrently on a thread pool, spaced
+  by a shared rate limiter so the provider's API limits are respected
+- Commits the refunded payments, escrows, orders and disputes of a chunk in
+  one transaction, so a failure later in the batch keeps earlier chunks
+
+Worker threads only talk to the provider; every database write happens on
+the calling thread. Stripe refunds carry an idempotency key per payment, so
+re-running a batch after a crash cannot refund the same payment twice.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.shops.models import Dispute, Order
+from .models import Payment
+from .stripe_provider import StripeProvider
+from . import ledger
+
+OPEN_DISPUTE_STATUSES = ['open', 'in_review']
+
+
+class RateLimiter:
+    """Space calls at least 1/rate seconds apart across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _refund_stripe(provider_payment_id, payment_id):
+    # Free-text reasons are kept locally; Stripe only accepts its own codes
+    return StripeProvider.refund_payment(
+        provider_payment_id,
+        idempotency_key=f'dispute-refund-{payment_id}',
+    )
+
+
+def _refund_pi(provider_payment_id, payment_id):
+    # TODO: Implement Pi Network refund if supported (see refund_order)
+    return {'success': True}
+
+
+PROVIDER_REFUNDS = {
+    'stripe': _refund_stripe,
+    'pi': _refund_pi,
+}
+
+
+def apply_refund(order, payment, reason=None):
+    """
+    Record a provider refund locally: payment, escrow, ledger and order
+
+    Must be called inside a transaction with the order row locked.
+    """
+    payment.status = 'refunded'
+    payment.save()
+
+    if hasattr(payment, 'escrow'):
+        escrow = payment.escrow
+        if escrow.status != 'refunded':
+            ledger.record_refund(payment, released=escrow.status == 'released')
+        escrow.status = 'refunded'
+        escrow.released_at = timezone.now()
+        escrow.notes = reason or 'Refunded'
+        escrow.save()
+
+    order.status = 'refunded'
+    order.save()
+
+
+def _provider_refund(item, limiter):
+    """Run one provider refund (worker thread, no database access)"""
+    limiter.wait()
+    try:
+        return PROVIDER_REFUNDS[item['provider']](item['provider_payment_id'], item['payment_id'])
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
+
+def _commit_chunk(outcomes, reason, resolution):
+    """Persist the refunds of one chunk in a single transaction"""
+    refunded = []
+    failures = []
+
+    with transaction.atomic():
+        succeeded = [item for item, result in outcomes if result['success']]
+        orders = Order.objects.select_for_update().in_bulk([item['order_id'] for item in succeeded])
+        payments = Payment.objects.select_for_update(of=('self',)).select_related('escrow').in_bulk(
+            [item['payment_id'] for item in succeeded]
+        )
+
+        for item in succeeded:
+            payment = payments[item['payment_id']]
+            if payment.status == 'refunded':
+                # The charge.refunded webhook of this very refund (or another batch)
+                # already recorded it: nothing left to apply, but the dispute is settled
+                refunded.append(item['dispute_id'])
+                continue
+            if payment.status != 'succeeded':
+                failures.append({**item, 'error': f"Payment already {payment.status}"})
+                continue
+
+            apply_refund(orders[item['order_id']], payment, reason)
+            refunded.append(item['dispute_id'])
+
+        Dispute.objects.filter(id__in=refunded).update(
+            status='resolved',
+            resolution=resolution,
+            resolved_at=timezone.now(),
+        )
+
+    failures.extend(
+        {**item, 'error': result.get('error', 'Refund failed')}
+        for item, result in outcomes if not result['success']
+    )
+    return refunded, failures
+
+
+def refund_disputes(dispute_ids, reason=None, resolution='Refunded to buyer',
+                    max_workers=None, rate=None, chunk_size=None):
+    """
+    Refund the orders of open disputes and mark the disputes resolved
+
+    Args:
+        dispute_ids: Disputes to resolve
+        reason: Refund reason recorded on the escrow
+        resolution: Resolution text stored on each refunded dispute
+        max_workers: Concurrent provider calls (REFUND_BATCH_WORKERS)
+        rate: Provider calls per second across workers (REFUND_RATE_PER_SECOND)
+        chunk_size: Disputes committed per transaction (REFUND_BATCH_CHUNK_SIZE)
+
+    Returns:
+        dict: Summary with per-provider counts and the failed disputes
+    """
+    max_workers = max_workers or settings.REFUND_BATCH_WORKERS
+    rate = rate or settings.REFUND_RATE_PER_SECOND
+    chunk_size = chunk_size or settings.REFUND_BATCH_CHUNK_SIZE
+
+    dispute_ids = set(dispute_ids)
+    rows = Payment.objects.filter(
+        order__dispute__id__in=dispute_ids,
+        order__dispute__status__in=OPEN_DISPUTE_STATUSES,
+        status='succeeded',
+    ).order_by('order_id', 'id').values_list(
+        'order__dispute__id', 'order_id', 'id', 'provider', 'provider_payment_id'
+    )
+
+    # One payment per order, like refund_order, grouped by provider
+    groups = defaultdict(dict)
+    for dispute_id, order_id, payment_id, provider, provider_payment_id in rows:
+        groups[provider].setdefault(order_id, {
+            'dispute_id': dispute_id,
+            'order_id': order_id,
+            'payment_id': payment_id,
+            'provider': provider,
+            'provider_payment_id': provider_payment_id,
+        })
+
+    summary = {
+        'requested': len(dispute_ids),
+        'refunded': 0,
+        'failed': 0,
+        'skipped': len(dispute_ids) - sum(len(group) for group in groups.values()),
+        'by_provider': {},
+        'failures': [],
+    }
+
+    limiter = RateLimiter(rate)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for provider, group in sorted(groups.items()):
+            items = list(group.values())
+            counts = summary['by_provider'].setdefault(provider, {'refunded': 0, 'failed': 0})
+
+            for start in range(0, len(items), chunk_size):
+                chunk = items[start:start + chunk_size]
+
+                if provider not in PROVIDER_REFUNDS:
+                    outcomes = [(item, {'success': False, 'error': f"Unsupported provider: {provider}"})
+                                for item in chunk]
+                else:
+                    results = executor.map(lambda item: _provider_refund(item, limiter), chunk)
+                    outcomes = list(zip(chunk, results))
+
+                refunded, failures = _commit_chunk(outcomes, reason, resolution)
+
+                counts['refunded'] += len(refunded)
+                counts['failed'] += len(failures)
+                summary['failures'].extend(
+                    {'dispute_id': f['dispute_id'], 'order_id': f['order_id'], 'error': f['error']}
+                    for f in failures
+                )
+
+    summary['refunded'] = sum(c['refunded'] for c in summary['by_provider'].values())
+    summary['failed'] = len(summary['failures'])
+
+    print(f"Batch dispute refund: {summary['refunded']} refunded, {summary['failed']} failed, "
+          f"{summary['skipped']} skipped")
+
+    return summary
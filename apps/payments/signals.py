@@ -0,0 +1,90 @@
+"""
+Live order and payment status push
+
+Order and Payment status transitions are pushed to the buyer and the seller
+over the channel layer once the surrounding transaction commits. Clients
+receive them on the per-user status WebSocket (ws/status/) or the SSE
+fallback (/api/payments/status/stream/) instead of polling the REST API.
+
+Bulk queryset.update() calls bypass these receivers and push nothing.
+"""
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from apps.shops.models import Order, Shop
+from .models import Payment
+
+
+def user_status_group(user_id):
+    """Channel layer group carrying status events for one user"""
+    return f'user_status_{user_id}'
+
+
+def publish_status_event(user_ids, event):
+    """Send a status event to each user's group once the transaction commits"""
+    def send():
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        
+        for user_id in set(user_ids):
+            try:
+                async_to_sync(channel_layer.group_send)(
+                    user_status_group(user_id),
+                    {'type': 'status_update', 'event': event}
+                )
+            except Exception as e:
+                print(f"Status push failed for user {user_id}: {e}")
+    
+    transaction.on_commit(send)
+
+
+@receiver(post_init, sender=Order)
+@receiver(post_init, sender=Payment)
+def remember_loaded_status(sender, instance, **kwargs):
+    """Keep the status as loaded, to detect transitions on save"""
+    # Read __dict__ so a deferred status field is not fetched
+    instance._loaded_status = instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=Order)
+def push_order_status(sender, instance, created, **kwargs):
+    """Push order status transitions to the buyer and the seller"""
+    if instance.status == instance._loaded_status:
+        return
+    instance._loaded_status = instance.status
+    
+    seller_id = Shop.objects.filter(id=instance.shop_id).values_list('owner_id', flat=True).first()
+    
+    publish_status_event([instance.buyer_id, seller_id], {
+        'type': 'order_status',
+        'order_id': instance.id,
+        'order_number': instance.order_number,
+        'status': instance.status,
+        'timestamp': timezone.now().isoformat(),
+    })
+
+
+@receiver(post_save, sender=Payment)
+def push_payment_status(sender, instance, created, **kwargs):
+    """Push payment status transitions to the buyer and the seller"""
+    if instance.status == instance._loaded_status:
+        return
+    instance._loaded_status = instance.status
+    
+    participants = Order.objects.filter(id=instance.order_id).values_list('buyer_id', 'shop__owner_id').first()
+    if not participants:
+        return
+    
+    publish_status_event(participants, {
+        'type': 'payment_status',
+        'payment_id': instance.id,
+        'order_id': instance.order_id,
+        'provider': instance.provider,
+        'status': instance.status,
+        'timestamp': timezone.now().isoformat(),
+    })
@@ -18,6 +18,17 @@ from decimal import Decimal
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
+# Map Stripe PaymentIntent statuses onto Payment.STATUS_CHOICES
+PAYMENT_INTENT_STATUS_MAP = {
+    'requires_payment_method': 'pending',
+    'requires_confirmation': 'pending',
+    'requires_action': 'pending',
+    'processing': 'processing',
+    'requires_capture': 'succeeded',  # Authorized and held in escrow
+    'succeeded': 'succeeded',
+    'canceled': 'failed',
+}
+
 
 class StripeProvider:
     """Stripe payment provider with escrow simulation"""
@@ -105,7 +116,7 @@ class StripeProvider:
             }
     
     @staticmethod
-    def refund_payment(payment_intent_id, amount=None, reason=None):
+    def refund_payment(payment_intent_id, amount=None, reason=None, idempotency_key=None):
         """
         Refund a payment (e.g., dispute resolved in buyer's favor)
         
@@ -113,12 +124,14 @@ class StripeProvider:
             payment_intent_id: Stripe PaymentIntent ID
             amount: Amount to refund in cents (None = full refund)
             reason: Refund reason
+            idempotency_key: Makes retries of the same refund safe (optional)
         """
         try:
             refund = stripe.Refund.create(
                 payment_intent=payment_intent_id,
                 amount=amount,
                 reason=reason or 'requested_by_customer',
+                idempotency_key=idempotency_key,
             )
             
             return {
@@ -164,3 +177,43 @@ class StripeProvider:
                 'success': False,
                 'error': str(e),
             }
+    
+    @staticmethod
+    def list_payments(created_gte, created_lt, page_size=100):
+        """
+        Stream PaymentIntents created in [created_gte, created_lt)
+        
+        Pages are fetched lazily through auto_paging_iter, so only one page
+        is held in memory at a time. Records are normalized to the Payment
+        vocabulary (status and amount in major currency units).
+        
+        Refunding an escrow payment before capture cancels its intent and
+        releases the authorization, so a canceled intent whose charge was
+        authorized is reported as refunded, not failed.
+        
+        Raises stripe.error.StripeError if a page cannot be fetched.
+        """
+        intents = stripe.PaymentIntent.list(
+            created={
+                'gte': int(created_gte.timestamp()),
+                'lt': int(created_lt.timestamp()),
+            },
+            limit=page_size,
+            expand=['data.latest_charge'],
+        )
+        
+        for intent in intents.auto_paging_iter():
+            status = PAYMENT_INTENT_STATUS_MAP.get(intent.status, intent.status)
+            
+            charge = intent.get('latest_charge')
+            if intent.status == 'canceled' and charge and charge.get('status') == 'succeeded':
+                status = 'refunded'
+            elif status == 'succeeded' and charge and charge.get('amount_refunded'):
+                status = 'refunded' if charge.get('refunded') else 'partially_refunded'
+            
+            yield {
+                'id': intent.id,
+                'status': status,
+                'amount': Decimal(intent.amount) / 100,
+                'created': intent.created,
+            }
@@ -5,15 +5,48 @@ These tasks handle:
 - Checking pending payments
 - Auto-releasing escrow funds
 - Sending payment notifications
+- Nightly reconciliation against provider records
+- Batch dispute refunds started from the API or the admin
 """
 
 from celery import shared_task
 from django.utils import timezone
 from django.db import transaction
+from django.conf import settings
+from django.core.cache import cache
 from datetime import timedelta
+from pathlib import Path
+import uuid
 from .models import Payment, EscrowTransaction
 from apps.shops.models import Order
 from .stripe_provider import StripeProvider
+from .refunds import apply_refund
+from . import ledger
+
+ESCROW_SWEEP_LOCK = 'payments:auto_release_escrow:lock'
+ESCROW_SWEEP_LOCK_TIMEOUT = 5 * 60
+
+# Progress and summary of a batch dispute refund, by job id
+REFUND_JOB_KEY = 'payments:refund_disputes:{}'
+REFUND_JOB_TTL = 24 * 60 * 60
+
+
+def refund_job_status(job_id):
+    """Status of a batch dispute refund job, or None if unknown or expired"""
+    return cache.get(REFUND_JOB_KEY.format(job_id))
+
+
+def start_refund_disputes(dispute_ids, reason=None, resolution='Refunded to buyer'):
+    """
+    Queue a batch dispute refund
+    
+    Returns:
+        str: Job id, to poll with refund_job_status
+    """
+    job_id = str(uuid.uuid4())
+    cache.set(REFUND_JOB_KEY.format(job_id), {'status': 'queued', 'requested': len(dispute_ids)}, REFUND_JOB_TTL)
+    refund_disputes_task.apply_async(args=[dispute_ids, reason, resolution], task_id=job_id)
+    return job_id
 
 
 @shared_task
@@ -46,9 +79,11 @@ def check_pending_payments():
                             payment=payment,
                             defaults={
                                 'status': 'held',
-                                'auto_release_date': auto_release_date
+                                'auto_release_date': auto_release_date,
+                                'next_release_check': auto_release_date
                             }
                         )
+                        ledger.record_hold(payment)
                         
                         # Update order
                         order = payment.order
@@ -70,29 +105,62 @@ def check_pending_payments():
 
 
 @shared_task
-def auto_release_escrow():
+def auto_release_escrow(batch_size=100):
     """
-    Auto-release escrow funds after specified period
+    Auto-release escrow funds once their auto_release_date has passed
     
-    Runs daily at midnight (configured in celery.py)
+    Runs every minute (configured in celery.py), so escrows are released
+    within a minute of their date instead of at the next midnight. Due
+    rows are looked up on next_release_check alone, which starts at
+    auto_release_date: the (status, next_release_check) index makes the
+    lookup a range scan over due rows only, so a tick with nothing due
+    costs one index probe, however many escrows were deferred.
+    
+    Escrows that are due but whose order is not releasable yet (not
+    shipped, disputed, capture failed...) are re-checked after
+    ESCROW_RELEASE_RECHECK_MINUTES rather than on every tick, by pushing
+    next_release_check back; their auto_release_date is left untouched. If a
+    full batch was due, the task re-enqueues itself to catch up on the backlog.
     """
-    escrows_to_release = EscrowTransaction.objects.filter(
-        status='held',
-        auto_release_date__lte=timezone.now()
-    )
+    # Only one sweep at a time, so a slow batch is never released twice
+    if not cache.add(ESCROW_SWEEP_LOCK, True, timeout=ESCROW_SWEEP_LOCK_TIMEOUT):
+        return "Escrow release sweep already running"
     
+    due = []
     released_count = 0
+    deferred_ids = []
     
-    for escrow in escrows_to_release:
-        order = escrow.payment.order
+    try:
+        now = timezone.now()
+        due = list(
+            EscrowTransaction.objects.filter(
+                status='held',
+                next_release_check__lte=now
+            ).order_by('next_release_check').values_list(
+                'id', 'payment__order_id', 'payment__order__status'
+            )[:batch_size]
+        )
         
-        # Only auto-release if order is delivered or shipped
-        if order.status in ['delivered', 'shipped']:
-            success = release_escrow_funds.apply(args=[order.id]).get()
-            if success:
+        for escrow_id, order_id, order_status in due:
+            # Only auto-release if order is delivered or shipped
+            if order_status in ['delivered', 'shipped'] and release_escrow_funds(order_id):
                 released_count += 1
+            else:
+                deferred_ids.append(escrow_id)
+        
+        if deferred_ids:
+            EscrowTransaction.objects.filter(id__in=deferred_ids, status='held').update(
+                next_release_check=now + timedelta(minutes=settings.ESCROW_RELEASE_RECHECK_MINUTES)
+            )
+    
+    finally:
+        cache.delete(ESCROW_SWEEP_LOCK)
     
-    return f"Auto-released {released_count} escrow transactions"
+    # Catch up on a backlog (e.g. after downtime) without waiting for the next tick
+    if len(due) == batch_size:
+        auto_release_escrow.delay(batch_size)
+    
+    return f"Auto-released {released_count} escrow transactions ({len(deferred_ids)} deferred)"
 
 
 @shared_task
@@ -143,6 +211,7 @@ def release_escrow_funds(order_id):
             escrow.status = 'released'
             escrow.released_at = timezone.now()
             escrow.save()
+            ledger.record_release(payment)
             
             # Update order status
             order.status = 'released'
@@ -195,21 +264,8 @@ def refund_order(order_id, reason=None):
                 # TODO: Implement Pi Network refund if supported
                 pass
             
-            # Update payment status
-            payment.status = 'refunded'
-            payment.save()
-            
-            # Update escrow
-            if hasattr(payment, 'escrow'):
-                escrow = payment.escrow
-                escrow.status = 'refunded'
-                escrow.released_at = timezone.now()
-                escrow.notes = reason or 'Refunded'
-                escrow.save()
-            
-            # Update order status
-            order.status = 'refunded'
-            order.save()
+            # Update payment, escrow, ledger and order
+            apply_refund(order, payment, reason)
             
             print(f"Order {order.order_number} refunded")
             
@@ -254,4 +310,61 @@ def send_payment_notification(payment_id, notification_type):
     
     except Payment.DoesNotExist:
         print(f"Payment {payment_id} not found")
-        return False
\ No newline at end of file
+        return False
+
+
+@shared_task
+def reconcile_provider_payments(provider=None, days_ago=1):
+    """
+    Reconcile Payment rows against provider records for one UTC day
+    
+    Runs nightly for the previous day (configured in celery.py). Streams
+    both sides, so it runs in bounded memory whatever the payment volume.
+    Discrepancies are written as JSON lines under RECONCILIATION_REPORT_DIR.
+    Without a provider, only DEFAULT_PROVIDERS are reconciled.
+    """
+    from .reconciliation import DEFAULT_PROVIDERS, reconcile_payments
+    
+    end = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days_ago - 1)
+    start = end - timedelta(days=1)
+    
+    report_dir = Path(settings.RECONCILIATION_REPORT_DIR)
+    report_dir.mkdir(parents=True, exist_ok=True)
+    
+    providers = [provider] if provider else DEFAULT_PROVIDERS
+    summaries = []
+    
+    for name in providers:
+        report_path = report_dir / f"{name}-{start:%Y-%m-%d}.jsonl"
+        try:
+            summary = reconcile_payments(name, start, end, report_path=report_path)
+        except Exception as e:
+            print(f"Reconciliation failed for {name} on {start:%Y-%m-%d}: {e}")
+            continue
+        
+        print(f"Reconciled {name} for {start:%Y-%m-%d}: {summary['total']} discrepancies")
+        summaries.append(summary)
+    
+    return summaries
+
+
+@shared_task(bind=True)
+def refund_disputes_task(self, dispute_ids, reason=None, resolution='Refunded to buyer'):
+    """
+    Refund and resolve a batch of disputes outside the request cycle
+    
+    Throttled provider calls make large batches too slow for a web worker.
+    The job status and summary are kept in the cache under the task id.
+    """
+    from .refunds import refund_disputes
+    
+    key = REFUND_JOB_KEY.format(self.request.id)
+    cache.set(key, {'status': 'running', 'requested': len(dispute_ids)}, REFUND_JOB_TTL)
+    try:
+        summary = refund_disputes(dispute_ids, reason=reason, resolution=resolution)
+    except Exception as e:
+        cache.set(key, {'status': 'failed', 'error': str(e)}, REFUND_JOB_TTL)
+        raise
+    
+    cache.set(key, {'status': 'done', 'summary': summary}, REFUND_JOB_TTL)
+    return summary
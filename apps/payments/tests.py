@@ -0,0 +1,501 @@
+import importlib
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+import stripe
+from django.apps import apps as django_apps
+from django.db.models import Sum
+from django.test import TestCase
+from django.utils import timezone
+from apps.accounts.models import User
+from apps.shops.models import Shop, Order, Dispute
+from django.test import override_settings
+from rest_framework.test import APIClient
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from pimarket.asgi import application
+from .signals import user_status_group
+from .models import Payment, EscrowTransaction, LedgerEntry, SellerBalance
+from .stripe_provider import StripeProvider
+from .tasks import auto_release_escrow, reconcile_provider_payments, release_escrow_funds, refund_order
+from . import ledger, reconciliation, refunds, views
+
+
+class PaymentTestMixin:
+    def create_order(self):
+        buyer = User.objects.create(
+            phone_number='+1234567890',
+            display_name='Buyer',
+            is_phone_verified=True
+        )
+        seller = User.objects.create(
+            phone_number='+0987654321',
+            display_name='Seller',
+            is_phone_verified=True
+        )
+        shop = Shop.objects.create(
+            owner=seller,
+            name='Test Shop',
+            address_text='123 Test St',
+            latitude=40.7128,
+            longitude=-74.0060
+        )
+        return Order.objects.create(
+            buyer=buyer,
+            shop=shop,
+            order_number=Order.generate_order_number(),
+            currency='fiat',
+            total_fiat=Decimal('99.99'),
+            status='paid_in_escrow'
+        )
+
+    def create_escrow(self, order, auto_release_date):
+        payment = Payment.objects.create(
+            order=order,
+            provider='pi',
+            provider_payment_id=f'pi_mock_{order.id}',
+            amount_pi=Decimal('31.41'),
+            currency='pi',
+            status='succeeded'
+        )
+        return EscrowTransaction.objects.create(
+            payment=payment,
+            status='held',
+            auto_release_date=auto_release_date,
+            next_release_check=auto_release_date
+        )
+
+
+class ExternalSortTest(TestCase):
+    def test_spilled_runs_are_merged_in_order(self):
+        records = [
+            {'id': f'pi_{n:04d}', 'status': 'succeeded', 'amount': Decimal('1.50'), 'created': n}
+            for n in (7, 3, 9, 1, 8, 2, 6, 4, 5, 0)
+        ]
+
+        result = list(reconciliation.external_sort(iter(records), key=lambda r: r['id'], chunk_size=3))
+
+        self.assertEqual([r['id'] for r in result], [f'pi_{n:04d}' for n in range(10)])
+        self.assertEqual(result[0]['amount'], Decimal('1.50'))
+
+
+class ReconciliationTest(PaymentTestMixin, TestCase):
+    def setUp(self):
+        self.order = self.create_order()
+        self.start = timezone.now() - timedelta(hours=1)
+        self.end = timezone.now() + timedelta(hours=1)
+        self.created = int(timezone.now().timestamp())
+
+        for provider_payment_id, status in [('pi_a', 'succeeded'), ('pi_b', 'succeeded'),
+                                            ('pi_c', 'pending'), ('pi_d', 'succeeded')]:
+            Payment.objects.create(
+                order=self.order,
+                provider='stripe',
+                provider_payment_id=provider_payment_id,
+                amount_fiat=Decimal('99.99'),
+                currency='fiat',
+                status=status
+            )
+
+    def provider_record(self, provider_payment_id, status='succeeded', amount='99.99', created=None):
+        return {
+            'id': provider_payment_id,
+            'status': status,
+            'amount': Decimal(amount),
+            'created': self.created if created is None else created,
+        }
+
+    def reconcile(self, provider_records):
+        listing = mock.Mock(return_value=iter(provider_records))
+        with mock.patch.dict(reconciliation.PROVIDER_LISTINGS, {'stripe': listing}):
+            return list(reconciliation.find_discrepancies('stripe', self.start, self.end, sort_chunk_size=2))
+
+    def test_matching_records_have_no_discrepancies(self):
+        discrepancies = self.reconcile([
+            self.provider_record('pi_d'),
+            self.provider_record('pi_a'),
+            self.provider_record('pi_c', status='pending'),
+            self.provider_record('pi_b'),
+        ])
+        self.assertEqual(discrepancies, [])
+
+    def test_discrepancies_are_classified(self):
+        discrepancies = self.reconcile([
+            self.provider_record('pi_e'),
+            self.provider_record('pi_a', status='refunded'),
+            self.provider_record('pi_c', status='pending', amount='10.00'),
+            self.provider_record('pi_b'),
+        ])
+
+        found = {(d['type'], d['provider_payment_id']) for d in discrepancies}
+        self.assertEqual(found, {
+            (reconciliation.STATUS_MISMATCH, 'pi_a'),
+            (reconciliation.AMOUNT_MISMATCH, 'pi_c'),
+            (reconciliation.MISSING_AT_PROVIDER, 'pi_d'),
+            (reconciliation.MISSING_LOCALLY, 'pi_e'),
+        })
+
+    def test_provider_records_outside_range_are_ignored(self):
+        outside = int((self.start - timedelta(minutes=5)).timestamp())
+        discrepancies = self.reconcile([
+            self.provider_record('pi_a'),
+            self.provider_record('pi_b'),
+            self.provider_record('pi_c', status='pending'),
+            self.provider_record('pi_d'),
+            self.provider_record('pi_0', created=outside),
+        ])
+        self.assertEqual(discrepancies, [])
+
+    def test_refunded_escrow_intent_is_not_a_status_mismatch(self):
+        Payment.objects.filter(provider_payment_id='pi_a').update(status='refunded')
+        intents = [
+            stripe.PaymentIntent.construct_from({
+                'id': provider_payment_id, 'status': status, 'amount': 9999, 'created': self.created,
+                'latest_charge': charge,
+            }, 'sk_test')
+            for provider_payment_id, status, charge in [
+                ('pi_a', 'canceled', {'status': 'succeeded', 'refunded': True, 'amount_refunded': 9999}),
+                ('pi_b', 'succeeded', {'status': 'succeeded', 'refunded': False, 'amount_refunded': 0}),
+                ('pi_c', 'requires_payment_method', None),
+                ('pi_d', 'canceled', None),
+            ]
+        ]
+
+        with mock.patch.object(stripe.PaymentIntent, 'list') as listing:
+            listing.return_value.auto_paging_iter.return_value = iter(intents)
+            records = list(StripeProvider.list_payments(self.start, self.end))
+
+        self.assertEqual([r['status'] for r in records], ['refunded', 'succeeded', 'pending', 'failed'])
+        found = {(d['type'], d['provider_payment_id']) for d in self.reconcile(records)}
+        self.assertEqual(found, {(reconciliation.STATUS_MISMATCH, 'pi_d')})
+
+    def test_nightly_run_skips_providers_without_a_listing(self):
+        with mock.patch('apps.payments.reconciliation.reconcile_payments', return_value={'total': 0}) as reconcile, \
+                tempfile.TemporaryDirectory() as report_dir, override_settings(RECONCILIATION_REPORT_DIR=report_dir):
+            reconcile_provider_payments()
+
+        self.assertEqual([call.args[0] for call in reconcile.call_args_list], ['stripe'])
+
+    def test_unsorted_stream_is_rejected(self):
+        local = iter([{'id': 'pi_b', 'payment_id': 1, 'status': 'succeeded', 'amount': Decimal('1')},
+                      {'id': 'pi_a', 'payment_id': 2, 'status': 'succeeded', 'amount': Decimal('1')}])
+        with self.assertRaises(ValueError):
+            list(reconciliation.merge_join(local, iter([])))
+
+
+class AutoReleaseEscrowTest(PaymentTestMixin, TestCase):
+    def setUp(self):
+        self.order = self.create_order()
+
+    def test_nothing_due_is_a_single_query(self):
+        self.create_escrow(self.order, timezone.now() + timedelta(days=3))
+
+        with self.assertNumQueries(1):
+            auto_release_escrow()
+
+    def test_due_escrow_of_shipped_order_is_released(self):
+        self.order.status = 'shipped'
+        self.order.save()
+        escrow = self.create_escrow(self.order, timezone.now() - timedelta(minutes=1))
+
+        auto_release_escrow()
+
+        escrow.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(escrow.status, 'released')
+        self.assertEqual(self.order.status, 'released')
+
+    def test_due_escrow_of_unshipped_order_is_deferred(self):
+        due = timezone.now() - timedelta(minutes=1)
+        escrow = self.create_escrow(self.order, due)
+
+        auto_release_escrow()
+
+        escrow.refresh_from_db()
+        self.assertEqual(escrow.status, 'held')
+        self.assertEqual(escrow.auto_release_date, due)
+        self.assertGreater(escrow.next_release_check, timezone.now())
+
+        # Not re-checked before next_release_check, even once the order ships
+        self.order.status = 'shipped'
+        self.order.save()
+        auto_release_escrow()
+        escrow.refresh_from_db()
+        self.assertEqual(escrow.status, 'held')
+
+        EscrowTransaction.objects.filter(id=escrow.id).update(next_release_check=timezone.now())
+        auto_release_escrow()
+        escrow.refresh_from_db()
+        self.assertEqual(escrow.status, 'released')
+
+    def test_escrows_created_before_next_release_check_are_backfilled(self):
+        backfill = importlib.import_module(
+            'apps.payments.migrations.0005_escrow_next_release_check_index'
+        ).backfill_next_release_check
+        self.order.status = 'shipped'
+        self.order.save()
+        due = timezone.now() - timedelta(minutes=1)
+        escrow = self.create_escrow(self.order, due)
+        EscrowTransaction.objects.filter(id=escrow.id).update(next_release_check=None)
+
+        backfill(django_apps, None)
+
+        escrow.refresh_from_db()
+        self.assertEqual(escrow.next_release_check, due)
+        auto_release_escrow()
+        escrow.refresh_from_db()
+        self.assertEqual(escrow.status, 'released')
+
+
+@override_settings(PLATFORM_FEE_PERCENT=10)
+class LedgerTest(PaymentTestMixin, TestCase):
+    def setUp(self):
+        self.order = self.create_order()
+        self.order.status = 'shipped'
+        self.order.save()
+        self.escrow = self.create_escrow(self.order, timezone.now() + timedelta(days=7))
+        self.payment = self.escrow.payment
+        self.seller = self.order.shop.owner
+        ledger.record_hold(self.payment)
+
+    def balance(self):
+        return SellerBalance.objects.get(seller=self.seller, currency='pi')
+
+    def test_hold_is_recorded_once(self):
+        self.assertFalse(ledger.record_hold(self.payment))
+        self.assertEqual(self.balance().escrow_balance, Decimal('31.41'))
+        self.assertEqual(LedgerEntry.objects.filter(entry_type='hold').count(), 2)
+
+    def test_release_moves_escrow_to_available_net_of_fee(self):
+        self.assertTrue(release_escrow_funds(self.order.id))
+
+        balance = self.balance()
+        self.assertEqual(balance.escrow_balance, Decimal('0'))
+        self.assertEqual(balance.available_balance, Decimal('28.27'))
+        self.assertEqual(ledger.verify_ledger(), {'unbalanced_transactions': [], 'balance_mismatches': []})
+
+    def test_refund_after_release_reverses_fee(self):
+        release_escrow_funds(self.order.id)
+        self.assertTrue(refund_order(self.order.id, reason='Dispute resolved'))
+
+        balance = self.balance()
+        self.assertEqual(balance.escrow_balance, Decimal('0'))
+        self.assertEqual(balance.available_balance, Decimal('0'))
+        fees = LedgerEntry.objects.filter(account='platform_fees').values_list('amount', flat=True)
+        self.assertEqual(sum(fees), Decimal('0'))
+        self.assertEqual(ledger.verify_ledger()['balance_mismatches'], [])
+
+    def test_verifier_detects_drift_and_rebuild_fixes_it(self):
+        SellerBalance.objects.filter(seller=self.seller).update(escrow_balance=Decimal('1.00'))
+
+        self.assertEqual(len(ledger.verify_ledger()['balance_mismatches']), 1)
+
+        ledger.rebuild_balances()
+        self.assertEqual(ledger.verify_ledger()['balance_mismatches'], [])
+        self.assertEqual(self.balance().escrow_balance, Decimal('31.41'))
+
+    def test_pre_ledger_escrows_are_backfilled(self):
+        backfill_ledger = importlib.import_module('apps.payments.migrations.0003_ledger').backfill_ledger
+        for status, released_at in [('released', timezone.now()), ('refunded', timezone.now()), ('refunded', None)]:
+            escrow = self.create_escrow(self.order, timezone.now())
+            EscrowTransaction.objects.filter(id=escrow.id).update(status=status, released_at=released_at)
+        LedgerEntry.objects.all().delete()
+        SellerBalance.objects.all().delete()
+
+        backfill_ledger(django_apps, None)
+
+        self.assertEqual(ledger.verify_ledger(), {'unbalanced_transactions': [], 'balance_mismatches': []})
+        self.assertEqual(self.balance().escrow_balance, Decimal('31.41'))
+        self.assertEqual(self.balance().available_balance, Decimal('28.27'))
+        self.assertEqual(LedgerEntry.objects.filter(account='platform_fees').aggregate(total=Sum('amount'))['total'],
+                         Decimal('3.14'))
+        # Refund paths set released_at too: a refunded escrow is not taken as released
+        self.assertEqual(
+            set(LedgerEntry.objects.filter(payment__escrow__status='refunded').values_list('entry_type', flat=True)),
+            {'hold', 'refund'},
+        )
+
+    def test_entries_are_append_only(self):
+        entry = LedgerEntry.objects.first()
+        entry.amount = Decimal('0')
+        with self.assertRaises(ValueError):
+            entry.save()
+
+
+class StatusPushTest(PaymentTestMixin, TestCase):
+    def setUp(self):
+        self.order = self.create_order()
+        self.channel_layer = mock.Mock()
+        self.channel_layer.group_send = mock.AsyncMock()
+        patcher = mock.patch('apps.payments.signals.get_channel_layer', return_value=self.channel_layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_order_transition_is_pushed_to_buyer_and_seller_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.order.status = 'shipped'
+            self.order.save()
+            self.channel_layer.group_send.assert_not_called()
+
+        self.assertEqual(len(callbacks), 1)
+        groups = {call.args[0] for call in self.channel_layer.group_send.call_args_list}
+        self.assertEqual(groups, {
+            user_status_group(self.order.buyer_id),
+            user_status_group(self.order.shop.owner_id),
+        })
+        event = self.channel_layer.group_send.call_args.args[1]['event']
+        self.assertEqual(event['type'], 'order_status')
+        self.assertEqual(event['status'], 'shipped')
+
+    def test_save_without_transition_pushes_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            order = Order.objects.get(id=self.order.id)
+            order.notes = 'Leave at the door'
+            order.save()
+
+        self.assertEqual(callbacks, [])
+
+
+class StatusConsumerTest(PaymentTestMixin, TestCase):
+    async def test_status_events_are_forwarded(self):
+        buyer = await User.objects.acreate(phone_number='+1555000111', display_name='Buyer')
+
+        communicator = WebsocketCommunicator(application, '/ws/status/')
+        communicator.scope['user'] = buyer
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        event = {'type': 'order_status', 'order_id': 1, 'status': 'shipped'}
+        await get_channel_layer().group_send(user_status_group(buyer.id), {'type': 'status_update', 'event': event})
+
+        self.assertEqual(await communicator.receive_json_from(), event)
+        await communicator.disconnect()
+
+    async def test_status_stream_closes_after_its_maximum_age(self):
+        with mock.patch.object(views, 'STATUS_STREAM_MAX_AGE', 0.05), \
+                mock.patch.object(views, 'STATUS_STREAM_KEEPALIVE', 0.02):
+            frames = [frame async for frame in views._status_events(1)]
+
+        self.assertEqual(frames[0], 'retry: 5000\n\n')
+        self.assertIn(': keep-alive\n\n', frames)
+        self.assertEqual(get_channel_layer().groups.get(user_status_group(1), {}), {})
+
+    def test_status_stream_is_not_served_under_wsgi(self):
+        buyer = User.objects.create(phone_number='+1555000112', display_name='Buyer')
+        client = APIClient()
+        client.force_authenticate(buyer)
+
+        self.assertEqual(client.get('/api/payments/status/stream/').status_code, 503)
+
+
+class BatchDisputeRefundTest(PaymentTestMixin, TestCase):
+    def setUp(self):
+        first = self.create_order()
+        self.disputes = []
+        for n, provider in enumerate(['stripe', 'stripe', 'pi']):
+            order = Order.objects.create(
+                buyer=first.buyer,
+                shop=first.shop,
+                order_number=f'ORD-DISPUTE-{n}',
+                currency='fiat',
+                total_fiat=Decimal('20.00'),
+                status='disputed'
+            )
+            payment = Payment.objects.create(
+                order=order,
+                provider=provider,
+                provider_payment_id=f'{provider}_{n}',
+                amount_fiat=Decimal('20.00'),
+                currency='fiat',
+                status='succeeded'
+            )
+            EscrowTransaction.objects.create(payment=payment, status='held',
+                                             auto_release_date=timezone.now() + timedelta(days=7))
+            ledger.record_hold(payment)
+            self.disputes.append(Dispute.objects.create(order=order, raised_by=first.buyer, reason='Damaged'))
+
+    def test_refunds_are_grouped_rate_limited_and_committed(self):
+        def stripe_refund(payment_intent_id, **kwargs):
+            if payment_intent_id == 'stripe_1':
+                return {'success': False, 'error': 'Card declined'}
+            return {'success': True, 'refund_id': 're_1', 'status': 'succeeded'}
+
+        with mock.patch.object(refunds.StripeProvider, 'refund_payment', side_effect=stripe_refund) as refund:
+            summary = refunds.refund_disputes([d.id for d in self.disputes] + [999], chunk_size=1)
+
+        self.assertEqual(refund.call_args_list[0].kwargs['idempotency_key'],
+                         f'dispute-refund-{self.disputes[0].order.payments.get().id}')
+        self.assertEqual(summary['requested'], 4)
+        self.assertEqual(summary['refunded'], 2)
+        self.assertEqual(summary['skipped'], 1)
+        self.assertEqual(summary['by_provider'], {
+            'pi': {'refunded': 1, 'failed': 0},
+            'stripe': {'refunded': 1, 'failed': 1},
+        })
+        self.assertEqual(summary['failures'], [
+            {'dispute_id': self.disputes[1].id, 'order_id': self.disputes[1].order_id, 'error': 'Card declined'},
+        ])
+
+        statuses = dict(Dispute.objects.values_list('id', 'status'))
+        self.assertEqual(statuses[self.disputes[0].id], 'resolved')
+        self.assertEqual(statuses[self.disputes[1].id], 'open')
+        self.assertEqual(statuses[self.disputes[2].id], 'resolved')
+        self.assertEqual(Order.objects.filter(status='refunded').count(), 2)
+        self.assertEqual(ledger.verify_ledger()['balance_mismatches'], [])
+
+    def test_already_refunded_payment_is_not_refunded_again(self):
+        Payment.objects.filter(order=self.disputes[2].order).update(status='refunded')
+
+        summary = refunds.refund_disputes([self.disputes[2].id])
+
+        self.assertEqual(summary['skipped'], 1)
+        self.assertEqual(Dispute.objects.get(id=self.disputes[2].id).status, 'open')
+
+    def test_api_is_admin_only(self):
+        client = APIClient()
+        client.force_authenticate(self.disputes[0].raised_by)
+
+        response = client.post('/api/payments/disputes/refund/', {'dispute_ids': [self.disputes[2].id]},
+                               format='json')
+        self.assertEqual(response.status_code, 403)
+
+        admin = User.objects.create(phone_number='+1555000999', display_name='Admin', is_staff=True)
+        client.force_authenticate(admin)
+        response = client.post('/api/payments/disputes/refund/', {'dispute_ids': [self.disputes[2].id]},
+                               format='json')
+        self.assertEqual(response.status_code, 202)
+
+        # Celery runs eagerly in tests: the job is already done
+        job = client.get(f"/api/payments/disputes/refund/{response.data['job_id']}/")
+        self.assertEqual(job.status_code, 200)
+        self.assertEqual(job.data['status'], 'done')
+        self.assertEqual(job.data['summary']['refunded'], 1)
+
+    def test_refund_recorded_by_its_webhook_first_still_resolves_the_dispute(self):
+        from .webhooks import handle_stripe_charge_refunded
+
+        commit_chunk = refunds._commit_chunk
+
+        def webhook_then_commit(outcomes, *args):
+            # charge.refunded of this refund lands before the chunk is committed
+            for item, _ in outcomes:
+                handle_stripe_charge_refunded({'payment_intent': item['provider_payment_id']})
+            return commit_chunk(outcomes, *args)
+
+        refund = {'success': True, 'refund_id': 're_0', 'status': 'succeeded'}
+        with mock.patch.object(refunds.StripeProvider, 'refund_payment', return_value=refund), \
+                mock.patch.object(refunds, '_commit_chunk', side_effect=webhook_then_commit):
+            summary = refunds.refund_disputes([self.disputes[0].id])
+
+        self.assertEqual((summary['refunded'], summary['failures']), (1, []))
+        self.assertEqual(Dispute.objects.get(id=self.disputes[0].id).status, 'resolved')
+        self.assertEqual(ledger.verify_ledger()['balance_mismatches'], [])
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = refunds.RateLimiter(rate=100)
+        started = time.monotonic()
+        for _ in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
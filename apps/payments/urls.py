@@ -7,4 +7,8 @@ urlpatterns = [
     path('create/<int:order_id>/', views.create_payment, name='create-payment'),
     path('confirm/stripe/', views.confirm_stripe_payment, name='confirm-stripe'),
     path('<int:payment_id>/status/', views.payment_status, name='payment-status'),
+    path('balance/', views.seller_balance, name='seller-balance'),
+    path('disputes/refund/', views.refund_disputes, name='refund-disputes'),
+    path('disputes/refund/<uuid:job_id>/', views.refund_disputes_status, name='refund-disputes-status'),
+    path('status/stream/', views.status_stream, name='status-stream'),
 ]
\ No newline at end of file
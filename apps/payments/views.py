@@ -1,16 +1,33 @@
 ﻿from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.db import transaction
 from datetime import timedelta
 from decimal import Decimal
+import asyncio
+import json
 from apps.shops.models import Order
 from .models import Payment, EscrowTransaction
 from .stripe_provider import StripeProvider
 from .pi_provider import pi_provider
 from .serializers import PaymentSerializer
+from . import ledger, tasks
+from .signals import user_status_group
+
+# Seconds between SSE keep-alive comments when no event is pushed
+STATUS_STREAM_KEEPALIVE = 20
+
+# Seconds before the server closes an SSE stream; the client reconnects. Django 4.2 does not
+# notice ASGI disconnects during a streaming response, so this bounds an abandoned stream.
+STATUS_STREAM_MAX_AGE = 5 * 60
 
 
 @api_view(['POST'])
@@ -142,8 +159,10 @@ def confirm_stripe_payment(request):
             EscrowTransaction.objects.create(
                 payment=payment,
                 status='held',
-                auto_release_date=auto_release_date
+                auto_release_date=auto_release_date,
+                next_release_check=auto_release_date
             )
+            ledger.record_hold(payment)
             
             # Update order status
             order = payment.order
@@ -179,4 +198,130 @@ def payment_status(request, payment_id):
     
     return Response({
         'payment': PaymentSerializer(payment).data
-    })
\ No newline at end of file
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def seller_balance(request):
+    """Get the authenticated seller's escrow and available balances"""
+    return Response({
+        'balances': ledger.get_seller_balances(request.user)
+    })
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def refund_disputes(request):
+    """
+    Queue the refund and resolution of a batch of disputes (admin only)
+    
+    Provider refunds run in a Celery task, concurrently under a rate limit
+    and committed per chunk. The response carries the job id to poll with
+    refund_disputes_status.
+    """
+    dispute_ids = request.data.get('dispute_ids')
+    
+    if not isinstance(dispute_ids, list) or not dispute_ids:
+        return Response({
+            'error': 'dispute_ids must be a non-empty list'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        dispute_ids = [int(dispute_id) for dispute_id in dispute_ids]
+    except (TypeError, ValueError):
+        return Response({
+            'error': 'dispute_ids must be integers'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    job_id = tasks.start_refund_disputes(
+        dispute_ids,
+        reason=request.data.get('reason'),
+        resolution=request.data.get('resolution') or 'Refunded to buyer',
+    )
+    
+    return Response({'job_id': job_id}, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def refund_disputes_status(request, job_id):
+    """Status of a batch dispute refund job, with its summary once done (admin only)"""
+    job = tasks.refund_job_status(job_id)
+    
+    if job is None:
+        return Response({'error': 'Unknown or expired job'}, status=status.HTTP_404_NOT_FOUND)
+    
+    return Response({'job_id': job_id, **job})
+
+
+def _stream_user(request):
+    """Resolve the user from the session or a Bearer token"""
+    if request.user.is_authenticated:
+        return request.user
+    
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    
+    return result[0] if result else None
+
+
+async def _status_events(user_id):
+    channel_layer = get_channel_layer()
+    channel = await channel_layer.new_channel()
+    group_name = user_status_group(user_id)
+    
+    await channel_layer.group_add(group_name, channel)
+    
+    loop = asyncio.get_running_loop()
+    closes_at = loop.time() + STATUS_STREAM_MAX_AGE
+    
+    try:
+        yield 'retry: 5000\n\n'
+        
+        while True:
+            remaining = closes_at - loop.time()
+            if remaining <= 0:
+                return
+            
+            try:
+                message = await asyncio.wait_for(
+                    channel_layer.receive(channel), min(STATUS_STREAM_KEEPALIVE, remaining)
+                )
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+                continue
+            
+            event = message['event']
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    
+    finally:
+        await channel_layer.group_discard(group_name, channel)
+
+
+async def status_stream(request):
+    """
+    Server-Sent Events fallback for the status WebSocket (ws/status/)
+    
+    Streams the same order_status / payment_status events. Accepts the
+    session or an `Authorization: Bearer` header (read with fetch, since
+    EventSource cannot send headers).
+    
+    Only served by the ASGI server: under WSGI the stream would hold a
+    worker for its whole lifetime. The stream is closed after
+    STATUS_STREAM_MAX_AGE seconds and the client reconnects.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=503)
+    
+    user = await sync_to_async(_stream_user)(request)
+    
+    if user is None:
+        return HttpResponse(status=401)
+    
+    response = StreamingHttpResponse(_status_events(user.id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
+    return response
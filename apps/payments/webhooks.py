@@ -18,6 +18,7 @@ from django.db import transaction
 from datetime import timedelta
 from .models import Payment, EscrowTransaction
 from .pi_provider import pi_provider
+from . import ledger
 
 
 @csrf_exempt
@@ -85,9 +86,11 @@ def handle_stripe_payment_succeeded(payment_intent):
                     payment=payment,
                     defaults={
                         'status': 'held',
-                        'auto_release_date': auto_release_date
+                        'auto_release_date': auto_release_date,
+                        'next_release_check': auto_release_date
                     }
                 )
+                ledger.record_hold(payment)
                 
                 # Update order
                 order = payment.order
@@ -129,21 +132,24 @@ def handle_stripe_charge_captured(charge):
         return
     
     try:
-        payment = Payment.objects.get(provider_payment_id=payment_intent_id)
-        
-        # Update escrow status
-        if hasattr(payment, 'escrow'):
-            escrow = payment.escrow
-            escrow.status = 'released'
-            escrow.released_at = timezone.now()
-            escrow.save()
-        
-        # Update order status
-        order = payment.order
-        order.status = 'released'
-        order.save()
-        
-        print(f"Escrow released for payment {payment.id}")
+        with transaction.atomic():
+            payment = Payment.objects.select_for_update().get(provider_payment_id=payment_intent_id)
+            
+            # Update escrow status
+            if hasattr(payment, 'escrow'):
+                escrow = payment.escrow
+                if escrow.status == 'held':
+                    ledger.record_release(payment)
+                escrow.status = 'released'
+                escrow.released_at = timezone.now()
+                escrow.save()
+            
+            # Update order status
+            order = payment.order
+            order.status = 'released'
+            order.save()
+            
+            print(f"Escrow released for payment {payment.id}")
     
     except Payment.DoesNotExist:
         print(f"Payment not found for payment_intent: {payment_intent_id}")
@@ -157,23 +163,26 @@ def handle_stripe_charge_refunded(charge):
         return
     
     try:
-        payment = Payment.objects.get(provider_payment_id=payment_intent_id)
-        payment.status = 'refunded'
-        payment.save()
-        
-        # Update escrow
-        if hasattr(payment, 'escrow'):
-            escrow = payment.escrow
-            escrow.status = 'refunded'
-            escrow.released_at = timezone.now()
-            escrow.save()
-        
-        # Update order
-        order = payment.order
-        order.status = 'refunded'
-        order.save()
-        
-        print(f"Payment {payment.id} refunded")
+        with transaction.atomic():
+            payment = Payment.objects.select_for_update().get(provider_payment_id=payment_intent_id)
+            payment.status = 'refunded'
+            payment.save()
+            
+            # Update escrow
+            if hasattr(payment, 'escrow'):
+                escrow = payment.escrow
+                if escrow.status != 'refunded':
+                    ledger.record_refund(payment, released=escrow.status == 'released')
+                escrow.status = 'refunded'
+                escrow.released_at = timezone.now()
+                escrow.save()
+            
+            # Update order
+            order = payment.order
+            order.status = 'refunded'
+            order.save()
+            
+            print(f"Payment {payment.id} refunded")
     
     except Payment.DoesNotExist:
         print(f"Payment not found for payment_intent: {payment_intent_id}")
@@ -233,9 +242,11 @@ def handle_pi_payment_completed(payment_data):
                 payment=payment,
                 defaults={
                     'status': 'held',
-                    'auto_release_date': auto_release_date
+                    'auto_release_date': auto_release_date,
+                    'next_release_check': auto_release_date
                 }
             )
+            ledger.record_hold(payment)
             
             # Update order
             order = payment.order
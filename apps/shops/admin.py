@@ -1,4 +1,4 @@
-﻿from django.contrib import admin
+﻿from django.contrib import admin, messages
 from .models import Shop, Product, ProductCategory, Order, OrderItem, Delivery, Dispute, DisputeMessage
 
 
@@ -83,8 +83,22 @@ class DisputeAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at', 'resolved_at']
     inlines = [DisputeMessageInline]
     
-    actions = ['resolve_disputes']
+    actions = ['resolve_disputes', 'refund_and_resolve_disputes']
     
     def resolve_disputes(self, request, queryset):
         queryset.update(status='resolved')
-    resolve_disputes.short_description = "Mark selected disputes as resolved"
\ No newline at end of file
+    resolve_disputes.short_description = "Mark selected disputes as resolved"
+    
+    def refund_and_resolve_disputes(self, request, queryset):
+        from apps.payments.tasks import start_refund_disputes
+        
+        dispute_ids = list(queryset.values_list('id', flat=True))
+        job_id = start_refund_disputes(dispute_ids, resolution=f"Refunded to buyer by {request.user}")
+        
+        self.message_user(
+            request,
+            f"Refund of {len(dispute_ids)} dispute(s) queued (job {job_id}); "
+            f"progress at /api/payments/disputes/refund/{job_id}/",
+            messages.SUCCESS,
+        )
+    refund_and_resolve_disputes.short_description = "Refund buyers and resolve selected disputes"
\ No newline at end of file
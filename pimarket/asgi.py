@@ -1,11 +1,12 @@
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from apps.messaging.routing import websocket_urlpatterns
+from apps.accounts.middleware import JWTAuthMiddlewareStack
+from apps.messaging.routing import websocket_urlpatterns as messaging_websocket_urlpatterns
+from apps.payments.routing import websocket_urlpatterns as payments_websocket_urlpatterns
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
-        URLRouter(websocket_urlpatterns)
+    "websocket": JWTAuthMiddlewareStack(
+        URLRouter(messaging_websocket_urlpatterns + payments_websocket_urlpatterns)
     ),
 })
\ No newline at end of file
@@ -16,6 +16,18 @@ app.conf.beat_schedule = {
     },
     'auto-release-escrow': {
         'task': 'apps.payments.tasks.auto_release_escrow',
-        'schedule': crontab(hour='0', minute='0'),  # Daily at midnight
+        'schedule': crontab(minute='*'),  # Every minute, cheap when nothing is due
+    },
+    'reconcile-provider-payments': {
+        'task': 'apps.payments.tasks.reconcile_provider_payments',
+        'schedule': crontab(hour='2', minute='0'),  # Nightly, for the previous day
+    },
+    'rollup-messaging-stats': {
+        'task': 'apps.messaging.tasks.rollup_messaging_stats',
+        'schedule': crontab(hour='3', minute='0'),  # Nightly, users active the previous day
+    },
+    'archive-old-messages': {
+        'task': 'apps.messaging.tasks.archive_old_messages',
+        'schedule': crontab(hour='4', minute='0'),  # Nightly, resumes from its checkpoint
     },
 }
\ No newline at end of file
@@ -194,6 +194,9 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
 }
 
+# WebSocket JWT auth: seconds a token's user stays cached (see apps/accounts/middleware.py)
+WEBSOCKET_AUTH_CACHE_TTL = env.int('WEBSOCKET_AUTH_CACHE_TTL', default=60)
+
 # Spectacular (API Documentation)
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Pi Market API',
@@ -209,6 +212,30 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Messaging
+MESSAGE_PROCESSING_BATCH_SIZE = env.int('MESSAGE_PROCESSING_BATCH_SIZE', default=200)
+MESSAGE_DIGEST_QUIET_SECONDS = env.int('MESSAGE_DIGEST_QUIET_SECONDS', default=300)
+MESSAGE_DIGEST_BATCH_SIZE = env.int('MESSAGE_DIGEST_BATCH_SIZE', default=20)
+MESSAGE_DIGEST_TTL = env.int('MESSAGE_DIGEST_TTL', default=24 * 3600)
+MESSAGING_PRESENCE_TTL = env.int('MESSAGING_PRESENCE_TTL', default=60)
+MESSAGING_PRESENCE_HEARTBEAT = env.int('MESSAGING_PRESENCE_HEARTBEAT', default=20)
+MESSAGING_TYPING_INTERVAL = env.float('MESSAGING_TYPING_INTERVAL', default=1.0)
+MESSAGING_TYPING_TIMEOUT = env.float('MESSAGING_TYPING_TIMEOUT', default=5.0)
+MESSAGING_SOCKET_RATE = env.float('MESSAGING_SOCKET_RATE', default=10.0)
+MESSAGING_SOCKET_BURST = env.int('MESSAGING_SOCKET_BURST', default=20)
+MESSAGING_MAX_SUBSCRIPTIONS = env.int('MESSAGING_MAX_SUBSCRIPTIONS', default=100)
+MESSAGING_ACK_MAX_IDS = env.int('MESSAGING_ACK_MAX_IDS', default=500)
+MESSAGE_HISTORY_PAGE_SIZE = env.int('MESSAGE_HISTORY_PAGE_SIZE', default=50)
+MESSAGE_HISTORY_MAX_PAGE_SIZE = env.int('MESSAGE_HISTORY_MAX_PAGE_SIZE', default=200)
+MESSAGE_RETENTION_DAYS = env.int('MESSAGE_RETENTION_DAYS', default=365)
+MESSAGE_RETENTION_BATCH_SIZE = env.int('MESSAGE_RETENTION_BATCH_SIZE', default=1000)
+MESSAGE_RETENTION_PAUSE = env.float('MESSAGE_RETENTION_PAUSE', default=0.2)
+MESSAGE_ARCHIVE_PREFIX = env('MESSAGE_ARCHIVE_PREFIX', default='message_archives')
+MESSAGE_EXPORT_CHUNK_SIZE = env.int('MESSAGE_EXPORT_CHUNK_SIZE', default=500)
+MESSAGE_ATTACHMENT_MAX_SIZE = env.int('MESSAGE_ATTACHMENT_MAX_SIZE', default=10 * 1024 * 1024)
+MESSAGE_UPLOAD_URL_TTL = env.int('MESSAGE_UPLOAD_URL_TTL', default=900)
+MESSAGE_THUMBNAIL_SIZE = env.int('MESSAGE_THUMBNAIL_SIZE', default=320)
+
 # Cache
 CACHES = {
     'default': {
@@ -238,4 +265,14 @@ TWILIO_PHONE_NUMBER = env('TWILIO_PHONE_NUMBER', default='')
 
 # Escrow Settings
 AUTO_RELEASE_DAYS = env.int('AUTO_RELEASE_DAYS', default=7)
-DISPUTE_WINDOW_DAYS = env.int('DISPUTE_WINDOW_DAYS', default=3)
\ No newline at end of file
+DISPUTE_WINDOW_DAYS = env.int('DISPUTE_WINDOW_DAYS', default=3)
+ESCROW_RELEASE_RECHECK_MINUTES = env.int('ESCROW_RELEASE_RECHECK_MINUTES', default=60)
+PLATFORM_FEE_PERCENT = env.float('PLATFORM_FEE_PERCENT', default=0)
+
+# Batch dispute refunds
+REFUND_BATCH_WORKERS = env.int('REFUND_BATCH_WORKERS', default=8)
+REFUND_RATE_PER_SECOND = env.float('REFUND_RATE_PER_SECOND', default=20)
+REFUND_BATCH_CHUNK_SIZE = env.int('REFUND_BATCH_CHUNK_SIZE', default=50)
+
+# Payment Reconciliation
+RECONCILIATION_REPORT_DIR = env('RECONCILIATION_REPORT_DIR', default=str(BASE_DIR / 'reports' / 'reconciliation'))
\ No newline at end of file